@@ -1,9 +1,13 @@
 from django.contrib import admin
 from django.contrib.auth.models import User, Group
 from django.contrib.auth.admin import UserAdmin
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.html import format_html
 from django.utils.translation import gettext_lazy as _
 
-from .models import Profile, Memory, MemoryMedia
+from .models import Profile, Memory, MemoryMedia, DiaryImport, Newsletter
+from .newsletters import queue_newsletter
 
 # Change admin page headers
 admin.site.site_header = _("DiaryTrove Administration")
@@ -14,30 +18,52 @@ admin.site.index_title = _("Welcome to the DiaryTrove Administration Interface")
 class ProfileInLine(admin.TabularInline):
     model = Profile
     can_delete = False
-    fields = ["language", "editable_lock_time", "lock_time", "mail_memory", "mail_reminder", "mail_newsletter"]
-
-
-class MemoryInLine(admin.TabularInline):
-    model = Memory
-    extra = 0
-    show_change_link = True
-    classes = ["collapse"]
-    fields = ["title", "mood", "date", "lock_time"]
+    fields = ["language", "editable_lock_time", "lock_time", "mail_memory", "mail_reminder", "time_zone", "mail_hour", "mail_newsletter", "keep_original_images"]
 
 
 class UserAdminCustom(UserAdmin):
     """
     Keep the default admin entries with a few additions
+    Memories are linked instead of inlined, as some users have thousands of them
     """
-    inlines = [ProfileInLine, MemoryInLine]
+    inlines = [ProfileInLine]
     list_display = ["username", "email", "is_staff"]
+    readonly_fields = ["memories_link"]
+    fieldsets = UserAdmin.fieldsets + ((_("Memories"), {"fields": ["memories_link"]}),)
+
+    @admin.display(description=_("Memories"))
+    def memories_link(self, user:User) -> str:
+        """
+        Link to the memory list filtered on this user, with a single count query
+        """
+        url = reverse("admin:diarytrove_memory_changelist") + f"?owner__id__exact={user.pk}"
+        return format_html('<a href="{}">{}</a>', url, _("See the %(count)s memories") % {"count": user.memory_set.count()})
 
 
 class MemoryMediaInLine(admin.TabularInline):
     model = MemoryMedia
     extra = 0
     classes = ["collapse"]
-    fields = ["file"]
+    fields = ["file", "bytes_saved"]
+    readonly_fields = ["bytes_saved"]
+
+
+class UnlockedListFilter(admin.SimpleListFilter):
+    """
+    Filter memories on their lock state, using the unlock date computed by the database
+    """
+    title = _("Unlocked")
+    parameter_name = "unlocked"
+
+    def lookups(self, request, model_admin):
+        return [("yes", _("Yes")), ("no", _("No"))]
+
+    def queryset(self, request, queryset):
+        if self.value() == "yes":
+            return queryset.filter(unlock_date__lte=timezone.now())
+        if self.value() == "no":
+            return queryset.filter(unlock_date__gt=timezone.now())
+        return queryset
 
 
 class MemoryAdmin(admin.ModelAdmin):
@@ -50,9 +76,54 @@ class MemoryAdmin(admin.ModelAdmin):
         (_("Additional fields"), {"fields": ["mood"]}),
     ]
     inlines = [MemoryMediaInLine]
-    list_display = ["pk", "owner", "title", "mood", "date", "is_unlocked"]
-    list_filter = ["owner", "date", "lock_time"]
-    search_fields = ["title", "content"]
+    list_display = ["pk", "owner", "title", "mood", "date", "unlocked"]
+    list_filter = [UnlockedListFilter, "date"]
+    list_select_related = ["owner"]
+    autocomplete_fields = ["owner"]
+    search_fields = ["title", "content", "owner__username"]
+    show_full_result_count = False  # Avoid an extra full count query when searching
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).with_unlock_date()
+
+    @admin.display(description=_("Unlocked"), boolean=True, ordering="unlock_date")
+    def unlocked(self, memory:Memory) -> bool:
+        """
+        Reads the unlock date annotated by the queryset instead of fetching the owner profile
+        """
+        return memory.unlock_date <= timezone.now() if memory.unlock_date is not None else False
+
+
+class DiaryImportAdmin(admin.ModelAdmin):
+    """
+    Follow the diary imports
+    """
+    list_display = ["pk", "owner", "status", "created", "processed_entries", "total_entries", "imported_entries"]
+    list_filter = ["status"]
+    list_select_related = ["owner"]
+    readonly_fields = ["owner", "archive", "created", "updated", "total_entries", "processed_entries", "imported_entries", "errors"]
+
+
+class NewsletterAdmin(admin.ModelAdmin):
+    """
+    Write newsletters and follow their sending
+    """
+    list_display = ["pk", "subject", "status", "created", "sent_count", "failed_count"]
+    list_filter = ["status"]
+    readonly_fields = ["status", "updated", "sent_count", "failed_count"]
+    actions = ["send_newsletters"]
+
+    @admin.action(description=_("Send the selected newsletters"))
+    def send_newsletters(self, request, queryset):
+        """
+        Queues the newsletters, the background jobs send them within a few minutes
+        Failed ones continue where they stopped
+        """
+        queued = 0
+        for newsletter in queryset:
+            if queue_newsletter(newsletter):
+                queued += 1
+        self.message_user(request, _("%(count)s newsletter(s) will be sent in the next minutes.") % {"count": queued})
 
 
 # Register admin stuff
@@ -62,3 +133,5 @@ admin.site.register(User, UserAdminCustom)
 
 # Register app models
 admin.site.register(Memory, MemoryAdmin)
+admin.site.register(DiaryImport, DiaryImportAdmin)
+admin.site.register(Newsletter, NewsletterAdmin)
@@ -1,4 +1,9 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_migrate, post_delete, post_save
+
+import os
+import sys
 
 
 class DiarytroveConfig(AppConfig):
@@ -6,5 +11,36 @@ class DiarytroveConfig(AppConfig):
     name = 'diarytrove'
 
     def ready(self):
-        from .jobs import start_job_scheduler
-        start_job_scheduler()
+        from .database import configure_sqlite
+        connection_created.connect(configure_sqlite)
+
+        from .backends import create_email_index
+        from .utils import backfill_memory_previews, backfill_memory_anniversaries
+        post_migrate.connect(create_email_index, sender=self)
+        post_migrate.connect(backfill_memory_previews, sender=self)
+        post_migrate.connect(backfill_memory_anniversaries, sender=self)
+
+        from .models import Profile, Memory, MemoryMedia, DiaryImport
+        from .stats import memory_deleted, backfill_stats
+        post_delete.connect(memory_deleted, sender=Memory)
+        post_migrate.connect(backfill_stats, sender=self)
+
+        from .purge import media_deleted, import_deleted
+        post_delete.connect(media_deleted, sender=MemoryMedia)  # Files are deleted right away instead of by the cleanup job
+        post_delete.connect(import_deleted, sender=DiaryImport)
+
+        from .rendering import media_changed
+        post_save.connect(media_changed, sender=MemoryMedia)  # The cached attachment listing of the memory is outdated
+        post_delete.connect(media_changed, sender=MemoryMedia)
+
+        from .jobs import wake_unlock_scheduler
+        post_save.connect(wake_unlock_scheduler, sender=Memory)  # The next unlock date can change
+        post_save.connect(wake_unlock_scheduler, sender=Profile)
+
+        # No threads are started here, management commands don't need them and they wouldn't survive gunicorn forking
+        # Gunicorn starts them with the hooks of gunicorn.conf.py, the other servers need the run_jobs command
+        reloaded = os.environ.get("RUN_MAIN") == "true"  # Reloaded process of the development server
+        without_reloader = sys.argv[1:2] == ["runserver"] and "--noreload" in sys.argv
+        if reloaded or without_reloader:
+            from .jobs import start_job_scheduler
+            start_job_scheduler()
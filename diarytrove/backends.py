@@ -0,0 +1,123 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import PermissionDenied
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.models import User
+from django.db import connection
+from django.db.models import Index, QuerySet
+from django.db.models.functions import Lower
+from django.http import HttpRequest
+
+from hashlib import sha256
+
+EMAIL_INDEX_NAME = "diarytrove_user_email_lower"
+
+
+def users_with_email(email:str) -> QuerySet:
+    """
+    Get the users registered with an email, case insensitive
+    The lookup matches the lowercase email index, so it doesn't scan the user table
+    """
+    return User.objects.annotate(email_lower=Lower("email")).filter(email_lower=email.lower())
+
+
+def resolve_login_user(username_email:str) -> User:
+    """
+    Get the user matching a username or an email in a single query
+    Raises User.DoesNotExist or User.MultipleObjectsReturned like a regular get
+    """
+    if "@" in username_email:  # Usernames cannot contain an @
+        return users_with_email(username_email).get()
+    return User.objects.get(username=username_email)
+
+
+def create_email_index(sender, **kwargs):
+    """
+    Create the lowercase email index on the user table after migrations, if it's missing
+    The user model belongs to django.contrib.auth, so the index can't be declared in its Meta
+    """
+    with connection.cursor() as cursor:
+        constraints = connection.introspection.get_constraints(cursor, User._meta.db_table)
+    if EMAIL_INDEX_NAME in constraints:
+        return
+    with connection.schema_editor() as schema_editor:
+        schema_editor.add_index(User, Index(Lower("email"), name=EMAIL_INDEX_NAME))
+
+
+def client_ip(request:HttpRequest|None) -> str:
+    """
+    Get the IP address of the client, as forwarded by Nginx when in production
+    """
+    if request is None:
+        return ""
+    return request.META.get(settings.LOGIN_THROTTLE_IP_HEADER) or request.META.get("REMOTE_ADDR", "")
+
+
+def throttle_keys(request:HttpRequest|None, username_email:str) -> list[str]:
+    """
+    Get the cache keys counting the failed logins for the client IP and for the account
+    """
+    account = sha256(username_email.strip().lower().encode()).hexdigest()
+    return [f"login_throttle:ip:{client_ip(request)}", f"login_throttle:account:{account}"]
+
+
+def login_throttled(request:HttpRequest|None, username_email:str) -> bool:
+    """
+    Check if there were too many failed logins for this IP address or account recently
+    Only reads the cache, so it can run before any password hashing
+    """
+    ip_key, account_key = throttle_keys(request, username_email)
+    counts = cache.get_many([ip_key, account_key])
+    return (counts.get(ip_key, 0) >= settings.LOGIN_THROTTLE_IP_ATTEMPTS
+            or counts.get(account_key, 0) >= settings.LOGIN_THROTTLE_ACCOUNT_ATTEMPTS)
+
+
+def record_failed_login(request:HttpRequest|None, username_email:str):
+    """
+    Count a failed login for the IP address and the account, the counts expire after the throttle window
+    """
+    for key in throttle_keys(request, username_email):
+        if not cache.add(key, 1, settings.LOGIN_THROTTLE_WINDOW):
+            try:
+                cache.incr(key)
+            except ValueError:
+                cache.set(key, 1, settings.LOGIN_THROTTLE_WINDOW)  # The key expired in between
+
+
+def reset_failed_logins(request:HttpRequest|None, username_email:str):
+    """
+    Forget the failed logins of an account after a successful login
+    """
+    cache.delete(throttle_keys(request, username_email)[1])
+
+
+class UsernameOrEmailBackend(ModelBackend):
+    """
+    Authenticate with either a username or a case insensitive email, with login throttling
+    The user can also be given directly with login_user when the view already resolved it
+    """
+    def authenticate(self, request, username=None, password=None, login_user=None, **kwargs):
+        if username is None:
+            username = kwargs.get(User.USERNAME_FIELD) if login_user is None else login_user.get_username()
+        if username is None or password is None:
+            return None
+
+        # Reject throttled attempts before hashing anything
+        if login_throttled(request, username):
+            raise PermissionDenied("Too many failed login attempts")
+
+        if login_user is None:
+            try:
+                login_user = resolve_login_user(username)
+            except (User.DoesNotExist, User.MultipleObjectsReturned):
+                # Run the default password hasher once to reduce the timing difference with an existing user
+                User().set_password(password)
+                record_failed_login(request, username)
+                return None
+
+        # check_password also rehashes the password if the hasher parameters changed
+        if login_user.check_password(password) and self.user_can_authenticate(login_user):
+            reset_failed_logins(request, username)
+            return login_user
+        record_failed_login(request, username)
+        return None
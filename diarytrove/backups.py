@@ -0,0 +1,302 @@
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from .models import private_storage
+from .storage import PrivateMediaStorage
+
+from contextlib import contextmanager
+from pathlib import Path, PurePosixPath
+from typing import Iterator
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import tarfile
+import tempfile
+import time
+import zlib
+
+COPY_CHUNK_SIZE = 2**20
+SQLITE_BACKUP_PAGES = 1024  # Pages copied at once, writers can use the database between the steps
+EXCLUDED_MEDIA_FOLDERS = ("uploads",)  # Unfinished chunked uploads
+MANIFEST_VERSION = 2  # Version 1 manifests have the modification times in nanoseconds instead of seconds
+MTIME_TOLERANCE = 1e-6  # Seconds, times converted from nanoseconds can differ in their last digits
+
+
+class BackupError(Exception):
+    pass
+
+
+@contextmanager
+def corrupted_as(description:str):
+    """
+    Turns the errors of damaged archives into backup errors
+    """
+    try:
+        yield
+    except (tarfile.TarError, EOFError, zlib.error, gzip.BadGzipFile) as e:
+        raise BackupError(f"{description} is corrupted ({e})")
+
+
+class HashingReader:
+    """
+    File like object hashing and counting the bytes read through it
+    """
+    def __init__(self, source):
+        self.source = source
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size:int=-1) -> bytes:
+        data = self.source.read(size)
+        self.hash.update(data)
+        self.size += len(data)
+        return data
+
+    def hexdigest(self) -> str:
+        return self.hash.hexdigest()
+
+
+class Throughput:
+    """
+    Counts the bytes processed by a backup, a verification or a restoration
+    """
+    def __init__(self):
+        self.start = time.monotonic()
+        self.bytes = 0
+        self.files = 0
+
+    def add(self, size:int):
+        self.bytes += size
+        self.files += 1
+
+    def report(self) -> str:
+        duration = max(time.monotonic() - self.start, 0.001)
+        return f"{self.files} files, {round(self.bytes / 2**20, 3)} MiB in {duration:.1f}s ({self.bytes / 2**20 / duration:.1f} MiB/s)"
+
+
+def backup_names(backup_root:Path) -> list[str]:
+    """
+    Get the names of the complete backups, from the oldest to the newest
+    """
+    if not backup_root.exists():
+        return []
+    return sorted(folder.name for folder in backup_root.iterdir() if (folder / "manifest.json").exists())
+
+
+def read_manifest(backup_root:Path, name:str) -> dict:
+    """
+    Get the manifest of a backup, converted to the current version
+    """
+    try:
+        with open(backup_root / name / "manifest.json", encoding="utf-8") as manifest_file:
+            manifest = json.load(manifest_file)
+    except FileNotFoundError:
+        raise BackupError(f"Backup {name} does not exist")
+    if manifest.get("version", 1) < 2:
+        for entry in manifest["media"].values():
+            entry["mtime"] /= 1e9
+    manifest["version"] = MANIFEST_VERSION
+    return manifest
+
+
+def copy_stream(source, destination, throughput:Throughput) -> tuple[int, str]:
+    """
+    Copies a stream by chunks, and returns its size and hash
+    The stream is only read and hashed when there's no destination
+    """
+    reader = HashingReader(source)
+    while data := reader.read(COPY_CHUNK_SIZE):
+        if destination is not None:
+            destination.write(data)
+    throughput.add(reader.size)
+    return reader.size, reader.hexdigest()
+
+
+def postgres_command(program:str, *args:str) -> tuple[list[str], dict]:
+    """
+    Get the command line and the environment to run a PostgreSQL client on the configured database
+    """
+    database = settings.DATABASES["default"]
+    command = [program, *args, "--host", str(database.get("HOST") or "localhost"), "--port", str(database.get("PORT") or 5432),
+               "--username", str(database.get("USER") or ""), database["NAME"]]
+    return command, {**os.environ, "PGPASSWORD": str(database.get("PASSWORD") or "")}
+
+
+def backup_database(folder:Path, throughput:Throughput) -> dict:
+    """
+    Writes a consistent compressed snapshot of the database, while the website keeps using it
+    SQLite databases are copied with the online backup API, PostgreSQL ones are dumped with pg_dump
+    """
+    if connection.vendor == "sqlite":
+        connection.ensure_connection()
+        with tempfile.NamedTemporaryFile(dir=folder, suffix=".sqlite3") as snapshot:
+            target = sqlite3.connect(snapshot.name)
+            try:
+                connection.connection.backup(target, pages=SQLITE_BACKUP_PAGES)
+            finally:
+                target.close()
+            with open(snapshot.name, "rb") as source, gzip.open(folder / "database.sqlite3.gz", "wb") as output:
+                size, sha256 = copy_stream(source, output, throughput)
+        return {"file": "database.sqlite3.gz", "vendor": "sqlite", "size": size, "sha256": sha256}
+
+    if connection.vendor == "postgresql":
+        command, env = postgres_command("pg_dump", "--clean", "--if-exists", "--no-owner")
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, env=env)
+        with gzip.open(folder / "database.sql.gz", "wb") as output:
+            size, sha256 = copy_stream(process.stdout, output, throughput)
+        if process.wait() != 0:
+            raise BackupError(f"pg_dump failed with exit code {process.returncode}")
+        return {"file": "database.sql.gz", "vendor": "postgresql", "size": size, "sha256": sha256}
+
+    raise BackupError(f"Backups of {connection.vendor} databases are not supported")
+
+
+def media_files() -> Iterator[tuple[str, int, float]]:
+    """
+    Generates the private media files to back up with their size and modification time, on the disk or in a bucket
+    """
+    for name, size, modified in private_storage.iter_files():
+        if PurePosixPath(name).parts[0] not in EXCLUDED_MEDIA_FOLDERS:
+            yield name, size, modified
+
+
+def create_backup(backup_root:Path, full:bool=False) -> tuple[str, dict, Throughput]:
+    """
+    Backs up the database and the private media files which changed since the last backup
+    Files are compared by size and modification time, unchanged ones point to the backup which already holds them
+    A full backup copies every file, older backups can then be deleted
+    Returns the name of the backup, its manifest, and what it copied
+    """
+    names = backup_names(backup_root)
+    previous = read_manifest(backup_root, names[-1])["media"] if names and not full else {}
+    name = timezone.now().strftime("%Y%m%d-%H%M%S")
+    folder = backup_root / name
+    folder.mkdir(parents=True)
+    throughput = Throughput()
+
+    try:
+        manifest = {"version": MANIFEST_VERSION, "created": timezone.now().isoformat(), "full": full or not names, "media": {}}
+        manifest["database"] = backup_database(folder, throughput)
+
+        with open(folder / "media.tar.gz", "wb") as archive_file, tarfile.open(fileobj=archive_file, mode="w|gz") as archive:
+            for path, size, modified in media_files():
+                old = previous.get(path)
+                if old is not None and old["size"] == size and abs(old["mtime"] - modified) < MTIME_TOLERANCE:
+                    manifest["media"][path] = old
+                    continue
+                try:
+                    source = private_storage.open(path, "rb")
+                except FileNotFoundError:
+                    continue  # Deleted meanwhile
+                with source:
+                    info = archive.tarinfo(path)
+                    info.size, info.mtime = size, int(modified)
+                    reader = HashingReader(source)
+                    archive.addfile(info, reader)  # Streamed, the file is read once
+                throughput.add(reader.size)
+                manifest["media"][path] = {"size": size, "mtime": modified, "sha256": reader.hexdigest(), "backup": name}
+    except BaseException:
+        shutil.rmtree(folder, ignore_errors=True)  # Never leave an incomplete backup which could be used as a base
+        raise
+
+    # Written last, a backup without manifest is incomplete
+    with open(folder / "manifest.json", "w", encoding="utf-8") as manifest_file:
+        json.dump(manifest, manifest_file, indent=1)
+    return name, manifest, throughput
+
+
+def archive_media(backup_root:Path, manifest:dict) -> Iterator[tuple[str, tarfile.TarFile, tarfile.TarInfo, dict]]:
+    """
+    Generates the media files of a manifest from the archives holding them, reading each archive once as a stream
+    Yields the path, the archive and the member to extract, and the manifest entry
+    """
+    by_backup = {}
+    for path, entry in manifest["media"].items():
+        by_backup.setdefault(entry["backup"], {})[path] = entry
+    for backup, entries in sorted(by_backup.items()):
+        try:
+            archive_file = open(backup_root / backup / "media.tar.gz", "rb")
+        except FileNotFoundError:
+            raise BackupError(f"Backup {backup} holding {len(entries)} media files is missing")
+        with archive_file, tarfile.open(fileobj=archive_file, mode="r|gz") as archive:
+            for member in archive:
+                if member.name in entries:
+                    yield member.name, archive, member, entries.pop(member.name)
+        if entries:
+            raise BackupError(f"{len(entries)} media files are missing from backup {backup}, like {next(iter(entries))}")
+
+
+def verify_backup(backup_root:Path, name:str) -> Throughput:
+    """
+    Checks that the database snapshot and all the media files of a backup can be read and match their hashes
+    """
+    manifest = read_manifest(backup_root, name)
+    throughput = Throughput()
+    database = manifest["database"]
+    with corrupted_as("The database snapshot"), gzip.open(backup_root / name / database["file"], "rb") as source:
+        size, sha256 = copy_stream(source, None, throughput)
+    if (size, sha256) != (database["size"], database["sha256"]):
+        raise BackupError("The database snapshot is corrupted")
+
+    with corrupted_as("A media archive"):
+        for path, archive, member, entry in archive_media(backup_root, manifest):
+            size, sha256 = copy_stream(archive.extractfile(member), None, throughput)
+            if (size, sha256) != (entry["size"], entry["sha256"]):
+                raise BackupError(f"The media file {path} is corrupted")
+    return throughput
+
+
+def restore_backup(backup_root:Path, name:str, media_root:Path=None, database_output:Path=None) -> Throughput:
+    """
+    Restores the media files of a backup and its database, checking the hashes while writing
+    The media files are written in the media_root folder, or in the configured storage
+    A SQLite database is written to database_output, the website must be stopped if it's the database in use
+    A PostgreSQL dump is loaded with psql in the configured database
+    """
+    manifest = read_manifest(backup_root, name)
+    throughput = Throughput()
+    storage = private_storage if media_root is None else PrivateMediaStorage(location=str(media_root))
+
+    with corrupted_as("A media archive"):
+        for path, archive, member, entry in archive_media(backup_root, manifest):
+            relative = PurePosixPath(path)
+            if relative.is_absolute() or ".." in relative.parts:
+                raise BackupError(f"Invalid media path {path}")
+            reader = HashingReader(archive.extractfile(member))
+            storage.overwrite(path, reader, modified=entry["mtime"])  # The next backup of the disk sees it as unchanged
+            throughput.add(reader.size)
+            if (reader.size, reader.hexdigest()) != (entry["size"], entry["sha256"]):
+                storage.delete(path)
+                raise BackupError(f"The media file {path} is corrupted")
+
+    database = manifest["database"]
+    if database["vendor"] != "sqlite":
+        with corrupted_as("The database dump"), gzip.open(backup_root / name / database["file"], "rb") as source:
+            if copy_stream(source, None, Throughput()) != (database["size"], database["sha256"]):
+                raise BackupError("The database dump is corrupted")  # Checked before loading anything
+
+    with corrupted_as("The database snapshot"), gzip.open(backup_root / name / database["file"], "rb") as source:
+        if database["vendor"] == "sqlite":
+            database_output = Path(database_output or settings.DATABASES["default"]["NAME"])
+            temporary = database_output.with_name(database_output.name + ".restoring")
+            with open(temporary, "wb") as output:
+                size, sha256 = copy_stream(source, output, throughput)
+            if (size, sha256) != (database["size"], database["sha256"]):
+                temporary.unlink()
+                raise BackupError("The database snapshot is corrupted")
+            for suffix in ("-wal", "-shm"):  # Would be applied to the restored database
+                database_output.with_name(database_output.name + suffix).unlink(missing_ok=True)
+            os.replace(temporary, database_output)
+        else:
+            command, env = postgres_command("psql", "--quiet", "--set", "ON_ERROR_STOP=1")
+            process = subprocess.Popen(command, stdin=subprocess.PIPE, env=env)
+            with process.stdin:
+                copy_stream(source, process.stdin, throughput)
+            if process.wait() != 0:
+                raise BackupError(f"psql failed with exit code {process.returncode}")
+    return throughput
@@ -0,0 +1,70 @@
+from django.conf import settings
+from django.db import connection
+from django.db.models import Func, TextField
+
+import logging
+import time
+
+logger = logging.getLogger("diarytrove.jobs")
+
+
+class UnicodeLower(Func):
+    """
+    Lowercases text with all its letters, the LOWER function of SQLite only handles the ASCII ones
+    """
+    function = "LOWER"
+    output_field = TextField()
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        return super().as_sql(compiler, connection, function="UNICODE_LOWER", **extra_context)
+
+
+def unicode_lower(text:str|None) -> str|None:
+    return text.lower() if text is not None else None
+
+
+def configure_sqlite(sender, connection, **kwargs):
+    """
+    Applies the SQLite pragmas to each new connection, so readers don't block the writer and waiting writers retry
+    Also adds the functions used by the queries
+    """
+    if connection.vendor != "sqlite":
+        return
+    connection.connection.create_function("UNICODE_LOWER", 1, unicode_lower, deterministic=True)
+    with connection.cursor() as cursor:
+        for pragma, value in settings.SQLITE_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {pragma} = {value}")
+
+
+def sqlite_maintenance_steps(cursor) -> list[tuple[str, str]]:
+    """
+    Get the maintenance statements of a SQLite database
+    Incremental vacuum needs the database to be converted once with a full vacuum
+    """
+    cursor.execute("PRAGMA auto_vacuum")
+    steps = []
+    if cursor.fetchone()[0] != 2:  # 2 is incremental
+        steps += [("enable_incremental_vacuum", "PRAGMA auto_vacuum = INCREMENTAL"), ("vacuum", "VACUUM")]
+    return steps + [("optimize", "PRAGMA optimize"),
+                    ("incremental_vacuum", "PRAGMA incremental_vacuum"),
+                    ("wal_checkpoint", "PRAGMA wal_checkpoint(TRUNCATE)")]
+
+
+def database_maintenance():
+    """
+    Refreshes the query planner statistics and gives the free pages back, logging the duration of each step
+    """
+    with connection.cursor() as cursor:
+        if connection.vendor == "sqlite":
+            steps = sqlite_maintenance_steps(cursor)
+        elif connection.vendor == "postgresql":
+            steps = [("analyze", "ANALYZE")]  # Vacuuming is left to autovacuum
+        else:
+            return
+
+        for name, sql in steps:
+            start = time.monotonic()
+            cursor.execute(sql)
+            if connection.vendor == "sqlite":
+                cursor.fetchall()  # Some pragmas only run fully once their rows are read
+            logger.info("maintenance=%s vendor=%s duration=%.2fs", name, connection.vendor, time.monotonic() - start)
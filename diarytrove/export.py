@@ -0,0 +1,114 @@
+from django.contrib.auth.models import User
+from django.utils import timezone
+
+from .models import Memory, MemoryMedia
+
+from pathlib import Path
+from typing import Iterator
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED
+import json
+
+CHUNK_SIZE = 2**20  # Bytes read at once from the media files, 1 MiB
+
+
+class ZipStreamBuffer:
+    """
+    Write only file object keeping what the zip file writes until it gets popped
+    It has no seek or tell, so ZipFile writes the archive sequentially with data descriptors
+    """
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data:bytes) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def memory_folder(memory:Memory) -> str:
+    """
+    Get the name of the folder containing a memory in the archive
+    """
+    return f"{timezone.localtime(memory.date):%Y-%m-%d}_{memory.pk}"
+
+
+def memory_json(memory:Memory, medias:list[MemoryMedia]) -> str:
+    """
+    Serializes a memory and the names of its media files
+    """
+    return json.dumps({
+        "title": memory.title,
+        "date": memory.date.isoformat(),
+        "lock_time": memory.lock_time,
+        "mood": memory.mood,
+        "mood_emoji": memory.MOODS[memory.mood-1][1],
+        "content": memory.content,
+        "markdown": memory.markdown,
+        "media": [f"media/{Path(media.file.name).name}" for media in medias],
+    }, ensure_ascii=False, indent=4)
+
+
+def memory_markdown(memory:Memory, medias:list[MemoryMedia]) -> str:
+    """
+    Formats a memory as a readable Markdown document
+    """
+    lines = [f"# {memory.MOODS[memory.mood-1][1]} {memory.title}", "",
+             f"*{timezone.localtime(memory.date):%Y-%m-%d %H:%M}*", "", memory.content.strip(), ""]
+    for media in medias:
+        name = Path(media.file.name).name
+        lines.append(f"- [{name}](media/{name.replace(' ', '%20')})")
+    return "\n".join(lines) + "\n"
+
+
+def archive_info(name:str, memory:Memory, compress_type:int) -> ZipInfo:
+    """
+    Creates the zip entry information for a file of a memory, dated like the memory
+    """
+    date_time = timezone.localtime(memory.date).timetuple()[:6]
+    info = ZipInfo(name, date_time=max(date_time, (1980, 1, 1, 0, 0, 0)))  # Zip dates start in 1980
+    info.compress_type = compress_type
+    return info
+
+
+def diary_zip_stream(user:User, include_locked:bool=False) -> Iterator[bytes]:
+    """
+    Generates a zip archive of the user diary chunk by chunk, to stream it with constant memory usage
+    Each memory gets a folder with a JSON and a Markdown document, and its media files
+    """
+    buffer = ZipStreamBuffer()
+    memories = Memory.objects.filter(owner=user)
+    if not include_locked:
+        memories = memories.unlocked()  # Locked memories stay hidden until they unlock
+    memories = memories.order_by("date").prefetch_related("memorymedia_set")
+
+    with ZipFile(buffer, "w", compression=ZIP_DEFLATED) as archive:
+        for memory in memories.iterator(chunk_size=100):
+            folder = memory_folder(memory)
+            medias = list(memory.memorymedia_set.all())
+            archive.writestr(archive_info(f"{folder}/memory.json", memory, ZIP_DEFLATED), memory_json(memory, medias))
+            archive.writestr(archive_info(f"{folder}/memory.md", memory, ZIP_DEFLATED), memory_markdown(memory, medias))
+            yield buffer.pop()
+
+            for media in medias:
+                storage = media.file.storage
+                try:
+                    source = storage.open(media.file.name, "rb")
+                except FileNotFoundError:
+                    continue  # The media file is missing, export what's left
+
+                # Media files are usually already compressed, so they're stored as is
+                info = archive_info(f"{folder}/media/{Path(media.file.name).name}", memory, ZIP_STORED)
+                info.file_size = storage.size(media.file.name)  # Lets zipfile pick zip64 for huge files
+                with source, archive.open(info, "w") as destination:
+                    while chunk := source.read(CHUNK_SIZE):
+                        destination.write(chunk)
+                        yield buffer.pop()
+
+    yield buffer.pop()  # Central directory
@@ -24,4 +24,11 @@ class PreferencesForm(forms.Form):
                                     choices=Profile.EMAIL_MEMORIES, widget=forms.Select)
     language = forms.ChoiceField(label=_("Email language"),
                                  choices=Profile.AVAILABLE_LANGUAGES, widget=forms.Select)
+    time_zone = forms.ChoiceField(label=_("Time zone"), choices=Profile.TIME_ZONES, widget=forms.Select)
+    mail_hour = forms.IntegerField(label=_("Hour to receive writing reminders"), min_value=0, max_value=23)
     mail_newsletter = forms.BooleanField(label=_("Receive email newsletters"), required=False)
+    keep_original_images = forms.BooleanField(label=_("Keep the original uploaded images, without reducing their size"), required=False)
+
+
+class ImportForm(forms.Form):
+    archive = forms.FileField(label=_("Diary archive (zip)"))
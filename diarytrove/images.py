@@ -0,0 +1,180 @@
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import transaction
+
+from .models import MemoryMedia
+from .rendering import bump_memory_version
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from mimetypes import guess_type
+from pathlib import Path, PurePosixPath
+from threading import Lock, get_ident
+import hashlib
+import os
+import time
+import traceback
+
+OPTIMIZED_FORMATS = ("JPEG", "MPO", "PNG", "WEBP", "TIFF", "BMP")  # Formats worth re-encoding, animated ones are left as is
+FORMAT_EXTENSIONS = {"JPEG": ".jpg", "WEBP": ".webp", "PNG": ".png"}
+
+executor = None
+executor_lock = Lock()
+
+
+def image_executor() -> ThreadPoolExecutor:
+    """
+    Get the thread pool optimizing images, created on first use
+    """
+    global executor
+    with executor_lock:
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=settings.IMAGE_OPTIMIZATION_WORKERS, thread_name_prefix="image")
+    return executor
+
+
+def encode_image(source) -> tuple[bytes, str]|None:
+    """
+    Re-encodes an image with a normalized orientation, no metadata and a capped size
+    Returns the encoded data and its extension, or None if the image can't or shouldn't be re-encoded
+    """
+    max_edge = settings.IMAGE_MAX_EDGE
+    image_format = settings.IMAGE_FORMAT
+    try:
+        with Image.open(source) as image:
+            if image.format not in OPTIMIZED_FORMATS or getattr(image, "n_frames", 1) > 1:
+                return None
+            if image.format == "JPEG":
+                image.draft("RGB", (max_edge, max_edge))  # Decode big photos directly at a reduced scale
+            has_alpha = image.mode in ("RGBA", "LA", "PA") or (image.mode == "P" and "transparency" in image.info)
+            if has_alpha and image_format == "JPEG":
+                image_format = "PNG"  # JPEG would lose the transparency
+
+            image = ImageOps.exif_transpose(image)  # Apply the orientation before dropping the metadata
+            image.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+            if image.mode not in ("RGB", "RGBA") or (image_format == "JPEG" and image.mode != "RGB"):
+                image = image.convert("RGBA" if has_alpha else "RGB")
+
+            # No exif or icc data is passed, so the metadata is stripped
+            output = BytesIO()
+            image.save(output, format=image_format, quality=settings.IMAGE_QUALITY, optimize=True)
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError, ValueError):
+        return None
+    return output.getvalue(), FORMAT_EXTENSIONS.get(image_format, f".{image_format.lower()}")
+
+
+def optimize_memory_media(media_pk:int):
+    """
+    Replaces an uploaded image by its optimized version without metadata, and records the saved bytes
+    Images of users who chose to keep their originals are left untouched, like the videos and other files
+    """
+    try:
+        media = MemoryMedia.objects.select_related("memory__owner__profile").get(pk=media_pk, processed=False)
+    except MemoryMedia.DoesNotExist:
+        return  # Already processed or deleted
+
+    storage = media.file.storage
+    old_name = media.file.name
+    profile = getattr(media.memory.owner, "profile", None)
+    encoded = None
+    old_size = 0
+    is_image = (guess_type(old_name)[0] or "").startswith("image/")  # Other files aren't downloaded from a bucket
+    if is_image and (profile is None or not profile.keep_original_images):
+        try:
+            old_size = storage.size(old_name)
+            with storage.open(old_name, "rb") as source:
+                encoded = encode_image(source)
+        except FileNotFoundError:
+            encoded = None
+
+    if encoded is None:
+        MemoryMedia.objects.filter(pk=media_pk).update(processed=True)
+        return
+
+    # Kept even when it isn't smaller, the original has metadata like the GPS position, the saved bytes are then negative
+    data, extension = encoded
+    path = PurePosixPath(old_name)
+    new_name = storage.save(str(path.with_suffix(extension)), ContentFile(data))
+    updated = MemoryMedia.objects.filter(pk=media_pk, processed=False).update(file=new_name, processed=True,
+                                                                               bytes_saved=old_size - len(data))
+    if not updated:
+        storage.delete(new_name)  # Processed somewhere else meanwhile, or deleted
+        return
+    if new_name != old_name:
+        storage.delete(old_name)
+    bump_memory_version(media.memory_id)  # The attachment listing shows the new file
+
+
+def optimize_media_thread(media_pk:int):
+    try:
+        optimize_memory_media(media_pk)
+    except Exception as e:
+        print(f"\n/!\\ Error while optimizing media {media_pk}: {e}:\n{traceback.format_exc()}")
+
+
+def optimize_images(media_pks:list[int]):
+    """
+    Queues media files to be optimized by the image thread pool, once the current transaction is committed
+    """
+    if not settings.IMAGE_OPTIMIZATION:
+        return
+    def submit():
+        for media_pk in media_pks:
+            image_executor().submit(optimize_media_thread, media_pk)
+    transaction.on_commit(submit)
+
+
+def optimize_pending_images():
+    """
+    Optimizes the media files which weren't processed yet, for example when the server stopped meanwhile
+    """
+    if not settings.IMAGE_OPTIMIZATION:
+        return
+    for media_pk in MemoryMedia.objects.filter(processed=False).values_list("pk", flat=True).iterator():
+        optimize_media_thread(media_pk)
+
+
+
+def email_image(media:MemoryMedia, size:int) -> Path|None:
+    """
+    Get a JPEG version of an image fitting in size pixels to attach to emails, or None if it can't be read
+    The versions are cached on disk, named after the media file so a replaced file gets a new version
+    """
+    name_hash = hashlib.md5(media.file.name.encode()).hexdigest()[:12]
+    path = Path(settings.EMAIL_IMAGE_CACHE_DIR) / f"{media.pk}-{name_hash}-{size}.jpg"
+    if path.exists():
+        return path
+
+    try:
+        with media.file.storage.open(media.file.name, "rb") as source, Image.open(source) as image:
+            image.draft("RGB", (size, size))
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((size, size), Image.Resampling.LANCZOS)
+            output = BytesIO()
+            image.convert("RGB").save(output, format="JPEG", quality=80, optimize=True)
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError, ValueError):
+        return None
+
+    # Write then rename, so another thread never reads a partial file
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temporary = path.with_name(f"{path.name}.{os.getpid()}.{get_ident()}.tmp")
+    temporary.write_bytes(output.getvalue())
+    os.replace(temporary, path)
+    return path
+
+
+def cleanup_email_images():
+    """
+    Deletes the email versions of images which weren't used recently
+    """
+    cache_dir = Path(settings.EMAIL_IMAGE_CACHE_DIR)
+    if not cache_dir.exists():
+        return
+    expiration = time.time() - settings.EMAIL_IMAGE_CACHE_DAYS * 86400
+    for path in cache_dir.iterdir():
+        try:
+            if path.stat().st_atime < expiration and path.stat().st_mtime < expiration:
+                path.unlink()
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,314 @@
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.db import transaction
+from django.db.models import F, Max
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .utils import check_profiles, private_media_usage
+from .images import optimize_images
+from .stats import add_memories_to_stats
+from .models import Profile, Memory, MemoryMedia, DiaryImport, memory_media_upload_to, private_storage
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import PurePosixPath
+from threading import Thread, Lock, local
+from typing import Iterator
+from zipfile import ZipFile
+import datetime
+import json
+import tempfile
+import traceback
+
+STALE_IMPORT_DELAY = timezone.timedelta(minutes=10)  # A running import without progress for this long is considered dead
+MAX_LOGGED_ERRORS = 100
+DEFAULT_MOOD = 6  # 😐, used when an entry has no mood
+
+
+class InvalidEntry(Exception):
+    pass
+
+
+def archive_documents(names:list[str]) -> list[str]:
+    """
+    Get the entry documents of an archive in a stable order, which is used to resume imports
+    Entries are JSON documents, or Markdown documents when there's no JSON one in the same folder
+    """
+    names = [name for name in names if not name.endswith("/") and not name.startswith("__MACOSX/")
+             and "media" not in PurePosixPath(name).parent.parts]  # Attached files can't be entries
+    json_folders = {str(PurePosixPath(name).parent) for name in names if name.endswith(".json")}
+    return sorted(name for name in names
+                  if name.endswith(".json") or (name.endswith(".md") and str(PurePosixPath(name).parent) not in json_folders))
+
+
+def parse_entry(archive:ZipFile, name:str, names:list[str]) -> dict:
+    """
+    Reads and validates an entry document of the archive, with the paths of its media files
+    JSON documents use the export format, Markdown ones use their first heading as the title
+    """
+    folder = PurePosixPath(name).parent
+    try:
+        text = archive.read(name).decode("utf-8")
+    except UnicodeDecodeError:
+        raise InvalidEntry("not encoded in UTF-8")
+
+    if name.endswith(".json"):
+        try:
+            data = json.loads(text)
+        except json.JSONDecodeError as e:
+            raise InvalidEntry(f"invalid JSON ({e})")
+        if not isinstance(data, dict):
+            raise InvalidEntry("the JSON document is not an object")
+        medias = data.get("media")
+        markdown = bool(data.get("markdown"))
+    else:
+        lines = text.strip().split("\n")
+        title = lines[0].lstrip("#").strip() if lines and lines[0].startswith("#") else PurePosixPath(name).stem
+        data = {"title": title, "content": "\n".join(lines[1:] if lines and lines[0].startswith("#") else lines)}
+        medias = None
+        markdown = True
+
+    # Media files are either listed, or are all the files in the media folder next to the document
+    if medias is None:
+        prefix = f"{folder}/media/" if str(folder) != "." else "media/"
+        medias = [media_name for media_name in names if media_name.startswith(prefix) and not media_name.endswith("/")]
+    else:
+        if not isinstance(medias, list):
+            raise InvalidEntry("the media list is invalid")
+        medias = [str(folder / str(media)) if str(folder) != "." else str(media) for media in medias]
+
+    title = str(data.get("title") or "").strip()
+    content = str(data.get("content") or "").strip()
+    if not title or not content:
+        raise InvalidEntry("title and content cannot be empty")
+    if len(title) > 255:
+        raise InvalidEntry("title is longer than 255 characters")
+
+    try:
+        mood = int(data.get("mood") or DEFAULT_MOOD)
+        lock_time = int(data.get("lock_time") or 0)
+    except (TypeError, ValueError):
+        raise InvalidEntry("mood and lock time must be integers")
+    if not Memory.MOODS[0][0] <= mood <= Memory.MOODS[-1][0]:
+        raise InvalidEntry("invalid mood")
+    if lock_time < 0:
+        raise InvalidEntry("lock time cannot be negative")
+
+    # Default to the date of the document in the archive
+    try:
+        date = parse_datetime(str(data["date"])) if data.get("date") else datetime.datetime(*archive.getinfo(name).date_time)
+    except ValueError:  # Well formed but impossible, like a 13th month
+        date = None
+    if date is None:
+        raise InvalidEntry("invalid date")
+    if timezone.is_naive(date):
+        date = timezone.make_aware(date)
+
+    media_size = 0
+    for media in medias:
+        try:
+            media_size += archive.getinfo(media).file_size
+        except KeyError:
+            raise InvalidEntry(f"missing media file {media}")
+    if media_size > settings.MAX_SUBMIT_MEDIA_SIZE:
+        raise InvalidEntry("the media files are too large")
+
+    return {"title": title, "content": content, "mood": mood, "lock_time": lock_time, "date": date, "media": medias, "markdown": markdown,
+            "media_size": media_size}
+
+
+def archive_entries(archive:ZipFile, start:int=0) -> Iterator[tuple[str, dict|None, str|None]]:
+    """
+    Generates the entries of the archive one by one, skipping the already processed ones
+    Yields the document name, and either the entry or the reason why it's invalid
+    """
+    names = archive.namelist()
+    for name in archive_documents(names)[start:]:
+        try:
+            yield name, parse_entry(archive, name, names), None
+        except InvalidEntry as e:
+            yield name, None, str(e)
+
+
+@contextmanager
+def local_archive(name:str) -> Iterator[str]:
+    """
+    Get the local path of an archive from the private storage
+    An archive in a bucket is downloaded once to a temporary file, deleted afterwards
+    """
+    if isinstance(private_storage, FileSystemStorage):
+        yield private_storage.path(name)
+        return
+    with tempfile.NamedTemporaryFile(suffix=".zip") as local_file:
+        for chunk in private_storage.stream(name):  # Not buffered by the storage
+            local_file.write(chunk)
+        local_file.flush()
+        yield local_file.name
+
+
+class ArchiveReaders:
+    """
+    Opens the local archive once per thread, as reading a zip file moves its file position
+    """
+    def __init__(self, archive_path:str):
+        self.archive_path = archive_path
+        self.thread_data = local()
+        self.opened = []
+        self.lock = Lock()
+
+    def get(self) -> ZipFile:
+        if not hasattr(self.thread_data, "archive"):
+            self.thread_data.archive = ZipFile(self.archive_path)
+            with self.lock:
+                self.opened.append(self.thread_data.archive)
+        return self.thread_data.archive
+
+    def close(self):
+        for archive in self.opened:
+            archive.close()
+
+
+def copy_media(readers:ArchiveReaders, media_name:str, memory:Memory) -> str:
+    """
+    Copies a media file from the archive to the private storage, and returns its storage name
+    """
+    filename = PurePosixPath(media_name).name
+    with readers.get().open(media_name) as source:
+        return private_storage.save(memory_media_upload_to(MemoryMedia(memory=memory), filename), File(source, name=filename))
+
+
+def import_chunk(diary_import:DiaryImport, entries:list[dict], skipped:list[str], pool:ThreadPoolExecutor, readers:ArchiveReaders):
+    """
+    Inserts a chunk of entries with their media files, and saves the progress in the same transaction
+    """
+    profile:Profile = diary_import.owner.profile
+    now = timezone.now()
+    memories = []
+    for entry in entries:
+        resolved_lock_time = entry["lock_time"] if entry["lock_time"] > 0 else profile.lock_time
+        memories.append(Memory(owner=diary_import.owner, title=entry["title"], content=entry["content"], mood=entry["mood"],
+                               lock_time=entry["lock_time"], date=entry["date"], markdown=entry["markdown"],
+                               # Old memories which are already unlocked are not sent by email
+                               mail_sent=entry["date"] + timezone.timedelta(days=resolved_lock_time) <= now))
+        memories[-1].update_preview()  # bulk_create doesn't call save
+        memories[-1].update_anniversary()
+
+    with transaction.atomic():
+        Memory.objects.bulk_create(memories)
+        add_memories_to_stats(memories)  # bulk_create doesn't call save either
+
+        # Copy the media files in parallel, then reference them all at once
+        futures = [(memory, pool.submit(copy_media, readers, media, memory))
+                   for memory, entry in zip(memories, entries) for media in entry["media"]]
+        medias = MemoryMedia.objects.bulk_create([MemoryMedia(memory=memory, file=future.result()) for memory, future in futures])
+        optimize_images([media.pk for media in medias])  # Queued once the batch is committed
+
+        diary_import.processed_entries += len(entries) + len(skipped)
+        diary_import.imported_entries += len(entries)
+        if skipped and diary_import.errors.count("\n") < MAX_LOGGED_ERRORS:
+            diary_import.errors += "".join(f"{error}\n" for error in skipped)
+        diary_import.updated = timezone.now()
+        diary_import.save(update_fields=["processed_entries", "imported_entries", "errors", "updated"])
+
+    from .jobs import wake_unlock_scheduler  # Not at the top, the jobs module imports this one
+    wake_unlock_scheduler()  # bulk_create doesn't send post_save, the imported memories can unlock before the next check
+
+
+def run_import(diary_import:DiaryImport, progress:callable=None):
+    """
+    Imports the entries of an archive, continuing after the entries which were already processed
+    The import must have been claimed first, its status is set to done or failed at the end
+    """
+    check_profiles(diary_import.owner)
+    try:
+        with local_archive(diary_import.archive.name) as archive_path, ZipFile(archive_path) as archive:
+            if diary_import.total_entries == 0:
+                diary_import.total_entries = len(archive_documents(archive.namelist()))
+                diary_import.save(update_fields=["total_entries"])
+
+            readers = ArchiveReaders(archive_path)
+            media_budget = settings.MAX_GLOBAL_MEDIA_SIZE - private_media_usage()  # Left for the media files of the entries
+            try:
+                with ThreadPoolExecutor(max_workers=settings.IMPORT_MEDIA_WORKERS) as pool:
+                    entries, skipped = [], []
+                    for name, entry, error in archive_entries(archive, diary_import.processed_entries):
+                        if entry is None:
+                            skipped.append(f"{name}: {error}")
+                        elif entry["media_size"] > media_budget:
+                            skipped.append(f"{name}: the media storage is full")
+                        else:
+                            media_budget -= entry["media_size"]
+                            entries.append(entry)
+                        if len(entries) + len(skipped) >= settings.IMPORT_BATCH_SIZE:
+                            import_chunk(diary_import, entries, skipped, pool, readers)
+                            entries, skipped = [], []
+                            if progress is not None:
+                                progress(diary_import)
+                    import_chunk(diary_import, entries, skipped, pool, readers)
+                    if progress is not None:
+                        progress(diary_import)
+            finally:
+                readers.close()
+    except Exception as e:
+        # Keep the progress and the archive, so the import can be resumed
+        print(f"\n/!\\ Error in diary import {diary_import.pk}: {e}:\n{traceback.format_exc()}")
+        DiaryImport.objects.filter(pk=diary_import.pk).update(status=DiaryImport.FAILED, errors=F("errors") + f"{e}\n")
+        return
+
+    # Update the last memory date once, instead of for each memory
+    latest = Memory.objects.filter(owner=diary_import.owner).aggregate(latest=Max("date"))["latest"]
+    if latest is not None:
+        Profile.objects.filter(user=diary_import.owner, last_memory_date__lt=latest).update(last_memory_date=latest, sent_writing_reminder=False)
+
+    # The archive isn't needed anymore
+    private_storage.delete(diary_import.archive.name)
+    DiaryImport.objects.filter(pk=diary_import.pk).update(status=DiaryImport.DONE, archive="", updated=timezone.now())
+
+
+def retry_import(diary_import:DiaryImport) -> bool:
+    """
+    Puts a failed import back in the queue, it will continue after the last saved chunk
+    """
+    return bool(DiaryImport.objects.filter(pk=diary_import.pk, status=DiaryImport.FAILED).exclude(archive="")
+                .update(status=DiaryImport.PENDING, updated=timezone.now()))
+
+
+def claim_import(diary_import:DiaryImport) -> bool:
+    """
+    Marks an import as running, unless it's already being processed
+    Imports which stopped progressing while running can be claimed again
+    """
+    now = timezone.now()
+    claimed = (DiaryImport.objects.filter(pk=diary_import.pk, status__in=[DiaryImport.PENDING, DiaryImport.RUNNING])
+               .exclude(status=DiaryImport.RUNNING, updated__gt=now - STALE_IMPORT_DELAY)
+               .update(status=DiaryImport.RUNNING, updated=now))
+    if claimed:
+        diary_import.refresh_from_db()
+    return bool(claimed)
+
+
+def process_diary_imports():
+    """
+    Processes the pending imports, and resumes the ones which were interrupted
+    """
+    stale = timezone.now() - STALE_IMPORT_DELAY
+    for diary_import in DiaryImport.objects.filter(status__in=[DiaryImport.PENDING, DiaryImport.RUNNING]).select_related("owner__profile"):
+        if diary_import.status == DiaryImport.RUNNING and diary_import.updated > stale:
+            continue  # Still progressing somewhere else
+        if claim_import(diary_import):
+            run_import(diary_import)
+
+
+def start_import(diary_import:DiaryImport):
+    """
+    Processes an import in a daemon thread, the jobs will resume it if the server stops meanwhile
+    """
+    def import_thread():
+        if claim_import(diary_import):
+            run_import(diary_import)
+
+    thread = Thread(target=import_thread)
+    thread.daemon = True
+    thread.start()
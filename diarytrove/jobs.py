@@ -1,136 +1,295 @@
 from django.conf import settings
 from django.apps import apps
-from django.conf import settings
 from django.utils import translation, timezone
-from django.db.models import FileField, ImageField
-from django.utils.translation import gettext as _
+from django.db import close_old_connections
+from django.db.models import FileField, ImageField, Min, F, Value, ExpressionWrapper, DateTimeField, DurationField
+from django.core.files.storage import FileSystemStorage
+from django.core.cache import cache
+from django.utils.translation import gettext as _, ngettext
+from django.contrib.auth.models import User
 
-from .models import Profile, Memory
-from .utils import send_email, check_profiles, memory_preview_image
+from .models import Profile, Memory, ChunkedUpload, private_storage
+from .utils import send_email, check_profiles, memory_preview_image, attachment_cache
+from .imports import process_diary_imports
+from .newsletters import send_queued_newsletters, RateLimiter
+from .images import optimize_pending_images, email_image, cleanup_email_images
+from .uploads import delete_upload
+from .database import database_maintenance
 
-from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Event, Lock
 from pathlib import Path
+import datetime
+import logging
 import os
+import random
 import time
 import schedule
 import traceback
+import zoneinfo
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Not available on Windows, where only the development server is used
+
+logger = logging.getLogger("diarytrove.jobs")
+
+UNLOCK_MAX_SLEEP = 30 * 60  # Seconds, safety net if a wake up is missed
+UNLOCK_POLL_INTERVAL = 60  # Seconds between the checks for memories changed by the other processes
+UNLOCK_WAKEUP_KEY = "unlock_scheduler_wakeup"  # Changed in the shared cache by any process saving a memory or a profile
+unlock_wakeup = Event()  # Set by the process running the scheduler, without waiting for the next check
+
+GOLDEN_RATIO = 0.6180339887  # Multiples of it modulo 1 are evenly spread, whatever the number of users
+email_limiter = RateLimiter(settings.EMAIL_RATE)  # Shared by the reminder job and the unlock scheduler
 
+job_executor = None
+running_jobs = {}  # Job name -> start time of its current run, a job never runs twice at the same time
+stuck_jobs = set()  # Running jobs already reported as over their timeout
+running_jobs_lock = Lock()
+jobs_lock_file = None  # Kept open by the process running the schedulers
 
-def start_job_scheduler():
+
+def start_job_scheduler() -> bool:
     """
-    Start the job scheduler in a daemon thread when the django app starts
+    Start the job and unlock schedulers in daemon threads, from a server hook after the process is forked
+    Only one process of the server runs them, the others get False
     """
-    if os.environ.get("RUN_MAIN") != "true" and settings.DEBUG == True:
-        return  # Prevent starting the scheduler multiple times in development
+    global jobs_lock_file
+    if jobs_lock_file is not None:
+        return True  # Already started in this process
     
+    lock_file = open(settings.JOBS_LOCK_FILE, "a")
+    if fcntl is not None:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False  # Another worker runs them, a replacement worker takes over if it dies
+    jobs_lock_file = lock_file
+
     job_thread = Thread(target=jobs)
     job_thread.daemon = True  # Avoid blocking shutdown
     job_thread.start()
 
+    unlock_thread = Thread(target=unlock_scheduler)
+    unlock_thread.daemon = True
+    unlock_thread.start()
+    logger.info("schedulers started pid=%d", os.getpid())
+    return True
+
+
+def job_scheduler_running() -> bool:
+    """
+    Checks if a process of this server runs the background jobs, from the lock taken by start_job_scheduler
+    """
+    if jobs_lock_file is not None or fcntl is None:
+        return jobs_lock_file is not None
+    with open(settings.JOBS_LOCK_FILE, "a") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        return False
+
+
+def check_job_scheduler():
+    """
+    Warns when the app is loaded by a server which doesn't start the background jobs and no other process runs them
+    Gunicorn starts them with the hooks of gunicorn.conf.py, the development server in the app config
+    """
+    if not job_scheduler_running():
+        logger.warning("background jobs are not running pid=%d, start them with python manage.py run_jobs", os.getpid())
+
 
 def jobs():
     """
-    Background job scheduler that runs scheduled tasks in threads
+    Background job scheduler that dispatches scheduled tasks to a thread pool
+    Memory emails have their own thread, see unlock_scheduler
     """
-    schedule.every(6).hours.do(cleanup_private_media)
-    schedule.every(6).hours.do(send_writing_reminder_emails)
-    schedule.every(30).minutes.do(send_memory_emails)
+    global job_executor
+    job_executor = ThreadPoolExecutor(max_workers=settings.JOB_WORKERS, thread_name_prefix="job")
+
+    jittered(schedule.every(1).days.do(run_job, cleanup_private_media))  # Safety net, deleted objects remove their files themselves
+    jittered(schedule.every(6).hours.do(run_job, cleanup_chunked_uploads))
+    jittered(schedule.every(6).hours.do(run_job, cleanup_email_images))
+    jittered(schedule.every(1).hours.do(run_job, log_cache_stats))
+    jittered(schedule.every(5).minutes.do(run_job, send_writing_reminder_emails))  # Sends the reminders whose slot passed
+    jittered(schedule.every(5).minutes.do(run_job, process_diary_imports))  # Resumes interrupted imports
+    jittered(schedule.every(5).minutes.do(run_job, send_queued_newsletters))  # Resumes interrupted newsletters
+    jittered(schedule.every(1).hours.do(run_job, optimize_pending_images))  # Images missed by the upload thread pool
+    schedule.every().day.at("04:00").do(run_job, database_maintenance)  # At night, the first run can vacuum the whole database
 
     while True:
         try:
             schedule.run_pending()
+            report_stuck_jobs()
         except Exception as e:
             print(f"\n/!\\ Error in job scheduler: {e}:\n{traceback.format_exc()}")
         finally:
             time.sleep(1)
 
 
-def cleanup_private_media():
+def jittered(job:schedule.Job) -> schedule.Job:
     """
-    Deletes unreferences private media files
+    Delays the first run of a job by a random duration, so the jobs don't all start at the same time
     """
-    grace_seconds = 86400  # One day
+    job.next_run += datetime.timedelta(seconds=random.uniform(0, settings.JOB_JITTER))
+    return job
+
+
+def run_job(job_func:callable):
+    """
+    Dispatches a run of a job to the thread pool, unless its previous run is still going
+    """
+    name = job_func.__name__
+    with running_jobs_lock:
+        if name in running_jobs:
+            logger.warning("job=%s outcome=skipped reason=still_running running_for=%.0fs", name, time.monotonic() - running_jobs[name])
+            return
+        running_jobs[name] = time.monotonic()
+    job_executor.submit(timed_job, job_func)
+
 
+def timed_job(job_func:callable):
+    """
+    Runs a job in the thread pool and logs its duration and outcome
+    """
+    name = job_func.__name__
+    start = time.monotonic()
+    outcome = "success"
+    try:
+        job_func()
+    except Exception as e:
+        outcome = "error"
+        logger.error("job=%s outcome=error error=%r\n%s", name, e, traceback.format_exc())
+    finally:
+        close_old_connections()  # Pool threads are reused, don't keep broken or expired connections
+        with running_jobs_lock:
+            running_jobs.pop(name, None)
+            stuck_jobs.discard(name)
+    logger.info("job=%s outcome=%s duration=%.2fs", name, outcome, time.monotonic() - start)
+
+
+def log_cache_stats():
+    """
+    Logs the usage of the in memory caches of this process
+    """
+    logger.info("cache=email_attachments %s", " ".join(f"{key}={value}" for key, value in attachment_cache.stats().items()))
+
+
+def report_stuck_jobs():
+    """
+    Logs the jobs running for longer than their timeout once, they keep their slot until they end
+    Threads can't be stopped from the outside, so the timeout only reports them
+    """
+    now = time.monotonic()
+    with running_jobs_lock:
+        for name, start in running_jobs.items():
+            timeout = settings.JOB_TIMEOUTS.get(name, settings.JOB_TIMEOUT)
+            if now - start > timeout and name not in stuck_jobs:
+                stuck_jobs.add(name)
+                logger.warning("job=%s outcome=timeout running_for=%.0fs timeout=%ss", name, now - start, timeout)
+
+
+def wake_unlock_scheduler(sender=None, **kwargs):
+    """
+    Makes the unlock scheduler look for the next memory to unlock again, when memories or lock times change
+    Connected in every process, the scheduler of another process notices the change within UNLOCK_POLL_INTERVAL
+    """
+    if kwargs.get("update_fields") is not None and set(kwargs["update_fields"]) == {"mail_sent"}:
+        return  # Saved by the unlock scheduler itself
+    unlock_wakeup.set()
+    try:
+        cache.set(UNLOCK_WAKEUP_KEY, time.time_ns(), None)
+    except Exception as e:
+        logger.warning("unlock scheduler wake up not shared error=%r", e)  # Still found after UNLOCK_MAX_SLEEP
+
+
+def unlock_wakeup_mark() -> int|None:
+    """
+    Get the last wake up of the unlock scheduler shared by the processes
+    """
     try:
-        private_root = Path(settings.PRIVATE_MEDIA_ROOT)
+        return cache.get(UNLOCK_WAKEUP_KEY)
     except Exception:
-       print("PRIVATE_MEDIA_ROOT not configured, skipping cleanup.")
-       return
+        return None
 
-    if not private_root.exists():
-        print(f"Private media root {private_root} does not exist, skipping cleanup.")
-        return
 
-    # Get each referenced media
-    referenced = []
-    representative_storage = None
+def wait_for_unlock_wakeup(timeout:float, mark:int|None):
+    """
+    Sleeps for the timeout, or until a process wakes the unlock scheduler
+    """
+    deadline = time.monotonic() + timeout
+    while (remaining := deadline - time.monotonic()) > 0:
+        if unlock_wakeup.wait(timeout=min(remaining, UNLOCK_POLL_INTERVAL)):
+            return  # Woken up by this process
+        if unlock_wakeup_mark() != mark:
+            return  # Woken up by another process
 
-    for model in apps.get_models():
-        for field in model._meta.get_fields():
-            if isinstance(field, (FileField, ImageField)):
-                # Ensure we will use the correct storage implementation later
-                if representative_storage is None:
-                    representative_storage = getattr(field, "storage", None)
-
-                # Collect referenced names from database efficiently
-                qs = model.objects.exclude(**{f"{field.name}__isnull": True}).exclude(**{f"{field.name}": ""}).values_list(field.name, flat=True)
-                for name in qs:
-                    if not name:
-                        continue
-                    # Normalize to forward slashes for comparison with Path.as_posix()
-                    referenced.append(str(name).lstrip("/"))
-
-    # If we didn't discover a storage object, try to create a filesystem storage pointing to the root
-    if representative_storage is None:
-        try:
-            from django.core.files.storage import FileSystemStorage
-            representative_storage = FileSystemStorage(location=str(private_root))
-        except Exception:
-            representative_storage = None
 
-    # Iterate files on disk and delete orphans older than a day
-    now = time.time()
-    for p in private_root.rglob("*"):
-        if not p.is_file():
-            continue
-        try:
-            rel = p.relative_to(private_root).as_posix()
-        except Exception:
-            # Can't relativize, skip for safety
-            continue
+def next_unlock_date() -> timezone.datetime|None:
+    """
+    Get the date when the next unsent memory unlocks, computed by the database
+    """
+    return Memory.objects.filter(mail_sent=False).with_unlock_date().aggregate(next_unlock=Min("unlock_date"))["next_unlock"]
 
-        if rel in referenced:
-            continue  # Still referenced in database
 
-        # Check age to avoid deleting files that may be in-progress
+def unlock_scheduler():
+    """
+    Sends the unlocked memories, then sleeps until the next memory unlocks or until woken up
+    """
+    while True:
+        unlock_wakeup.clear()
+        mark = unlock_wakeup_mark()  # Before the queries, so the changes made meanwhile aren't missed
+        next_unlock = None
         try:
-            mtime = p.stat().st_mtime
-        except Exception:
-            # If we cannot read stat, skip
-            print(f"Could not stat file {p}, skipping.")
-            continue
+            send_memory_emails()
+            next_unlock = next_unlock_date()
+        except Exception as e:
+            print(f"\n/!\\ Error in unlock scheduler: {e}:\n{traceback.format_exc()}")
+        finally:
+            close_old_connections()  # The thread lives forever, don't keep an expired or broken connection
+        
+        delay = UNLOCK_MAX_SLEEP if next_unlock is None else (next_unlock - timezone.now()).total_seconds()
+        wait_for_unlock_wakeup(min(max(delay, 1), UNLOCK_MAX_SLEEP), mark)
 
-        age = now - mtime
-        if age < grace_seconds:
-            continue  # Keep files which are too recent
 
-        # Attempt deletion via storage API if available, else unlink
+def cleanup_private_media():
+    """
+    Deletes unreferences private media files
+    Files of deleted objects are already removed by the purge module, this catches the ones left by crashes
+    The storage is listed page by page, so it works the same on the disk and in a bucket
+    """
+    grace_seconds = 86400  # One day
+
+    # Get each referenced media
+    referenced = set()
+    for model in apps.get_models():
+        for field in model._meta.get_fields():
+            if isinstance(field, (FileField, ImageField)) and field.storage is private_storage:
+                names = model.objects.exclude(**{f"{field.name}__isnull": True}).exclude(**{field.name: ""}).values_list(field.name, flat=True)
+                referenced.update(str(name).lstrip("/") for name in names.iterator())
+
+    # Delete the orphans older than a day, newer ones may still be in progress
+    expiration = time.time() - grace_seconds
+    deleted = 0
+    for name, _, modified in private_storage.iter_files():
+        if name in referenced or modified > expiration:
+            continue
         try:
-            if representative_storage is not None:
-                if representative_storage.exists(rel):
-                    representative_storage.delete(rel)
-                else:
-                    # Fallback to unlink if file exists
-                    if p.exists():
-                        p.unlink()
-            else:
-                # No storage object, use unlink
-                p.unlink()
+            private_storage.delete(name)
+            deleted += 1
         except Exception:
-            print(f"Failed to delete orphaned private media {p}")
-    
-    # Delete empty subfolders
-    top_folders = ["memory_media"]  # Folders relative to the private media root
+            print(f"Failed to delete orphaned private media {name}")
+    if deleted:
+        logger.info("job=cleanup_private_media deleted=%d", deleted)
+
+    # Delete empty subfolders, buckets have no folders
+    if not isinstance(private_storage, FileSystemStorage):
+        return
+    private_root = Path(private_storage.location)
+    top_folders = ["memory_media", "imports", "uploads"]  # Folders relative to the private media root
     for folder in top_folders:
         folder_path = private_root / folder
         if not folder_path.exists():
@@ -144,50 +303,134 @@ def cleanup_private_media():
                     print(f"Failed to remove empty subfolder {subfolder}")
 
 
+def cleanup_chunked_uploads():
+    """
+    Deletes the uploads which were never attached to a memory
+    """
+    expiration = timezone.now() - timezone.timedelta(seconds=settings.UPLOAD_EXPIRATION)
+    for upload in ChunkedUpload.objects.filter(created__lt=expiration):
+        delete_upload(upload)
+
+
 def send_memory_emails():
     """
     Check for newly unlocked memories and send emails accordingly
     """
-    # Get memories which can eventually be sent by email
-    unsent_memories = Memory.objects.filter(mail_sent=False)
-    memories:list[Memory] = [memory for memory in unsent_memories if memory.is_unlocked()]
+    # Only get the memories which are due, the database resolves the unlock dates
+    memories = Memory.objects.filter(mail_sent=False).unlocked().select_related("owner__profile").order_by("unlock_date")
 
+    # Group the memories by user, so digests contain all the memories unlocked at the same time
+    memories_by_owner:dict[int, list[Memory]] = {}
     for memory in memories:
-        # Check if the memory should be sent
-        check_profiles(memory.owner)
-        profile:Profile = memory.owner.profile
-        if profile.mail_memory == 1 or (profile.mail_memory == 2 and memory.mood in memory.POSITIVE_MOODS):
-            context = {"memory": memory, "content": memory.content.strip().split("\n"),
-                       "mood_emoji": memory.MOODS[memory.mood-1][1],
-                       "delay": (timezone.now() - memory.date).days}
-            # Get image data if there's one
-            image = memory_preview_image(memory)
-            attachments = []
-            if image is not None:
-                image_abs_path = settings.PRIVATE_MEDIA_ROOT / Path(image.file.name)
-                image_name = image_abs_path.name
-                context["image_name"] = image_name
-                attachments.append(image_abs_path)
-
-            # Send the memory by email
-            with translation.override(memory.owner.profile.language):
-                send_email(memory.owner, "unlocked_memory", _("One of your memories was just unlocked!"), context, attachments=attachments)
-        memory.mail_sent = True
-        memory.save()
+        memories_by_owner.setdefault(memory.owner_id, []).append(memory)
+
+    for owner_memories in memories_by_owner.values():
+        owner = owner_memories[0].owner
+        if not hasattr(owner, "profile"):
+            check_profiles(owner)
+            owner.refresh_from_db()
+        profile:Profile = owner.profile
+
+        # Check which memories should be sent
+        sent_memories = [memory for memory in owner_memories
+                         if profile.mail_memory in Profile.EMAIL_ALL_MEMORIES
+                         or (profile.mail_memory in Profile.EMAIL_POSITIVE_MEMORIES and memory.mood in memory.POSITIVE_MOODS)]
+        if profile.mail_memory in Profile.EMAIL_DIGEST and len(sent_memories) > 1:
+            email_limiter.wait()
+            send_memory_digest(owner, sent_memories)
+        else:
+            for memory in sent_memories:
+                email_limiter.wait()  # Many memories can unlock at once, like after an import
+                send_memory_email(memory)
+        
+        # Set to True even for the memories not sent because of preferences
+        Memory.objects.filter(pk__in=[memory.pk for memory in owner_memories]).update(mail_sent=True)
+
+
+def send_memory_email(memory:Memory):
+    """
+    Sends an unlocked memory by email, with its first image
+    """
+    context = {"memory": memory, "content": memory.content.strip().split("\n"),
+               "mood_emoji": memory.MOODS[memory.mood-1][1],
+               "delay": (timezone.now() - memory.date).days}
+    # Attach an email sized version of the image if there's one
+    image = memory_preview_image(memory)
+    image_path = email_image(image, settings.EMAIL_IMAGE_SIZE) if image is not None else None
+    attachments = []
+    if image_path is not None:
+        context["image_name"] = image_path.name
+        attachments.append(image_path)
+
+    # Send the memory by email
+    with translation.override(memory.owner.profile.language):
+        send_email(memory.owner, "unlocked_memory", _("One of your memories was just unlocked!"), context, attachments=attachments)
+
+
+def send_memory_digest(owner:User, memories:list[Memory]):
+    """
+    Sends several unlocked memories in one email, with their excerpts and image thumbnails
+    Only the first memories are shown inline, the other ones are counted
+    """
+    inline_memories = []
+    attachments = []
+    for memory in memories[:settings.MEMORY_DIGEST_MAX_INLINE]:
+        entry = {"memory": memory, "mood_emoji": memory.MOODS[memory.mood-1][1], "delay": (timezone.now() - memory.date).days}
+        image = memory_preview_image(memory)
+        image_path = email_image(image, settings.EMAIL_THUMBNAIL_SIZE) if image is not None else None
+        if image_path is not None:
+            entry["image_name"] = image_path.name
+            attachments.append(image_path)
+        inline_memories.append(entry)
+
+    context = {"memories": inline_memories, "count": len(memories), "more": len(memories) - len(inline_memories)}
+    with translation.override(owner.profile.language):
+        subject = ngettext("%(count)s of your memories was just unlocked!", "%(count)s of your memories were just unlocked!",
+                           len(memories)) % {"count": len(memories)}
+        send_email(owner, "unlocked_digest", subject, context, attachments=attachments)
+
+
+def reminder_slot(profile:Profile, now:datetime.datetime) -> datetime.datetime:
+    """
+    Get the last time before now when reminders can be sent to the user, at the hour they chose in their time zone
+    Each user gets a fixed offset in the sending window, so the users choosing the same hour are spread evenly
+    """
+    try:
+        zone = zoneinfo.ZoneInfo(profile.time_zone)
+    except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+        zone = zoneinfo.ZoneInfo(settings.TIME_ZONE)
+    offset = datetime.timedelta(seconds=(profile.user_id * GOLDEN_RATIO) % 1 * settings.EMAIL_REMINDER_WINDOW)
+    local_now = now.astimezone(zone)
+    slot = datetime.datetime.combine(local_now.date(), datetime.time(profile.mail_hour), tzinfo=zone) + offset
+    if slot > local_now:  # Not yet today
+        slot = datetime.datetime.combine(local_now.date() - datetime.timedelta(days=1), datetime.time(profile.mail_hour), tzinfo=zone) + offset
+    return slot
 
 
 def send_writing_reminder_emails():
     """
     Send emails to remind users to write new memories if they haven't written any recently
+    A due reminder waits for the slot of the user, see reminder_slot, then they are sent in order at a limited rate
+    Slots missed for longer than the window, like when the server was down, wait for the next day
     """
-    profiles = Profile.objects.filter(mail_reminder__gt=0)  # Only profiles with reminders enabled
-    for profile in profiles:
-        if not profile.sent_writing_reminder:  # Only send if not already sent
-            days_since_last = (timezone.now() - profile.last_memory_date).days
-            if days_since_last >= profile.mail_reminder:
-                # Send reminder email
-                context = {"days": days_since_last}
-                with translation.override(profile.language):
-                    send_email(profile.user, "writing_reminder", _("Come write a new memory!"), context)
-                profile.sent_writing_reminder = True
-                profile.save()
+    now = timezone.now()
+    reminder_delay = ExpressionWrapper(F("mail_reminder") * Value(timezone.timedelta(days=1)), output_field=DurationField())
+    due_date = ExpressionWrapper(F("last_memory_date") + reminder_delay, output_field=DateTimeField())
+    profiles = (Profile.objects.filter(mail_reminder__gt=0, sent_writing_reminder=False)  # Only profiles with reminders enabled and not sent yet
+                .annotate(due_date=due_date).filter(due_date__lte=now).select_related("user"))
+    window = datetime.timedelta(seconds=settings.EMAIL_REMINDER_WINDOW)
+    due_profiles = [(slot, profile) for profile in profiles
+                    if profile.due_date <= (slot := reminder_slot(profile, now)) and now - slot <= window]
+    due_profiles.sort(key=lambda due: due[0])
+
+    for _slot, profile in due_profiles:
+        email_limiter.wait()
+        days_since_last = (timezone.now() - profile.last_memory_date).days
+        # Send reminder email
+        context = {"days": days_since_last}
+        with translation.override(profile.language):
+            send_email(profile.user, "writing_reminder", _("Come write a new memory!"), context)
+        # Not saved if a memory was written meanwhile, and without waking the unlock scheduler
+        Profile.objects.filter(pk=profile.pk, last_memory_date=profile.last_memory_date).update(sent_writing_reminder=True)
+    if due_profiles:
+        logger.info("job=send_writing_reminder_emails sent=%d", len(due_profiles))
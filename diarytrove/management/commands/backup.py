@@ -0,0 +1,26 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from diarytrove.backups import BackupError, create_backup, verify_backup
+
+from pathlib import Path
+
+
+class Command(BaseCommand):
+    help = "Back up the database and the private media files which changed since the last backup, while the website runs"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--output", default=settings.BACKUP_ROOT, help="Folder holding the backups")
+        parser.add_argument("--full", action="store_true", help="Copy every media file, the older backups can then be deleted")
+        parser.add_argument("--verify", action="store_true", help="Read the new backup back and check its hashes")
+
+    def handle(self, *args, **options):
+        backup_root = Path(options["output"])
+        try:
+            name, manifest, throughput = create_backup(backup_root, full=options["full"])
+            self.stdout.write(f"Backed up the database and {throughput.files - 1} of {len(manifest['media'])} media files: {throughput.report()}")
+            if options["verify"]:
+                self.stdout.write(f"Verified: {verify_backup(backup_root, name).report()}")
+        except BackupError as e:
+            raise CommandError(str(e))
+        self.stdout.write(self.style.SUCCESS(f"Created backup {name} in {backup_root}"))
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+
+from diarytrove.export import diary_zip_stream
+
+import time
+
+
+class Command(BaseCommand):
+    help = "Export the diary of a user as a zip archive, with the memories and their media files"
+
+    def add_arguments(self, parser):
+        parser.add_argument("username", help="Username of the diary owner")
+        parser.add_argument("output", help="Path of the zip archive to write")
+        parser.add_argument("--include-locked", action="store_true", help="Also export the memories which are still locked")
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options["username"])
+        except User.DoesNotExist:
+            raise CommandError(f"User {options['username']} does not exist")
+
+        start = time.monotonic()
+        written = 0
+        with open(options["output"], "wb") as output:
+            for chunk in diary_zip_stream(user, include_locked=options["include_locked"]):
+                output.write(chunk)
+                written += len(chunk)
+
+        duration = time.monotonic() - start
+        self.stdout.write(self.style.SUCCESS(f"Exported {round(written / 2**20, 3)} MiB to {options['output']} in {duration:.1f}s"))
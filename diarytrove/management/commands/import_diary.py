@@ -0,0 +1,59 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+from django.core.files import File
+
+from diarytrove.models import DiaryImport
+from diarytrove.imports import claim_import, retry_import, run_import
+
+from pathlib import Path
+import time
+
+
+class Command(BaseCommand):
+    help = "Import a diary zip archive for a user, or resume an interrupted import"
+
+    def add_arguments(self, parser):
+        parser.add_argument("username", nargs="?", help="Username of the diary owner")
+        parser.add_argument("archive", nargs="?", help="Path of the zip archive to import")
+        parser.add_argument("--resume", type=int, metavar="IMPORT_ID", help="Resume an interrupted or failed import instead")
+
+    def handle(self, *args, **options):
+        if options["resume"] is not None:
+            try:
+                diary_import = DiaryImport.objects.get(pk=options["resume"])
+            except DiaryImport.DoesNotExist:
+                raise CommandError(f"Import {options['resume']} does not exist")
+            retry_import(diary_import)
+        else:
+            if not options["username"] or not options["archive"]:
+                raise CommandError("Give a username and an archive, or an import to resume")
+            try:
+                user = User.objects.get(username=options["username"])
+            except User.DoesNotExist:
+                raise CommandError(f"User {options['username']} does not exist")
+
+            # Copy the archive to the private storage, so the import can be resumed like uploaded ones
+            archive_path = Path(options["archive"])
+            with open(archive_path, "rb") as archive:
+                diary_import = DiaryImport(owner=user)
+                diary_import.archive.save(archive_path.name, File(archive), save=False)
+            diary_import.save()
+            self.stdout.write(f"Created import {diary_import.pk}")
+
+        if not claim_import(diary_import):
+            raise CommandError(f"Import {diary_import.pk} is already running or finished")
+
+        start, already_processed = time.monotonic(), diary_import.processed_entries
+        def progress(current:DiaryImport):
+            rate = (current.processed_entries - already_processed) / max(time.monotonic() - start, 0.001)
+            self.stdout.write(f"{current.processed_entries}/{current.total_entries} entries processed, "
+                              f"{current.imported_entries} imported ({rate:.0f} entries/s)")
+        run_import(diary_import, progress)
+
+        diary_import.refresh_from_db()
+        if diary_import.errors:
+            self.stdout.write(self.style.WARNING(diary_import.errors))
+        if diary_import.status == DiaryImport.DONE:
+            self.stdout.write(self.style.SUCCESS(f"Imported {diary_import.imported_entries} memories"))
+        else:
+            raise CommandError(f"Import failed, resume it with --resume {diary_import.pk}")
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+
+from diarytrove.stats import rebuild_stats
+
+
+class Command(BaseCommand):
+    help = "Rebuild the daily mood statistics from the memories, for one user or everyone"
+
+    def add_arguments(self, parser):
+        parser.add_argument("username", nargs="?", help="Only rebuild the statistics of this user")
+
+    def handle(self, *args, **options):
+        user = None
+        if options["username"]:
+            try:
+                user = User.objects.get(username=options["username"])
+            except User.DoesNotExist:
+                raise CommandError(f"User {options['username']} does not exist")
+
+        created = rebuild_stats(user)
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {created} daily statistics"))
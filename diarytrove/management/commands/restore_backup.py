@@ -0,0 +1,37 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from diarytrove.backups import BackupError, backup_names, verify_backup, restore_backup
+
+from pathlib import Path
+
+
+class Command(BaseCommand):
+    help = "Check a backup, or restore its database and private media files (stop the website before restoring its database)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("backup", nargs="?", help="Name of the backup, the latest one by default")
+        parser.add_argument("--input", default=settings.BACKUP_ROOT, help="Folder holding the backups")
+        parser.add_argument("--verify", action="store_true", help="Only check that the backup is complete and not corrupted")
+        parser.add_argument("--media-root", help="Folder to restore the media files in, the configured storage by default")
+        parser.add_argument("--database-output", help="File to restore a SQLite database in, the configured database by default")
+
+    def handle(self, *args, **options):
+        backup_root = Path(options["input"])
+        name = options["backup"]
+        if name is None:
+            names = backup_names(backup_root)
+            if not names:
+                raise CommandError(f"There is no backup in {backup_root}")
+            name = names[-1]
+
+        media_root = Path(options["media_root"]) if options["media_root"] else None
+        try:
+            if options["verify"]:
+                throughput = verify_backup(backup_root, name)
+            else:
+                throughput = restore_backup(backup_root, name, media_root, options["database_output"])
+        except BackupError as e:
+            raise CommandError(str(e))
+        action = "Verified" if options["verify"] else "Restored"
+        self.stdout.write(self.style.SUCCESS(f"{action} backup {name}: {throughput.report()}"))
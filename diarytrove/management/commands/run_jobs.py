@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from diarytrove.jobs import start_job_scheduler
+
+import time
+
+
+class Command(BaseCommand):
+    help = "Run the background jobs, for the servers which don't start them like gunicorn does"
+
+    def handle(self, *args, **options):
+        if not start_job_scheduler():
+            self.stdout.write("Another process runs the background jobs, waiting to take over")
+            self.stdout.flush()  # Shown right away in the service logs
+            while not start_job_scheduler():
+                time.sleep(60)
+        self.stdout.write(self.style.SUCCESS("Background jobs started"))
+        self.stdout.flush()
+
+        while True:
+            time.sleep(60 * 60)  # The jobs run in daemon threads, until the command is stopped
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from diarytrove.models import Newsletter
+from diarytrove.newsletters import queue_newsletter, claim_newsletter, run_newsletter
+
+import time
+
+
+class Command(BaseCommand):
+    help = "Send a newsletter to the users who accepted them, or resume an interrupted sending"
+
+    def add_arguments(self, parser):
+        parser.add_argument("newsletter_id", type=int, help="Primary key of the newsletter to send")
+
+    def handle(self, *args, **options):
+        try:
+            newsletter = Newsletter.objects.get(pk=options["newsletter_id"])
+        except Newsletter.DoesNotExist:
+            raise CommandError(f"Newsletter {options['newsletter_id']} does not exist")
+
+        queue_newsletter(newsletter)  # Drafts and failed newsletters, queued ones are claimed directly
+        if not claim_newsletter(newsletter):
+            raise CommandError(f"Newsletter {newsletter.pk} is already sent or being sent")
+
+        start = time.monotonic()
+        def progress(newsletter:Newsletter):
+            rate = newsletter.sent_count / max(time.monotonic() - start, 0.001)
+            self.stdout.write(f"{newsletter.sent_count} sent, {newsletter.failed_count} failed ({rate:.0f} emails/s)")
+
+        run_newsletter(newsletter, progress)
+        newsletter.refresh_from_db()
+        if newsletter.status != Newsletter.SENT:
+            raise CommandError(f"Newsletter {newsletter.pk} failed, run the command again to resume it")
+        self.stdout.write(self.style.SUCCESS(f"Sent newsletter {newsletter.pk} to {newsletter.sent_count} users"))
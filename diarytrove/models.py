@@ -1,13 +1,25 @@
-from django.db import models
+from django.conf import settings
+from django.db import models, transaction, IntegrityError
+from django.db.models import F, Case, When, Value, ExpressionWrapper, DateTimeField, DurationField
+from django.db.models.functions import Coalesce
 from django.utils.translation import gettext_lazy as _
 from django.contrib.auth.models import User
 from django.contrib import admin
 from django.utils import timezone
 
-from .storage import PrivateMediaStorage
+from .storage import private_media_storage
 
-# Creating the private media storage object
-private_storage = PrivateMediaStorage()
+import calendar
+import datetime
+import uuid
+import zoneinfo
+
+# Creating the private media storage object, on the disk or in a bucket
+private_storage = private_media_storage()
+
+
+def get_private_storage():
+    return private_storage  # Callable, so migrations don't depend on the configured storage
 
 
 class Profile(models.Model):
@@ -18,8 +30,13 @@ class Profile(models.Model):
         verbose_name = _("profile")
         verbose_name_plural = _("profiles")
     
-    EMAIL_MEMORIES = [(1, _("Always send")), (2, _("Only positive memories")), (3, _("Never send"))]
+    EMAIL_MEMORIES = [(1, _("Always send")), (2, _("Only positive memories")), (3, _("Never send")),
+                      (4, _("Always send, grouped in one email")), (5, _("Only positive memories, grouped in one email"))]
+    EMAIL_ALL_MEMORIES = (1, 4)
+    EMAIL_POSITIVE_MEMORIES = (2, 5)
+    EMAIL_DIGEST = (4, 5)  # The memories unlocked at the same time are sent in one email
     AVAILABLE_LANGUAGES = [("en", "English"), ("fr", "Français")]
+    TIME_ZONES = [(name, name.replace("_", " ")) for name in sorted(zoneinfo.available_timezones())]
 
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     editable_lock_time = models.BooleanField(_("Can the lock time be edited"), default=True)
@@ -27,14 +44,56 @@ class Profile(models.Model):
     mail_reminder = models.IntegerField(_("Email writing reminder delay in days"), default=7)
     last_memory_date = models.DateTimeField(_("Date of the last memory"), default=timezone.now)  # For reminder emails
     sent_writing_reminder = models.BooleanField(_("Was a writing reminder sent"), default=False)
+    time_zone = models.CharField(_("Time zone"), default=settings.TIME_ZONE)  # For the hour of reminder emails
+    mail_hour = models.IntegerField(_("Hour to receive writing reminders"), default=18)
     mail_memory = models.IntegerField(_("When to send memories by email"), choices=EMAIL_MEMORIES, default=1)
     language = models.CharField(_("Email language"), default="en")
+    keep_original_images = models.BooleanField(_("Keep the original uploaded images"), default=False)
     mail_newsletter = models.BooleanField(_("Receive email newsletters"), default=True)
 
     def __str__(self):
         return str(_("%(user)s's profile") % {"user": self.user})
 
 
+class MemoryQuerySet(models.QuerySet):
+    """
+    Adds database side helpers to resolve the lock state of memories
+    """
+    def with_unlock_date(self) -> "MemoryQuerySet":
+        """
+        Annotates each memory with its unlock date, resolving the user preference when the lock time is 0
+        Owners without a profile get the default lock time, like the profile created for them when the memory is sent
+        """
+        default_lock_time = Coalesce(F("owner__profile__lock_time"), Value(Profile._meta.get_field("lock_time").default))
+        resolved_lock_time = Case(When(lock_time__gt=0, then=F("lock_time")), default=default_lock_time)
+        lock_duration = ExpressionWrapper(resolved_lock_time * Value(timezone.timedelta(days=1)), output_field=DurationField())
+        return self.annotate(unlock_date=ExpressionWrapper(F("date") + lock_duration, output_field=DateTimeField()))
+
+    def unlocked(self) -> "MemoryQuerySet":
+        """
+        Only keeps the memories which are already unlocked
+        """
+        return self.with_unlock_date().filter(unlock_date__lte=timezone.now())
+
+    def locked(self) -> "MemoryQuerySet":
+        """
+        Only keeps the memories which are still locked
+        """
+        return self.with_unlock_date().filter(unlock_date__gt=timezone.now())
+
+    def on_this_day(self, day:datetime.date=None) -> "MemoryQuerySet":
+        """
+        Only keeps the memories written on the same month and day in the previous years
+        Memories of february 29 are also shown on february 28 of the other years
+        """
+        day = day or timezone.localdate()
+        keys = [Memory.anniversary_key(day)]
+        if (day.month, day.day) == (2, 28) and not calendar.isleap(day.year):
+            keys.append(229)
+        year_start = timezone.make_aware(datetime.datetime(day.year, 1, 1))
+        return self.filter(anniversary__in=keys, date__lt=year_start)
+
+
 class Memory(models.Model):
     """
     Represents a memory entry and its attributes
@@ -42,9 +101,17 @@ class Memory(models.Model):
     class Meta:
         verbose_name = _("memory")
         verbose_name_plural = _("memories")
+        indexes = [
+            models.Index(fields=["owner", "date"], name="diarytrove_memory_owner_date"),
+            models.Index(fields=["owner", "mood", "date"], name="diarytrove_memory_owner_mood"),
+            models.Index(fields=["owner", "anniversary"], name="diarytrove_memory_anniversary"),
+        ]
     
     MOODS = [(1, "😀"), (2, "🙂"), (3, "😊"), (4, "🤩"), (5, "😜"), (6, "😐"), (7, "😒"), (8, "😮‍💨"), (9, "😔"), (10, "🤕"), (11, "🙁"), (12, "😢")]
     POSITIVE_MOODS = (1, 2, 3, 4, 5)
+    PREVIEW_TITLE_CHARS = 120
+    EXCERPT_CHARS = 1000
+    RENDERED_FIELDS = {"title", "content", "mood", "date", "markdown"}
 
     owner = models.ForeignKey(User, on_delete=models.CASCADE, verbose_name=_("Owner of the memory"))
     date = models.DateTimeField(_("Date of creation"), default=timezone.now)
@@ -53,6 +120,13 @@ class Memory(models.Model):
     content = models.TextField(_("Content of the memory"))
     mood = models.IntegerField(_("Mood for the memory"), choices=MOODS)
     mail_sent = models.BooleanField(_("Was it already sent"), default=False)  # Set to True even if it wasn't really sent because of preferences
+    preview_title = models.CharField(_("Title shown in previews"), max_length=PREVIEW_TITLE_CHARS+3, blank=True, editable=False)
+    excerpt = models.CharField(_("Content excerpt shown in previews"), max_length=EXCERPT_CHARS+3, blank=True, editable=False)
+    anniversary = models.PositiveSmallIntegerField(_("Month and day of the date"), default=0, editable=False)  # Month * 100 + day, in the server timezone
+    markdown = models.BooleanField(_("Content formatted with Markdown"), default=False)
+    version = models.PositiveIntegerField(_("Version of the rendered memory"), default=1, editable=False)  # Bumped by edits, keys the render cache
+
+    objects = MemoryQuerySet.as_manager()
 
     @admin.display(description=_("Unlocked"), boolean=True)
     def is_unlocked(self) -> bool:
@@ -62,6 +136,56 @@ class Memory(models.Model):
         resolved_lock_time = self.lock_time if self.lock_time > 0 else self.owner.profile.lock_time
         return self.date + timezone.timedelta(days=resolved_lock_time) <= timezone.now()
 
+    def update_preview(self):
+        """
+        Computes the preview title and content excerpt, so that list views don't need the whole content
+        Called when saving, and must be called before bulk creating memories
+        """
+        title = str(self.title).strip()
+        content = str(self.content).strip().replace("\n", " ")
+        if len(title) > self.PREVIEW_TITLE_CHARS:
+            title = title[:self.PREVIEW_TITLE_CHARS] + "..."
+        if len(content) > self.EXCERPT_CHARS:
+            content = content[:self.EXCERPT_CHARS] + "..."
+        self.preview_title = title
+        self.excerpt = content
+
+    @staticmethod
+    def anniversary_key(day:datetime.date) -> int:
+        return day.month * 100 + day.day
+
+    def update_anniversary(self):
+        """
+        Computes the month and day key used to find the memories of the same day in previous years
+        Called when saving, and must be called before bulk creating memories
+        """
+        self.anniversary = self.anniversary_key(timezone.localdate(self.date))
+
+    def save(self, *args, **kwargs):
+        if kwargs.get("update_fields") is None or {"title", "content"} & set(kwargs["update_fields"]):
+            self.update_preview()
+            if kwargs.get("update_fields") is not None:
+                kwargs["update_fields"] = {*kwargs["update_fields"], "preview_title", "excerpt"}
+        if kwargs.get("update_fields") is None or "date" in kwargs["update_fields"]:
+            self.update_anniversary()
+            if kwargs.get("update_fields") is not None:
+                kwargs["update_fields"] = {*kwargs["update_fields"], "anniversary"}
+        if self.pk is not None and (kwargs.get("update_fields") is None or self.RENDERED_FIELDS & set(kwargs["update_fields"])):
+            self.version += 1  # The cached page of the memory is outdated
+            if kwargs.get("update_fields") is not None:
+                kwargs["update_fields"] = {*kwargs["update_fields"], "version"}
+
+        # Keep the daily statistics up to date when the date or the mood can change
+        track_stats = kwargs.get("update_fields") is None or {"date", "mood"} & set(kwargs["update_fields"])
+        previous = None
+        if track_stats and self.pk is not None:
+            previous = Memory.objects.filter(pk=self.pk).values_list("date", "mood").first()
+        super().save(*args, **kwargs)
+        if track_stats and previous != (self.date, self.mood):
+            if previous is not None:
+                DailyMood.add(self.owner_id, timezone.localdate(previous[0]), previous[1], -1)
+            DailyMood.add(self.owner_id, timezone.localdate(self.date), self.mood, 1)
+
     def __str__(self):
         return f"{str(self.title)} ({self.pk})"
 
@@ -79,7 +203,124 @@ class MemoryMedia(models.Model):
         verbose_name_plural = _("memory media")
     
     memory = models.ForeignKey(Memory, on_delete=models.CASCADE, verbose_name=_("Memory of origin"))
-    file = models.FileField(storage=private_storage, upload_to=memory_media_upload_to)
+    file = models.FileField(storage=get_private_storage, upload_to=memory_media_upload_to)
+    processed = models.BooleanField(_("Was the file optimized"), default=False)  # Also True when it couldn't be optimized
+    bytes_saved = models.BigIntegerField(_("Bytes saved by the optimization"), default=0)
 
     def __str__(self):
         return f"{self.file} ({self.pk})"
+
+
+def diary_import_upload_to(instance, filename):
+    return f"imports/{instance.owner.pk}/{filename}"
+
+
+class DiaryImport(models.Model):
+    """
+    Tracks a diary archive imported in the background, so that it can resume after a failure
+    """
+    class Meta:
+        verbose_name = _("diary import")
+        verbose_name_plural = _("diary imports")
+
+    PENDING, RUNNING, DONE, FAILED = 1, 2, 3, 4
+    STATUSES = [(PENDING, _("Pending")), (RUNNING, _("Running")), (DONE, _("Done")), (FAILED, _("Failed"))]
+
+    owner = models.ForeignKey(User, on_delete=models.CASCADE, verbose_name=_("Owner of the import"))
+    archive = models.FileField(storage=get_private_storage, upload_to=diary_import_upload_to, blank=True)
+    status = models.IntegerField(_("Import status"), choices=STATUSES, default=PENDING)
+    created = models.DateTimeField(_("Date of creation"), default=timezone.now)
+    updated = models.DateTimeField(_("Date of the last progress"), default=timezone.now)  # Also used as a heartbeat
+    total_entries = models.IntegerField(_("Number of entries in the archive"), default=0)
+    processed_entries = models.IntegerField(_("Number of processed entries"), default=0)  # Imported or skipped, in archive order
+    imported_entries = models.IntegerField(_("Number of imported entries"), default=0)
+    errors = models.TextField(_("Errors log"), blank=True, default="")
+
+    def __str__(self):
+        return f"{self.owner} ({self.pk})"
+
+
+class ChunkedUpload(models.Model):
+    """
+    A media file uploaded by chunks, which can be resumed and gets attached to a memory when it's created
+    The chunks are stored in the private media storage until then
+    """
+    class Meta:
+        verbose_name = _("chunked upload")
+        verbose_name_plural = _("chunked uploads")
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    owner = models.ForeignKey(User, on_delete=models.CASCADE, verbose_name=_("Owner of the upload"))
+    filename = models.CharField(_("Name of the uploaded file"), max_length=255)
+    size = models.BigIntegerField(_("Size of the file in bytes"))
+    chunk_size = models.IntegerField(_("Size of the chunks in bytes"))
+    created = models.DateTimeField(_("Date of creation"), default=timezone.now)
+
+    @property
+    def chunk_count(self) -> int:
+        return max(1, -(-self.size // self.chunk_size))
+
+    def __str__(self):
+        return f"{self.filename} ({self.pk})"
+
+
+class DailyMood(models.Model):
+    """
+    Number of memories of a user for each day and mood, maintained when memories are saved or deleted
+    Statistics are computed from it instead of scanning all the memories
+    """
+    class Meta:
+        verbose_name = _("daily mood")
+        verbose_name_plural = _("daily moods")
+        constraints = [models.UniqueConstraint(fields=["owner", "day", "mood"], name="diarytrove_dailymood_unique")]
+
+    owner = models.ForeignKey(User, on_delete=models.CASCADE, verbose_name=_("Owner of the memories"))
+    day = models.DateField(_("Day of the memories"))  # In the server timezone
+    mood = models.IntegerField(_("Mood of the memories"), choices=Memory.MOODS)
+    count = models.IntegerField(_("Number of memories"), default=0)
+
+    @classmethod
+    def add(cls, owner_id:int, day, mood:int, delta:int):
+        """
+        Adds a number of memories to a day and mood, which can be negative when memories are removed
+        """
+        rows = cls.objects.filter(owner_id=owner_id, day=day, mood=mood)
+        if delta < 0:
+            rows.update(count=F("count") + delta)
+            rows.filter(count__lte=0).delete()
+            return
+        if rows.update(count=F("count") + delta):
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.create(owner_id=owner_id, day=day, mood=mood, count=delta)
+        except IntegrityError:
+            rows.update(count=F("count") + delta)  # Created by another request meanwhile
+
+    def __str__(self):
+        return f"{self.owner} {self.day} {self.mood} ({self.count})"
+
+
+class Newsletter(models.Model):
+    """
+    An announcement written in the admin and sent by email to the users who accepted newsletters
+    Recipients are sent in user order, so an interrupted sending resumes after the last checkpoint
+    """
+    class Meta:
+        verbose_name = _("newsletter")
+        verbose_name_plural = _("newsletters")
+
+    DRAFT, QUEUED, SENDING, SENT, FAILED = 1, 2, 3, 4, 5
+    STATUSES = [(DRAFT, _("Draft")), (QUEUED, _("Queued")), (SENDING, _("Sending")), (SENT, _("Sent")), (FAILED, _("Failed"))]
+
+    subject = models.CharField(_("Email subject"), max_length=255)
+    content = models.TextField(_("Content of the newsletter"))
+    status = models.IntegerField(_("Sending status"), choices=STATUSES, default=DRAFT)
+    created = models.DateTimeField(_("Date of creation"), default=timezone.now)
+    updated = models.DateTimeField(_("Date of the last progress"), default=timezone.now)  # Also used as a heartbeat
+    last_recipient = models.BigIntegerField(_("Primary key of the last user sent to"), default=0, editable=False)
+    sent_count = models.IntegerField(_("Number of emails sent"), default=0, editable=False)
+    failed_count = models.IntegerField(_("Number of emails which couldn't be sent"), default=0, editable=False)
+
+    def __str__(self):
+        return f"{self.subject} ({self.pk})"
@@ -0,0 +1,189 @@
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db.models import F
+from django.template.loader import render_to_string
+from django.urls import reverse
+from django.utils import timezone, translation
+
+from .models import Profile, Newsletter
+from .utils import email_base_context, with_email_css
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, local
+from typing import Iterator
+import time
+import traceback
+
+STALE_NEWSLETTER_DELAY = timezone.timedelta(minutes=10)  # A sending newsletter without progress for this long is considered dead
+
+
+class RateLimiter:
+    """
+    Spaces calls evenly to stay under a number of calls per second, shared by several threads
+    """
+    def __init__(self, rate:float):
+        self.interval = 1 / rate if rate > 0 else 0
+        self.next_slot = time.monotonic()
+        self.lock = Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class SmtpConnections:
+    """
+    Keeps one open SMTP connection per thread, reused for all the emails sent by the thread
+    """
+    def __init__(self):
+        self.thread_data = local()
+        self.opened = []
+        self.lock = Lock()
+
+    def get(self):
+        if getattr(self.thread_data, "connection", None) is None:
+            self.thread_data.connection = get_connection(fail_silently=False)
+            self.thread_data.connection.open()
+            with self.lock:
+                self.opened.append(self.thread_data.connection)
+        return self.thread_data.connection
+
+    def reset(self):
+        """
+        Drops the connection of the current thread after an error, the next email opens a new one
+        """
+        connection = getattr(self.thread_data, "connection", None)
+        self.thread_data.connection = None
+        if connection is not None:
+            try:
+                connection.close()
+            except Exception:
+                pass
+
+    def close(self):
+        for connection in self.opened:
+            try:
+                connection.close()
+            except Exception:
+                pass
+
+
+def render_newsletter(newsletter:Newsletter, language:str) -> tuple[str, str]:
+    """
+    Renders the text and html versions of a newsletter in a language, they are the same for every recipient
+    """
+    context = {"language": language, "content": newsletter.content.strip().split("\n"), **email_base_context(newsletter.subject)}
+    text_content = render_to_string("diarytrove/emails/newsletter/template.txt", context=context)
+    html_content = with_email_css(render_to_string("diarytrove/emails/newsletter/template.html", context=context))
+    return text_content, html_content
+
+
+def newsletter_recipients(newsletter:Newsletter) -> Iterator[list[tuple[int, str, str]]]:
+    """
+    Generates the remaining recipients by chunks of user primary key, email and language
+    Uses keyset pagination so each chunk is an index seek
+    """
+    last_recipient = newsletter.last_recipient
+    recipients = (Profile.objects.filter(mail_newsletter=True, user__is_active=True).exclude(user__email="")
+                  .order_by("user_id").values_list("user_id", "user__email", "language"))
+    while chunk := list(recipients.filter(user_id__gt=last_recipient)[:settings.NEWSLETTER_BATCH_SIZE]):
+        yield chunk
+        last_recipient = chunk[-1][0]
+
+
+def send_newsletter_email(connections:SmtpConnections, limiter:RateLimiter, email:EmailMultiAlternatives) -> bool:
+    """
+    Sends an email over the connection of the current thread, and tells if it was sent
+    """
+    limiter.wait()
+    try:
+        email.connection = connections.get()
+        email.send()
+        return True
+    except Exception as e:
+        print(f"\n/!\\ Error while sending a newsletter to {email.to[0]}: {e}")
+        connections.reset()  # The connection may be broken
+        return False
+
+
+def run_newsletter(newsletter:Newsletter, progress:callable=None):
+    """
+    Sends a newsletter to the remaining recipients, saving the progress every NEWSLETTER_CHECKPOINT_INTERVAL emails
+    The newsletter must have been claimed first, its status is set to sent or failed at the end
+    """
+    rendered = {}  # Language -> text and html content
+    connections = SmtpConnections()
+    limiter = RateLimiter(settings.NEWSLETTER_RATE)
+    unsubscribe_url = email_base_context(newsletter.subject)["base_url"] + reverse("preferences")
+    try:
+        with ThreadPoolExecutor(max_workers=settings.NEWSLETTER_CONNECTIONS, thread_name_prefix="newsletter") as pool:
+            for chunk in newsletter_recipients(newsletter):
+                emails = []
+                for user_pk, address, language in chunk:
+                    if language not in rendered:
+                        with translation.override(language):
+                            rendered[language] = render_newsletter(newsletter, language)
+                    text_content, html_content = rendered[language]
+                    email = EmailMultiAlternatives(newsletter.subject, text_content, settings.DEFAULT_FROM_EMAIL, [address],
+                                                   headers={"List-Unsubscribe": f"<{unsubscribe_url}>"})
+                    email.attach_alternative(html_content, "text/html")
+                    emails.append(email)
+
+                # The results come in order, every recipient up to a checkpoint has been handled
+                results = pool.map(lambda email: send_newsletter_email(connections, limiter, email), emails)
+                sent = failed = 0
+                for index, ((user_pk, _, _), result) in enumerate(zip(chunk, results), start=1):
+                    sent += result
+                    failed += not result
+                    if index % settings.NEWSLETTER_CHECKPOINT_INTERVAL and index < len(chunk):
+                        continue
+                    Newsletter.objects.filter(pk=newsletter.pk).update(last_recipient=user_pk, sent_count=F("sent_count") + sent,
+                                                                       failed_count=F("failed_count") + failed, updated=timezone.now())
+                    sent = failed = 0
+                    newsletter.refresh_from_db()
+                    if progress is not None:
+                        progress(newsletter)
+    except Exception as e:
+        # Keep the checkpoint, so the sending can be resumed
+        print(f"\n/!\\ Error while sending newsletter {newsletter.pk}: {e}:\n{traceback.format_exc()}")
+        Newsletter.objects.filter(pk=newsletter.pk).update(status=Newsletter.FAILED)
+        return
+    finally:
+        connections.close()
+
+    Newsletter.objects.filter(pk=newsletter.pk).update(status=Newsletter.SENT, updated=timezone.now())
+
+
+def queue_newsletter(newsletter:Newsletter) -> bool:
+    """
+    Puts a draft or failed newsletter in the queue, a failed one continues after its last checkpoint
+    """
+    return bool(Newsletter.objects.filter(pk=newsletter.pk, status__in=[Newsletter.DRAFT, Newsletter.FAILED])
+                .update(status=Newsletter.QUEUED, updated=timezone.now()))
+
+
+def claim_newsletter(newsletter:Newsletter) -> bool:
+    """
+    Marks a newsletter as sending, unless it's already being sent
+    Newsletters which stopped progressing while sending can be claimed again
+    """
+    now = timezone.now()
+    claimed = (Newsletter.objects.filter(pk=newsletter.pk, status__in=[Newsletter.QUEUED, Newsletter.SENDING])
+               .exclude(status=Newsletter.SENDING, updated__gt=now - STALE_NEWSLETTER_DELAY)
+               .update(status=Newsletter.SENDING, updated=now))
+    if claimed:
+        newsletter.refresh_from_db()
+    return bool(claimed)
+
+
+def send_queued_newsletters():
+    """
+    Sends the queued newsletters, and resumes the ones which were interrupted
+    """
+    for newsletter in Newsletter.objects.filter(status__in=[Newsletter.QUEUED, Newsletter.SENDING]):
+        if claim_newsletter(newsletter):
+            run_newsletter(newsletter)
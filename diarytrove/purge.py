@@ -0,0 +1,60 @@
+from django.db import transaction
+
+from .models import MemoryMedia, DiaryImport, private_storage
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import PurePosixPath
+from threading import Lock
+import os
+import traceback
+
+executor = None
+executor_lock = Lock()
+
+
+def purge_executor() -> ThreadPoolExecutor:
+    """
+    Get the thread deleting the files of deleted objects, created on first use
+    """
+    global executor
+    with executor_lock:
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="purge")
+    return executor
+
+
+def purge_file(name:str):
+    """
+    Deletes a private file, then its folder if it became empty
+    """
+    try:
+        private_storage.delete(name)
+        folder = str(PurePosixPath(name).parent)
+        if folder != ".":
+            os.rmdir(private_storage.path(folder))
+    except (OSError, NotImplementedError):
+        pass  # The folder isn't empty, or the storage has no folders
+    except Exception as e:
+        print(f"\n/!\\ Error while deleting the private file {name}: {e}:\n{traceback.format_exc()}")
+
+
+def queue_file_deletion(name:str):
+    """
+    Deletes a file in the background once the current transaction is committed, so a rollback keeps it
+    """
+    if name:
+        transaction.on_commit(lambda: purge_executor().submit(purge_file, name))
+
+
+def media_deleted(sender, instance:MemoryMedia, **kwargs):
+    """
+    Deletes the file of a deleted media, also called when its memory or user is deleted
+    """
+    queue_file_deletion(instance.file.name)
+
+
+def import_deleted(sender, instance:DiaryImport, **kwargs):
+    """
+    Deletes the archive of a deleted import if it was still kept
+    """
+    queue_file_deletion(instance.archive.name)
@@ -0,0 +1,86 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F
+from django.template.loader import render_to_string
+from django.utils.html import escape
+from django.utils.safestring import mark_safe, SafeString
+from django.utils import translation
+
+from .models import Memory, MemoryMedia
+from .utils import memory_media_mimetype, signed_media_url
+
+from pathlib import Path
+
+# Markdown can only produce these, scripts, styles, images and raw html attributes are removed
+MARKDOWN_TAGS = {"p", "br", "hr", "h1", "h2", "h3", "h4", "h5", "h6", "strong", "em", "b", "i", "del", "code", "pre",
+                 "blockquote", "ul", "ol", "li", "a", "table", "thead", "tbody", "tr", "th", "td", "dl", "dt", "dd", "abbr", "sup"}
+MARKDOWN_ATTRIBUTES = {"a": {"href", "title"}, "abbr": {"title"}, "th": {"align"}, "td": {"align"}}
+MEDIA_URL_PLACEHOLDER = "__media_url_{pk}__"  # Signed URLs depend on the viewer and expire, so they're added after the cache
+
+
+def render_content(memory:Memory) -> SafeString:
+    """
+    Renders the content of a memory as html, sanitized when it's formatted with Markdown
+    """
+    if memory.markdown:
+        import markdown, nh3  # Only loaded when needed, the server preloads them before forking its workers
+        html = markdown.markdown(memory.content, extensions=["extra", "sane_lists", "nl2br"], output_format="html")
+        return mark_safe(nh3.clean(html, tags=MARKDOWN_TAGS, attributes=MARKDOWN_ATTRIBUTES,
+                                   url_schemes={"http", "https", "mailto"}, link_rel="noopener noreferrer nofollow"))
+    return mark_safe("<p>" + "<br>".join(escape(line) for line in memory.content.strip().split("\n")) + "</p>")
+
+
+def render_media_list(medias:list[MemoryMedia]) -> str:
+    """
+    Renders the attachment listing of a memory, with placeholders instead of the media URLs
+    """
+    if not medias:
+        return ""
+    media_data = []
+    for memory_media in medias:
+        ctype = memory_media_mimetype(memory_media)
+        if ctype.startswith("image/"):
+            media_type = "image"
+        elif ctype.startswith("video/"):
+            media_type = "video"
+        elif ctype.startswith("audio/"):
+            media_type = "audio"
+        else:
+            media_type = "file"
+        media_data.append({"pk": memory_media.pk, "filename": Path(memory_media.file.name).name, "type": media_type, "mimetype": ctype,
+                           "url": MEDIA_URL_PLACEHOLDER.format(pk=memory_media.pk)})
+    return render_to_string("diarytrove/subtemplates/memory_media_list.html", {"media_data": media_data})
+
+
+def rendered_memory(memory:Memory, user_pk:int) -> dict:
+    """
+    Get the rendered content and attachment listing of an unlocked memory, cached per memory version and language
+    Only the media URLs are computed on each view
+    """
+    key = f"memory_render:{memory.pk}:{memory.version}:{translation.get_language()}"
+    rendered = cache.get(key)
+    if rendered is None:
+        medias = list(memory.memorymedia_set.only("pk", "file"))
+        rendered = {"content": str(render_content(memory)), "media_list": render_media_list(medias),
+                    "media": [(media.pk, media.file.name) for media in medias]}
+        cache.set(key, rendered, settings.MEMORY_RENDER_CACHE_TIMEOUT)
+
+    media_list = rendered["media_list"]
+    for media_pk, file_name in rendered["media"]:
+        media_list = media_list.replace(MEDIA_URL_PLACEHOLDER.format(pk=media_pk),
+                                        escape(signed_media_url(user_pk, MemoryMedia(pk=media_pk, file=file_name))))
+    return {"content": mark_safe(rendered["content"]), "media_list": mark_safe(media_list)}
+
+
+def bump_memory_version(memory_pk:int):
+    """
+    Makes the rendered memory cache miss, when something changes without saving the memory
+    """
+    Memory.objects.filter(pk=memory_pk).update(version=F("version") + 1)
+
+
+def media_changed(sender, instance:MemoryMedia, **kwargs):
+    """
+    The attachment listing changes when a media is added, replaced or deleted
+    """
+    bump_memory_version(instance.memory_id)
@@ -0,0 +1,61 @@
+from django.conf import settings
+
+from storages.backends.s3 import S3Storage
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+
+from typing import Iterator
+
+LIST_PAGE_SIZE = 1000  # Objects per listing request, the maximum of S3
+
+
+class S3PrivateMediaStorage(S3Storage):
+    """
+    Stores the private media files in an S3 compatible bucket, so several servers can share them
+    The bucket must stay private, browsers get presigned URLs or the files go through the server
+    """
+    def __init__(self, **kwargs):
+        options = {key: value for key, value in settings.PRIVATE_MEDIA_S3.items() if value}
+        super().__init__(bucket_name=settings.PRIVATE_MEDIA_BUCKET,
+                         querystring_auth=True,
+                         querystring_expire=settings.MEDIA_URL_LIFETIME,
+                         signature_version="s3v4",
+                         file_overwrite=False,  # Uploads with the same name get a suffix, like on the disk
+                         max_memory_size=settings.PRIVATE_MEDIA_S3_BUFFER_SIZE,  # Opened files are buffered on the disk above this size
+                         transfer_config=TransferConfig(multipart_threshold=settings.PRIVATE_MEDIA_S3_PART_SIZE,
+                                                        multipart_chunksize=settings.PRIVATE_MEDIA_S3_PART_SIZE),
+                         **options, **kwargs)
+
+    def iter_files(self, prefix:str="") -> Iterator[tuple[str, int, float]]:
+        """
+        Generates the name, size and modification timestamp of the stored files, one listing page at a time
+        """
+        for page in self.bucket.objects.filter(Prefix=prefix).page_size(LIST_PAGE_SIZE).pages():
+            for summary in page:
+                yield summary.key, summary.size, summary.last_modified.timestamp()
+
+    def usage(self) -> int:
+        """
+        Get the total size of the stored files in bytes
+        """
+        return sum(size for _, size, _ in self.iter_files())
+
+    def stream(self, name:str, chunk_size:int=2**20) -> Iterator[bytes]:
+        """
+        Get the content of a file by chunks, without buffering the whole file
+        Raises FileNotFoundError right away if the file doesn't exist
+        """
+        try:
+            body = self.bucket.Object(name).get()["Body"]
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+                raise FileNotFoundError(name)
+            raise
+        return body.iter_chunks(chunk_size)
+
+    def overwrite(self, name:str, source, modified:float=None):
+        """
+        Writes a file with this exact name from a file like object, streamed with a multipart upload
+        The modification time can't be set in a bucket
+        """
+        self.bucket.upload_fileobj(source, name, Config=self.transfer_config)
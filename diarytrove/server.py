@@ -0,0 +1,56 @@
+from django.conf import settings
+from django.db import connections
+from django.urls import get_resolver
+
+import logging
+import os
+import resource
+import time
+
+logger = logging.getLogger("diarytrove.server")
+
+
+def preload(started:float):
+    """
+    Imports the views and the libraries they use before the server forks its workers, so the workers share them
+    Connections opened meanwhile are closed, each worker must open its own
+    Logs the time since the server started, from the monotonic clock
+    """
+    get_resolver().url_patterns  # Imports all the views
+    import markdown, nh3  # noqa: F401, imported lazily by the rendering module
+    connections.close_all()
+
+    duration = time.monotonic() - started
+    log = logger.warning if duration > settings.PRELOAD_TIME_BUDGET else logger.info
+    log("preload duration=%.2fs budget=%.2fs", duration, settings.PRELOAD_TIME_BUDGET)
+
+
+def worker_memory() -> dict[str, int]:
+    """
+    Get the memory used by the current process in KiB
+    The proportional size counts the memory shared with the other workers once for all of them, it's only available on Linux
+    """
+    memory = {"max_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+    try:
+        with open("/proc/self/smaps_rollup") as smaps:
+            for line in smaps:
+                name, value = line.split(":", 1)
+                if name in ("Rss", "Pss"):
+                    memory[name.lower()] = int(value.split()[0])
+    except (OSError, ValueError):
+        pass
+    return memory
+
+
+def worker_started():
+    """
+    Starts the background jobs if no other worker runs them, and logs the memory of the worker
+    """
+    from .jobs import start_job_scheduler
+    runs_jobs = start_job_scheduler()
+
+    memory = worker_memory()
+    size = memory.get("pss", memory["max_rss"])
+    log = logger.warning if size > settings.WORKER_MEMORY_BUDGET else logger.info
+    log("worker pid=%d jobs=%s %s budget=%d", os.getpid(), runs_jobs,
+        " ".join(f"{name}={value}" for name, value in memory.items()), settings.WORKER_MEMORY_BUDGET)
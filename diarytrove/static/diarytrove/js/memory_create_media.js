@@ -15,6 +15,9 @@ const errorbold = document.getElementById("errorbold");
 const errorbr = document.getElementById("errorbr");
 
 const MAX_TOTAL_BYTES = document.getElementById("max-bytes").innerText;
+const CHUNK_PARALLEL = 3;  // Chunks sent at the same time
+const CHUNK_RETRIES = 3;  // Attempts for a chunk before giving up, a new submit resumes the upload
+const csrfToken = form.querySelector("input[name=csrfmiddlewaretoken]").value;
 var selectedFiles = [];
 
 function uid() {
@@ -118,6 +121,11 @@ function removeFile(id) {
     if (item._objectUrl) {
         try { URL.revokeObjectURL(item._objectUrl); } catch (e) {}
     }
+    // Cancel its upload on the server
+    if (item.uploadId) {
+        requestJson("DELETE", chunkUrl(item.uploadId)).catch(() => {});
+        localStorage.removeItem(uploadKey(item.file));
+    }
     selectedFiles.splice(idx, 1);
     renderList();
 }
@@ -147,7 +155,116 @@ function totalSelectedBytes() {
     return selectedFiles.reduce((s, i) => s + (i.file.size || 0), 0);
 }
 
-form.addEventListener("submit", (ev) => {
+function showProgress(percent) {
+    progressWrap.style.display = "";
+    progressBar.value = percent;
+    progressText.textContent = percent + "%";
+}
+
+function showError(message) {
+    errorbold.textContent = message;
+    error.style.display = "";
+    errorbr.style.display = "";
+    progressWrap.style.display = "none";
+    progressBar.value = 0;
+    progressText.textContent = "0%";
+}
+
+function chunkUrl(uploadId) {
+    return upload_chunk_url.replace(upload_placeholder, uploadId);
+}
+
+function uploadKey(file) {
+    // Remember the uploads between attempts, so a failed upload is resumed instead of started over
+    return "diarytrove-upload:" + file.name + ":" + file.size + ":" + file.lastModified;
+}
+
+async function requestJson(method, url, body, headers) {
+    const response = await fetch(url, {
+        method: method,
+        body: body,
+        credentials: "same-origin",
+        headers: Object.assign({"X-CSRFToken": csrfToken, "X-Requested-With": "XMLHttpRequest"}, headers || {}),
+    });
+    let data = null;
+    try { data = await response.json(); } catch (e) {}
+    if (!response.ok || !data || !data.success) {
+        const err = new Error(data && data.error ? data.error : gettext("Upload failed (status ") + response.status + ").");
+        err.status = response.status;
+        throw err;
+    }
+    return data;
+}
+
+async function startUpload(item) {
+    // Resume the previous upload of this file if the server still has it
+    const saved = localStorage.getItem(uploadKey(item.file));
+    if (saved) {
+        try {
+            return await requestJson("GET", chunkUrl(saved));
+        } catch (e) {
+            if (e.status !== 404) throw e;
+            localStorage.removeItem(uploadKey(item.file));
+        }
+    }
+    const fd = new FormData();
+    fd.append("filename", item.file.name);
+    fd.append("size", item.file.size);
+    const data = await requestJson("POST", upload_create_url, fd);
+    localStorage.setItem(uploadKey(item.file), data.id);
+    return data;
+}
+
+async function sendChunk(item, upload, index, onSent) {
+    const start = index * upload.chunk_size;
+    const chunk = item.file.slice(start, start + upload.chunk_size);
+    for (let attempt = 1; ; attempt++) {
+        try {
+            await requestJson("PATCH", chunkUrl(upload.id), chunk, {"Upload-Offset": start, "Content-Type": "application/octet-stream"});
+            onSent(chunk.size);
+            return;
+        } catch (e) {
+            // Retry network and server errors after a growing delay
+            if (attempt >= CHUNK_RETRIES || (e.status && e.status < 500)) throw e;
+            await new Promise(resolve => setTimeout(resolve, 1000 * 2 ** attempt));
+        }
+    }
+}
+
+async function uploadFiles(onProgress) {
+    // Send the files by chunks, skipping the chunks the server already received
+    const uploaded = selectedFiles.filter(item => item.file.size > 0);  // Empty files are sent with the form
+    const total = uploaded.reduce((s, i) => s + i.file.size, 0);
+    let sent = 0;
+    const tasks = [];
+    for (const item of uploaded) {
+        const upload = await startUpload(item);
+        item.uploadId = upload.id;
+        const received = new Set(upload.received);
+        for (let index = 0; index * upload.chunk_size < item.file.size; index++) {
+            if (received.has(index)) {
+                sent += Math.min(upload.chunk_size, item.file.size - index * upload.chunk_size);
+            } else {
+                tasks.push(() => sendChunk(item, upload, index, size => {
+                    sent += size;
+                    onProgress(sent, total);
+                }));
+            }
+        }
+    }
+    onProgress(sent, total);
+
+    // A few workers take the chunks one after the other
+    let next = 0;
+    async function worker() {
+        while (next < tasks.length) {
+            await tasks[next++]();
+        }
+    }
+    await Promise.all(Array.from({length: Math.min(CHUNK_PARALLEL, tasks.length)}, worker));
+}
+
+form.addEventListener("submit", async (ev) => {
     ev.preventDefault();
     errorbold.textContent = "";
     error.style.display = "none";
@@ -167,31 +284,29 @@ form.addEventListener("submit", (ev) => {
         return;
     }
 
-    // Build FormData from the form
-    const fd = new FormData(form);
-
-    // Append the files we stored in selectedFiles
-    selectedFiles.forEach(item => fd.append("files[]", item.file));
-    
     // Disable UI while uploading
     submitBtn.disabled = true;
     addBtn.disabled = true;
 
+    // Upload the files first, so a network error only loses the chunks being sent
+    try {
+        await uploadFiles((sent, total) => showProgress(total ? Math.round((sent / total) * 100) : 100));
+    } catch (e) {
+        submitBtn.disabled = false;
+        addBtn.disabled = false;
+        showError(e.status ? e.message : gettext("Network or server error during upload."));
+        return;
+    }
+
+    // Build FormData from the form, with the uploads to attach
+    const fd = new FormData(form);
+    selectedFiles.forEach(item => item.uploadId ? fd.append("uploads[]", item.uploadId) : fd.append("files[]", item.file));
+
     const xhr = new XMLHttpRequest();
     xhr.open("POST", form.action, true);
 
     xhr.setRequestHeader("X-Requested-With", "XMLHttpRequest");
 
-    // Progress for upload
-    xhr.upload.onprogress = function (e) {
-        if (e.lengthComputable) {
-            const percent = Math.round((e.loaded / e.total) * 100);
-            progressWrap.style.display = "";
-            progressBar.value = percent;
-            progressText.textContent = percent + "%";
-        }
-    };
-
     xhr.onload = function () {
         submitBtn.disabled = false;
         addBtn.disabled = false;
@@ -203,6 +318,7 @@ form.addEventListener("submit", (ev) => {
                 // Revoke created object URLs to free memory
                 for (const it of selectedFiles) {
                 if (it._objectUrl) try { URL.revokeObjectURL(it._objectUrl); } catch(e) {}
+                localStorage.removeItem(uploadKey(it.file));  // The server attached the uploads
                 }
                 // Redirect if server asked for it after confirming success to the user
                 if (data.redirect) {
@@ -0,0 +1,182 @@
+// Service worker caching the static files, and the pages and media files already viewed by the user
+// Served by the service_worker view, which defines service_worker_config before this script
+const config = self.service_worker_config;
+const user = new URL(self.location).searchParams.get("user");  // The pages register the worker with the logged in user
+const static_cache = "diarytrove-static-" + config.version;
+const user_cache = user ? "diarytrove-user-" + user : null;  // Nothing private is cached for logged out visitors
+
+// Paths from diarytrove/urls.py
+const page_paths = [/^\/gallery\/$/, /^\/memory\/\d+\/$/];
+const media_path = /^\/memory\/\d+\/\d+\/$/;  // The file of a media can be replaced by its optimized version
+const signed_media_path = /^\/signed_media\//;  // Named after the file which never changes, the signature changes over time
+const deleted_memory_path = /^\/memory\/(\d+)\/delete\/$/;
+
+// Cache the app shell, a missing file doesn't prevent the installation
+self.addEventListener("install", function(event) {
+    event.waitUntil(caches.open(static_cache).then(function(cache) {
+        return Promise.allSettled(config.shell.map(function(url) {
+            return cache.add(url);
+        }));
+    }).then(function() {
+        return self.skipWaiting();
+    }));
+});
+
+// Delete the static files of the previous versions, and the pages of any other user
+self.addEventListener("activate", function(event) {
+    event.waitUntil(caches.keys().then(function(names) {
+        return Promise.all(names.filter(function(name) {
+            return name.startsWith("diarytrove-") && name !== static_cache && name !== user_cache;
+        }).map(function(name) {
+            return caches.delete(name);
+        }));
+    }).then(function() {
+        return self.clients.claim();
+    }));
+});
+
+self.addEventListener("fetch", function(event) {
+    const request = event.request;
+    const url = new URL(request.url);
+    if (url.origin !== self.location.origin) {
+        return;  // Like media files presigned by a bucket
+    }
+
+    if (url.pathname === config.logout_url) {
+        event.respondWith(clear_user_cache().then(function() {
+            return fetch(request);
+        }));
+        return;
+    }
+
+    if (request.method !== "GET") {
+        const deleted = url.pathname.match(deleted_memory_path);
+        if (deleted && user_cache) {
+            event.waitUntil(caches.open(user_cache).then(function(cache) {
+                return cache.delete("/memory/" + deleted[1] + "/");
+            }));
+        }
+        return;
+    }
+
+    if (url.pathname.startsWith(config.static_url)) {
+        // Hashed file names change with their content, they can be used without checking the server
+        event.respondWith(config.hashed ? cache_first(request, static_cache, {}) : stale_while_revalidate(event, static_cache, {}));
+    } else if (user_cache && is_page(url)) {
+        event.respondWith(page_response(event));
+    } else if (user_cache && !request.headers.has("range")) {  // Partial requests of videos are left to the browser
+        if (media_path.test(url.pathname)) {
+            event.respondWith(stale_while_revalidate(event, user_cache, {}));
+        } else if (signed_media_path.test(url.pathname)) {
+            event.respondWith(cache_first(request, user_cache, {ignoreSearch: true}));
+        }
+    }
+});
+
+function is_page(url) {
+    return page_paths.some(function(path) {
+        return path.test(url.pathname);
+    });
+}
+
+function clear_user_cache() {
+    return user_cache ? caches.delete(user_cache) : Promise.resolve();
+}
+
+// Answer from the cache, only go to the server for files which aren't cached yet
+function cache_first(request, cache_name, options) {
+    return caches.open(cache_name).then(function(cache) {
+        return cache.match(request, options).then(function(cached) {
+            return cached || fetch(request).then(function(response) {
+                return store(cache, cache_name, request, response, options);
+            });
+        });
+    });
+}
+
+// Answer from the cache right away and update it in the background, or wait for the server if it isn't cached yet
+function stale_while_revalidate(event, cache_name, options) {
+    const request = event.request;
+    return caches.open(cache_name).then(function(cache) {
+        const network = fetch(request).then(function(response) {
+            return store(cache, cache_name, request, response, options);
+        });
+        return cache.match(request, options).then(function(cached) {
+            if (cached) {
+                event.waitUntil(network.catch(function() {}));  // Offline, the cached version stays
+                return cached;
+            }
+            return network;
+        });
+    });
+}
+
+// Answer with the page from the server, which checks that the session is still open
+// The cached page is only used when the server is slow to answer or offline, and then updated in the background
+function page_response(event) {
+    const request = event.request;
+    return caches.open(user_cache).then(function(cache) {
+        const network = fetch(request).then(function(response) {
+            return store(cache, user_cache, request, response, {});
+        });
+        const timeout = new Promise(function(resolve) {
+            setTimeout(resolve, config.page_timeout, null);
+        });
+        return Promise.race([network.catch(function() { return null; }), timeout]).then(function(response) {
+            if (response) {
+                return response;
+            }
+            return cache.match(request).then(function(cached) {
+                if (cached) {
+                    event.waitUntil(network.catch(function() {}));
+                    return cached;
+                }
+                return network;
+            });
+        });
+    });
+}
+
+// Cache a complete response from the server, and returns it
+function store(cache, cache_name, request, response, options) {
+    if (is_page(new URL(request.url))) {
+        // Navigations don't follow redirects, the worker gets an opaque redirect
+        if (response.type === "opaqueredirect" || response.redirected || (response.status >= 300 && response.status < 400)) {
+            return clear_user_cache().then(function() {  // Redirected to the login page, the session ended
+                return response;
+            });
+        }
+        if (response.status >= 400 && response.status < 500) {
+            return cache.delete(request).then(function() {  // Deleted memory or no access anymore
+                return response;
+            });
+        }
+    }
+    if (response.status !== 200 || response.type !== "basic") {
+        return Promise.resolve(response);
+    }
+    if (cache_name === user_cache && !(response.headers.get("content-type") || "").startsWith("text/html")) {
+        const size = parseInt(response.headers.get("content-length"), 10);
+        if (!(size <= config.max_media_size)) {
+            return Promise.resolve(response);  // Large or streamed media files
+        }
+    }
+
+    const copy = response.clone();
+    return cache.delete(request, options).then(function() {  // Older signatures of the same media file
+        return cache.put(request, copy);
+    }).then(function() {
+        return cache_name === user_cache ? trim(cache) : null;
+    }).catch(function() {}).then(function() {  // Storage quota exceeded
+        return response;
+    });
+}
+
+// Remove the oldest cached pages and media files above the limit
+function trim(cache) {
+    return cache.keys().then(function(requests) {
+        return Promise.all(requests.slice(0, Math.max(requests.length - config.max_entries, 0)).map(function(request) {
+            return cache.delete(request);
+        }));
+    });
+}
@@ -0,0 +1,6 @@
+// Register the service worker with the logged in user, another user or a logout replaces it and its cached pages
+if ("serviceWorker" in navigator) {
+    navigator.serviceWorker.register(service_worker_url).catch(function(error) {
+        console.warn("Service worker registration failed:", error);  // Like on an insecure origin
+    });
+}
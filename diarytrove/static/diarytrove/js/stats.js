@@ -0,0 +1,115 @@
+// Render the statistics charts from the compact JSON data
+(function () {
+const summary = document.getElementById("stats-summary");
+const heatmap = document.getElementById("heatmap");
+const heatmapMonth = document.getElementById("heatmap-month");
+const previousBtn = document.getElementById("heatmap-previous");
+const nextBtn = document.getElementById("heatmap-next");
+const moodChart = document.getElementById("mood-chart");
+const moodUntil = document.getElementById("mood-until");
+
+var stats = null;
+var dayCounts = new Map();
+var shownMonth = new Date();
+shownMonth.setDate(1);
+
+function monthKey(date) {
+    return date.getFullYear() + "-" + String(date.getMonth() + 1).padStart(2, "0");
+}
+
+function moodColor(index) {
+    // Positive moods in green, the neutral mood in grey and the other ones in red, darker for stronger moods
+    const mood = index + 1;
+    if (stats.positive_moods.includes(mood)) return "hsl(140, 55%, " + (35 + 8 * stats.positive_moods.indexOf(mood)) + "%)";
+    if (mood === 6) return "hsl(0, 0%, 70%)";
+    return "hsl(0, 60%, " + (75 - 6 * (mood - 7)) + "%)";
+}
+
+function renderSummary() {
+    const lines = [
+        gettext("Memories written: ") + stats.total_memories,
+        gettext("Days with memories: ") + stats.total_days,
+        gettext("Current streak: ") + stats.current_streak + " " + gettext("day(s)"),
+        gettext("Longest streak: ") + stats.longest_streak + " " + gettext("day(s)"),
+    ];
+    summary.innerHTML = "";
+    lines.forEach(line => {
+        const p = document.createElement("p");
+        p.textContent = line;
+        summary.appendChild(p);
+    });
+}
+
+function renderHeatmap() {
+    heatmapMonth.textContent = shownMonth.toLocaleDateString(undefined, {month: "long", year: "numeric"});
+    heatmap.innerHTML = "";
+    const max = Math.max(1, ...dayCounts.values());
+    const key = monthKey(shownMonth);
+    const daysInMonth = new Date(shownMonth.getFullYear(), shownMonth.getMonth() + 1, 0).getDate();
+    const offset = (shownMonth.getDay() + 6) % 7;  // Weeks start on monday
+
+    let row = document.createElement("tr");
+    for (let i = 0; i < offset; i++) row.appendChild(document.createElement("td"));
+    for (let day = 1; day <= daysInMonth; day++) {
+        if (row.children.length === 7) {
+            heatmap.appendChild(row);
+            row = document.createElement("tr");
+        }
+        const count = dayCounts.get(key + "-" + String(day).padStart(2, "0")) || 0;
+        const cell = document.createElement("td");
+        cell.textContent = day;
+        cell.title = count + " " + gettext("memories");
+        if (count > 0) cell.style.backgroundColor = "rgba(16, 169, 235, " + (0.25 + 0.75 * count / max) + ")";
+        row.appendChild(cell);
+    }
+    heatmap.appendChild(row);
+}
+
+function renderMoods() {
+    moodUntil.textContent = gettext("Moods of the memories until ") + stats.mood_until + gettext(", the more recent ones are still locked.");
+    moodChart.innerHTML = "";
+    stats.months.forEach(([month, counts]) => {
+        const total = counts.reduce((s, c) => s + c, 0);
+        const line = document.createElement("div");
+        line.className = "mood-line";
+        const label = document.createElement("span");
+        label.textContent = month;
+        const bar = document.createElement("div");
+        bar.className = "mood-bar";
+        counts.forEach((count, index) => {
+            if (count === 0) return;
+            const segment = document.createElement("div");
+            segment.style.width = (100 * count / total) + "%";
+            segment.style.backgroundColor = moodColor(index);
+            segment.title = stats.moods[index] + " " + count;
+            bar.appendChild(segment);
+        });
+        line.appendChild(label);
+        line.appendChild(bar);
+        moodChart.appendChild(line);
+    });
+}
+
+previousBtn.addEventListener("click", () => {
+    shownMonth.setMonth(shownMonth.getMonth() - 1);
+    renderHeatmap();
+});
+
+nextBtn.addEventListener("click", () => {
+    shownMonth.setMonth(shownMonth.getMonth() + 1);
+    renderHeatmap();
+});
+
+fetch(stats_data_url, {credentials: "same-origin"})
+    .then(response => response.json())
+    .then(data => {
+        stats = data;
+        dayCounts = new Map(stats.days);
+        renderSummary();
+        renderHeatmap();
+        renderMoods();
+    })
+    .catch(() => {
+        summary.textContent = gettext("The statistics could not be loaded.");
+    });
+})();
@@ -0,0 +1,92 @@
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDate, TruncMonth
+from django.utils import timezone
+
+from .models import Memory, DailyMood
+
+from collections import Counter
+import datetime
+
+
+def add_memories_to_stats(memories:list[Memory]):
+    """
+    Counts memories created without calling save, like with bulk_create
+    """
+    counts = Counter((memory.owner_id, timezone.localdate(memory.date), memory.mood) for memory in memories)
+    for (owner_id, day, mood), count in counts.items():
+        DailyMood.add(owner_id, day, mood, count)
+
+
+def memory_deleted(sender, instance:Memory, **kwargs):
+    """
+    Removes a deleted memory from the statistics, also called for memories deleted in bulk
+    """
+    DailyMood.add(instance.owner_id, timezone.localdate(instance.date), instance.mood, -1)
+
+
+def rebuild_stats(user:User=None) -> int:
+    """
+    Recomputes the daily statistics from the memories, for one user or everyone
+    Returns the number of rows created
+    """
+    memories = Memory.objects.all() if user is None else Memory.objects.filter(owner=user)
+    rows = (memories.annotate(day=TruncDate("date")).values("owner", "day", "mood")
+            .annotate(count=Count("pk")).order_by())
+    with transaction.atomic():
+        (DailyMood.objects.all() if user is None else DailyMood.objects.filter(owner=user)).delete()
+        created = DailyMood.objects.bulk_create([DailyMood(owner_id=row["owner"], day=row["day"], mood=row["mood"], count=row["count"])
+                                                 for row in rows.iterator()], batch_size=1000)
+    return len(created)
+
+
+def backfill_stats(sender, **kwargs):
+    """
+    Builds the statistics of the memories saved before they existed
+    """
+    if not DailyMood.objects.exists() and Memory.objects.exists():
+        rebuild_stats()
+
+
+def writing_streaks(days:list[datetime.date]) -> tuple[int, int]:
+    """
+    Get the current and longest numbers of consecutive days with memories, from sorted days
+    The current streak is kept until the end of the day after the last memory
+    """
+    current, longest, previous = 0, 0, None
+    for day in days:
+        current = current + 1 if previous is not None and day - previous == datetime.timedelta(days=1) else 1
+        longest = max(longest, current)
+        previous = day
+    if previous is None or timezone.localdate() - previous > datetime.timedelta(days=1):
+        current = 0
+    return current, longest
+
+
+def user_stats(user:User) -> dict:
+    """
+    Get the mood and writing statistics of a user in a compact form, for the charts
+    Moods are only given until the default lock time, so the statistics don't reveal locked memories
+    """
+    stats = DailyMood.objects.filter(owner=user).order_by()
+    mood_until = timezone.localdate() - datetime.timedelta(days=user.profile.lock_time)
+
+    months = {}
+    for row in (stats.filter(day__lte=mood_until).annotate(month=TruncMonth("day")).values("month", "mood")
+                .annotate(total=Sum("count")).order_by("month")):
+        month = months.setdefault(row["month"].strftime("%Y-%m"), [0] * len(Memory.MOODS))
+        month[row["mood"] - 1] += row["total"]
+
+    days = list(stats.values("day").annotate(total=Sum("count")).order_by("day").values_list("day", "total"))
+    current_streak, longest_streak = writing_streaks([day for day, _ in days])
+
+    return {"moods": [emoji for _, emoji in Memory.MOODS],
+            "positive_moods": list(Memory.POSITIVE_MOODS),
+            "mood_until": mood_until.isoformat(),
+            "months": [[month, counts] for month, counts in months.items()],
+            "days": [[day.isoformat(), total] for day, total in days],
+            "total_memories": sum(total for _, total in days),
+            "total_days": len(days),
+            "current_streak": current_streak,
+            "longest_streak": longest_streak}
@@ -1,6 +1,107 @@
 from django.core.files.storage import FileSystemStorage
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
 from django.conf import settings
 
+from pathlib import Path
+from typing import Iterator
+from threading import get_ident
+import gzip
+import os
+import brotli
+
 class PrivateMediaStorage(FileSystemStorage):
     def __init__(self, *args, **kwargs):
-        super().__init__(location=str(settings.PRIVATE_MEDIA_ROOT), base_url=None, *args, **kwargs)
+        kwargs.setdefault("location", str(settings.PRIVATE_MEDIA_ROOT))
+        super().__init__(base_url=None, *args, **kwargs)
+
+    def iter_files(self, prefix:str="") -> Iterator[tuple[str, int, float]]:
+        """
+        Generates the name, size and modification timestamp of the stored files, one folder at a time
+        """
+        root = Path(self.location)
+        for folder, subfolders, files in os.walk(root / prefix):
+            subfolders.sort()
+            for filename in sorted(files):
+                path = Path(folder) / filename
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue  # Deleted meanwhile
+                yield path.relative_to(root).as_posix(), stat.st_size, stat.st_mtime
+
+    def usage(self) -> int:
+        """
+        Get the total size of the stored files in bytes
+        """
+        return sum(size for _, size, _ in self.iter_files())
+
+    def overwrite(self, name:str, source, modified:float=None):
+        """
+        Writes a file with this exact name from a file like object, replacing it at once when it's complete
+        """
+        path = Path(self.path(name))
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temporary = path.with_name(f"{path.name}.{os.getpid()}.{get_ident()}.writing")  # Concurrent writes of the same name don't mix
+        try:
+            with open(temporary, "wb") as output:
+                while data := source.read(2**20):
+                    output.write(data)
+            os.replace(temporary, path)
+        except BaseException:
+            temporary.unlink(missing_ok=True)
+            raise
+        if modified is not None:
+            os.utime(path, (modified, modified))
+
+
+def private_media_storage() -> FileSystemStorage:
+    """
+    Get the storage of the private media files, on the disk or in an S3 compatible bucket when one is configured
+    """
+    if settings.PRIVATE_MEDIA_BUCKET:
+        from .s3storage import S3PrivateMediaStorage  # Needs django-storages[s3]
+        return S3PrivateMediaStorage()
+    return PrivateMediaStorage()
+
+
+class PrecompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """
+    Adds a content hash to the collected static file names, so they can be cached forever
+    Also writes gzip and brotli versions next to each text file, for Nginx gzip_static and brotli_static
+    """
+    compressed_extensions = (".css", ".js", ".svg", ".json", ".txt", ".html", ".xml", ".map")
+
+    def stored_name(self, name):
+        try:
+            return super().stored_name(name)
+        except ValueError:
+            return name  # The file wasn't collected (like an optional favicon), keep its plain name
+
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run, **options)
+        if dry_run:
+            return
+
+        # Compress both the original and the hashed names, once they all have their final content
+        names = set(paths) | set(self.hashed_files.values())
+        for name in sorted(names):
+            if name.endswith(self.compressed_extensions) and self.exists(name):
+                for compressed_name in self.compress(name):
+                    yield name, compressed_name, True
+
+    def compress(self, name:str) -> list[str]:
+        """
+        Writes the compressed versions of a static file, only keeping those smaller than the original
+        """
+        with self.open(name) as f:
+            content = f.read()
+
+        compressed_names = []
+        for extension, data in ((".gz", gzip.compress(content, compresslevel=9, mtime=0)),
+                                (".br", brotli.compress(content, mode=brotli.MODE_TEXT))):
+            if len(data) >= len(content):
+                continue
+            with open(self.path(name + extension), "wb") as f:
+                f.write(data)
+            compressed_names.append(name + extension)
+        return compressed_names
@@ -1 +1,116 @@
-from django.test import TestCase
+from django.test import SimpleTestCase, override_settings
+from django.core.cache import cache
+from django.http import Http404, StreamingHttpResponse
+
+from . import utils
+from .models import MemoryMedia
+
+from pathlib import PurePosixPath
+from unittest import mock, skipUnless
+import io
+
+try:
+    import boto3
+    from moto import mock_aws
+    from . import s3storage
+except ImportError:  # The bucket client and moto are optional, see requirements-s3.txt
+    s3storage = None
+
+S3_TEST_SETTINGS = {
+    "PRIVATE_MEDIA_BUCKET": "diarytrove-test",
+    "PRIVATE_MEDIA_S3": {"endpoint_url": None, "region_name": "us-east-1", "access_key": "test", "secret_key": "test"},
+    "PRIVATE_MEDIA_S3_PROXY": False,
+    "CACHES": {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+}
+
+
+@skipUnless(s3storage, "boto3, django-storages and moto are needed to test the bucket storage")
+@override_settings(**S3_TEST_SETTINGS)
+class S3PrivateMediaStorageTests(SimpleTestCase):
+    """
+    Runs the bucket storage against the S3 API stubbed by moto
+    """
+    def setUp(self):
+        aws = mock_aws()
+        aws.start()
+        self.addCleanup(aws.stop)
+        boto3.client("s3", region_name="us-east-1").create_bucket(Bucket="diarytrove-test")
+
+        self.storage = s3storage.S3PrivateMediaStorage()
+        patcher = mock.patch.object(utils, "private_storage", self.storage)  # Used by the media responses
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        cache.clear()
+
+    def put(self, name:str, content:bytes):
+        self.storage.bucket.put_object(Key=name, Body=content)
+
+    def test_iter_files_pages(self):
+        for i in range(5):
+            self.put(f"memory_media/1/{i}.txt", b"x" * i)
+        self.put("imports/archive.zip", b"zip")
+
+        with mock.patch.object(s3storage, "LIST_PAGE_SIZE", 2):
+            files = list(self.storage.iter_files("memory_media/"))
+            self.assertEqual(self.storage.usage(), 10 + 3)
+        self.assertEqual(sorted((name, size) for name, size, _ in files),
+                         [(f"memory_media/1/{i}.txt", i) for i in range(5)])
+        self.assertTrue(all(isinstance(modified, float) for _, _, modified in files))
+
+    def test_stream(self):
+        self.put("memory_media/1/video.mp4", b"0123456789")
+        self.assertEqual(b"".join(self.storage.stream("memory_media/1/video.mp4", chunk_size=3)), b"0123456789")
+        with self.assertRaises(FileNotFoundError):
+            self.storage.stream("memory_media/1/missing.mp4")
+
+    def test_overwrite(self):
+        self.put("memory_media/1/image.jpg", b"old")
+        self.storage.overwrite("memory_media/1/image.jpg", io.BytesIO(b"new content"))
+        self.assertEqual(b"".join(self.storage.stream("memory_media/1/image.jpg")), b"new content")
+        self.assertEqual([name for name, _, _ in self.storage.iter_files()], ["memory_media/1/image.jpg"])
+
+    def test_save_keeps_existing_files(self):
+        self.put("memory_media/1/image.jpg", b"old")
+        name = self.storage.save("memory_media/1/image.jpg", io.BytesIO(b"new"))
+        self.assertNotEqual(name, "memory_media/1/image.jpg")
+        self.assertEqual(b"".join(self.storage.stream("memory_media/1/image.jpg")), b"old")
+
+    def test_private_media_usage_cached(self):
+        self.put("memory_media/1/a.txt", b"12345")
+        self.assertEqual(utils.private_media_usage(), 5)
+
+        self.put("memory_media/1/b.txt", b"123")
+        with mock.patch.object(self.storage, "usage") as usage:
+            self.assertEqual(utils.private_media_usage(), 5)  # Until the cache expires
+            usage.assert_not_called()
+
+        cache.delete("private_media_usage")
+        self.assertEqual(utils.private_media_usage(), 8)
+
+    def test_presigned_download(self):
+        self.put("memory_media/1/image.jpg", b"image")
+        response = utils.bucket_media_response(PurePosixPath("memory_media/1/image.jpg"))
+        self.assertEqual(response.status_code, 302)
+        self.assertIn("diarytrove-test", response["Location"])
+        self.assertIn("/memory_media/1/image.jpg?", response["Location"])
+        self.assertIn("X-Amz-Signature=", response["Location"])
+
+        media = MemoryMedia(file="memory_media/1/image.jpg")
+        self.assertIn("X-Amz-Signature=", utils.signed_media_url(1, media))  # Pages link to the bucket directly
+
+        with self.assertRaises(Http404):
+            utils.bucket_media_response(PurePosixPath("memory_media/../secret.txt"))
+
+    @override_settings(PRIVATE_MEDIA_S3_PROXY=True)
+    def test_proxied_download(self):
+        self.put("memory_media/1/image.jpg", b"image")
+        response = utils.bucket_media_response(PurePosixPath("memory_media/1/image.jpg"))
+        self.assertIsInstance(response, StreamingHttpResponse)
+        self.assertEqual(response["Content-Type"], "image/jpeg")
+        self.assertEqual(b"".join(response.streaming_content), b"image")
+
+        with self.assertRaises(Http404):
+            utils.bucket_media_response(PurePosixPath("memory_media/1/missing.jpg"))
+
+        media = MemoryMedia(file="memory_media/1/image.jpg")
+        self.assertTrue(utils.signed_media_url(1, media).startswith("/signed_media/1/memory_media/1/image.jpg?"))
@@ -0,0 +1,108 @@
+from django.core.files import File
+from django.core.files.base import ContentFile
+
+from .models import Memory, MemoryMedia, ChunkedUpload, private_storage
+
+from pathlib import PurePosixPath
+
+
+def upload_folder(upload:ChunkedUpload) -> str:
+    return f"uploads/{upload.pk}"
+
+
+def chunk_name(upload:ChunkedUpload, index:int) -> str:
+    return f"{upload_folder(upload)}/{index}.chunk"
+
+
+def expected_chunk_size(upload:ChunkedUpload, index:int) -> int:
+    """
+    Get the size a chunk must have, only the last one can be smaller
+    """
+    return min(upload.chunk_size, upload.size - index * upload.chunk_size)
+
+
+def received_chunks(upload:ChunkedUpload) -> list[int]:
+    """
+    Get the indexes of the chunks which were fully received
+    Chunks without the expected size were cut short and must be sent again, other files are ignored
+    """
+    indexes = []
+    for name, size, _ in private_storage.iter_files(f"{upload_folder(upload)}/"):
+        index = PurePosixPath(name).name.removesuffix(".chunk")
+        if name.endswith(".chunk") and index.isdigit() and int(index) < upload.chunk_count \
+                and size == expected_chunk_size(upload, int(index)):
+            indexes.append(int(index))
+    return sorted(indexes)
+
+
+def save_chunk(upload:ChunkedUpload, index:int, data:bytes):
+    """
+    Stores a chunk under its exact name, replacing it at once if it was already sent
+    Chunks are separate files, so they can be sent in parallel and in any order
+    """
+    private_storage.overwrite(chunk_name(upload, index), ContentFile(data))
+
+
+def upload_complete(upload:ChunkedUpload) -> bool:
+    return len(received_chunks(upload)) == upload.chunk_count
+
+
+def delete_upload(upload:ChunkedUpload):
+    """
+    Deletes an upload and its chunks, including the incomplete ones
+    """
+    for name, _, _ in list(private_storage.iter_files(f"{upload_folder(upload)}/")):
+        private_storage.delete(name)
+    upload.delete()
+
+
+class ChunksReader:
+    """
+    File like object reading the chunks of an upload one after the other, without loading the whole file
+    """
+    def __init__(self, upload:ChunkedUpload):
+        self.upload = upload
+        self.size = upload.size
+        self.index = 0
+        self.current = None
+        self.closed = False
+
+    def seekable(self) -> bool:
+        return False  # Read once from the start, so bucket storages stream it with a multipart upload
+
+    def read(self, size:int=-1) -> bytes:
+        data = b""
+        while size < 0 or len(data) < size:
+            if self.current is None:
+                if self.index >= self.upload.chunk_count:
+                    break
+                self.current = private_storage.open(chunk_name(self.upload, self.index), "rb")
+                self.index += 1
+            read = self.current.read(-1 if size < 0 else size - len(data))
+            if not read:
+                self.current.close()
+                self.current = None
+                continue
+            data += read
+        return data
+
+    def close(self):
+        if self.current is not None:
+            self.current.close()
+        self.closed = True
+
+
+def attach_upload(upload:ChunkedUpload, memory:Memory) -> MemoryMedia:
+    """
+    Assembles the chunks of a complete upload into a media file of the memory, then deletes the upload
+    """
+    filename = PurePosixPath(upload.filename).name
+    media = MemoryMedia(memory=memory)
+    reader = ChunksReader(upload)
+    try:
+        media.file.save(filename, File(reader, name=filename), save=False)  # The field adds the memory folder
+    finally:
+        reader.close()
+    media.save()
+    delete_upload(upload)
+    return media
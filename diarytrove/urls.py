@@ -11,9 +11,18 @@ urlpatterns = [
     path("passwords/", views.passwords, name="passwords"),
     path("sendmail/", views.contact_email, name="contact_email"),
     path("preferences/", views.preferences, name="preferences"),
+    path("export/", views.diary_export, name="diary_export"),
+    path("import/", views.diary_import, name="diary_import"),
     path("home/", views.home, name="home"),
     path("gallery/", views.gallery, name="gallery"),
+    path("stats/", views.stats, name="stats"),
+    path("stats/data/", views.stats_data, name="stats_data"),
     path("memory/create/", views.memory_create, name="memory_create"),
+    path("upload/", views.upload_create, name="upload_create"),
+    path("upload/<uuid:upload_id>/", views.upload_chunk, name="upload_chunk"),
     path("memory/<int:memory_pk>/", views.memory_view, name="memory_view"),
+    path("memory/<int:memory_pk>/delete/", views.memory_delete, name="memory_delete"),
     path("memory/<int:memory_pk>/<int:media_pk>/", views.memory_media_view, name="memory_media_view"),
+    path("serviceworker.js", views.service_worker, name="service_worker"),
+    path("signed_media/<int:user_pk>/<path:file_path>", views.signed_media_view, name="signed_media"),
 ]
@@ -1,17 +1,37 @@
 from django.conf import settings
-from django.http import HttpRequest, HttpResponse, Http404, FileResponse
+from django.http import HttpRequest, HttpResponse, Http404, FileResponse, StreamingHttpResponse
+from django.shortcuts import redirect
+from django.core.files.storage import FileSystemStorage
 from django.core.mail import EmailMultiAlternatives
 from django.contrib.staticfiles import finders
+from django.contrib.staticfiles.storage import staticfiles_storage, ManifestFilesMixin
+from django.templatetags.static import static
 from django.contrib.auth.models import User
 from django.template.loader import render_to_string
+from django.core.cache import cache
+from django.utils import translation
+from django.utils.cache import patch_vary_headers
+from django.utils.dateparse import parse_date
+from django.utils.crypto import salted_hmac
+from django.urls import reverse
 
-from .models import Profile, Memory, MemoryMedia
+from .models import Profile, Memory, MemoryMedia, private_storage
 
-from pathlib import Path
-from threading import Thread
+from pathlib import Path, PurePosixPath
+import os
+from threading import Thread, Lock
+from email.mime.base import MIMEBase
 from email.mime.image import MIMEImage
 from mimetypes import guess_type
-from functools import lru_cache
+from urllib.parse import unquote
+from collections import OrderedDict
+from functools import wraps
+import base64
+import datetime
+import hashlib
+import hmac
+import json
+import time
 
 
 def check_profiles(user:User=None):
@@ -43,6 +63,52 @@ def needs_profile(func) -> callable:
     return wrapper
 
 
+def cache_anonymous_page(func) -> callable:
+    """
+    Decorator to cache the page given to anonymous visitors, once per language
+    Logged in users get the page rendered normally, as its header depends on the user
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        request: HttpRequest = args[0]
+        if request.method != "GET" or request.user.is_authenticated:
+            return func(*args, **kwargs)
+
+        cache_key = f"anonymous_page:{translation.get_language()}:{request.path}"
+        cached = cache.get(cache_key)
+        if cached is not None:
+            response = HttpResponse(cached["content"], content_type=cached["content_type"])
+        else:
+            response = func(*args, **kwargs)
+            if response.status_code == 200:
+                cache.set(cache_key, {"content": response.content, "content_type": response["Content-Type"]},
+                          settings.ANONYMOUS_PAGES_CACHE_TIMEOUT)
+        
+        # The page depends on the language picked by LocaleMiddleware, and on the session cookie
+        patch_vary_headers(response, ("Accept-Language", "Cookie"))
+        return response
+    return wrapper
+
+
+def private_media_usage() -> int:
+    """
+    Get the total size of the private media files in bytes
+    Cached for a while and shared by the servers, as it lists the whole storage
+    """
+    usage = cache.get("private_media_usage")
+    if usage is None:
+        usage = private_storage.usage()
+        cache.set("private_media_usage", usage, settings.PRIVATE_MEDIA_USAGE_CACHE_TIMEOUT)
+    return usage
+
+
+def private_media_full(upload_bytes:int) -> bool:
+    """
+    Checks if the private media storage has no room left for an upload of the given size
+    """
+    return private_media_usage() >= settings.MAX_GLOBAL_MEDIA_SIZE - upload_bytes
+
+
 def safe_join(root:Path, *paths) -> Path:
     """
     Join paths while protecting against directory transversal attacks
@@ -59,6 +125,9 @@ def private_media_response(request:HttpRequest, file_path:Path) -> HttpResponse:
     Ownership verification must be passed before calling this function
     The file_path is local to the private media directory
     """
+    if not isinstance(private_storage, FileSystemStorage):
+        return bucket_media_response(PurePosixPath(file_path))
+
     # Resolve the safe absolute path
     try:
         abs_path = safe_join(Path(settings.PRIVATE_MEDIA_ROOT), file_path)
@@ -84,36 +153,122 @@ def private_media_response(request:HttpRequest, file_path:Path) -> HttpResponse:
     return response
 
 
+def bucket_media_response(name:PurePosixPath) -> HttpResponse:
+    """
+    Get a private media file stored in a bucket, with a redirection to a presigned URL or through Django
+    """
+    if name.is_absolute() or ".." in name.parts:
+        raise Http404("Attempted directory transversal")
+
+    if not settings.PRIVATE_MEDIA_S3_PROXY:
+        return redirect(private_storage.url(str(name)))  # The bucket checks the signature and serves the file
+
+    try:
+        chunks = private_storage.stream(str(name))
+    except FileNotFoundError:
+        raise Http404("Cannot find media file")
+    response = StreamingHttpResponse(chunks, content_type=guess_type(name.name)[0] or "application/octet-stream")
+    response["Cache-Control"] = "private, max-age=0, no-cache"
+    return response
+
+
+def media_url_secret() -> str:
+    """
+    Get the secret signing media URLs, shared with the Nginx secure_link configuration
+    Derived from the secret key when it isn't configured, then only Django can check the URLs
+    """
+    return settings.MEDIA_URL_SECRET or salted_hmac("diarytrove.media_url", "").hexdigest()
+
+
+def media_signature(expires:int, url_path:str) -> str:
+    """
+    Signs an URL path and its expiry like the Nginx secure_link_md5 directive "$secure_link_expires$uri <secret>"
+    """
+    digest = hashlib.md5(f"{expires}{url_path} {media_url_secret()}".encode()).digest()
+    return base64.urlsafe_b64encode(digest).decode().rstrip("=")
+
+
+def signed_media_url(user_pk:int, memory_media:MemoryMedia) -> str:
+    """
+    Get a short lived URL to a media file, served by Nginx without going through Django
+    The expiry is rounded, so the same URL is given for a while and browsers can cache the file
+    """
+    if not isinstance(private_storage, FileSystemStorage) and not settings.PRIVATE_MEDIA_S3_PROXY:
+        return private_storage.url(memory_media.file.name)  # Presigned by the bucket, with the same lifetime
+    lifetime = settings.MEDIA_URL_LIFETIME
+    expires = (int(time.time()) // lifetime + 2) * lifetime  # Valid between one and two lifetimes
+    url = reverse("signed_media", args=[user_pk, memory_media.file.name])
+    return f"{url}?expires={expires}&md5={media_signature(expires, unquote(url))}"
+
+
+def valid_media_signature(url_path:str, expires:str, signature:str) -> bool:
+    """
+    Checks the signature and the expiry of a signed media URL, for requests which didn't go through Nginx
+    """
+    try:
+        expires = int(expires)
+    except ValueError:
+        return False
+    return expires >= time.time() and hmac.compare_digest(media_signature(expires, url_path), signature)
+
+
 def memory_media_mimetype(memory_media:MemoryMedia) -> str:
     """
     Get the mimetype of a memory media object
     """
-    ctype = guess_type(str(settings.PRIVATE_MEDIA_ROOT / memory_media.file.name))[0]
+    ctype = guess_type(memory_media.file.name)[0]
     if ctype is None:
         return "application/octet-stream"  # Default to binary if no type is found
     return ctype
 
 
+def parse_date_or_none(value:str) -> datetime.date|None:
+    """
+    Parses a date from a query parameter, returns None if it's missing or invalid
+    """
+    try:
+        return parse_date(value.strip())
+    except ValueError:
+        return None
+
+
 def memory_to_dict(memory:Memory) -> dict:
     """
     Creates a dict with all the needed information for a memory preview tile
+    Only uses the precomputed preview fields, so the content can be deferred
     """
-    MAX_CONTENT_CHARS = 1000
-    MAX_TITLE_CHARS = 120
-
-    title = memory.title.strip()
     mood_emoji = memory.MOODS[memory.mood-1][1]
-    content = memory.content.strip().replace("\n", " ")
-    if len(title) > MAX_TITLE_CHARS:
-        title = title[:MAX_TITLE_CHARS] + "..."
-    if len(content) > MAX_CONTENT_CHARS:
-        content = content[:MAX_CONTENT_CHARS] + "..."
-
     image = memory_preview_image(memory)
     image_pk = image.pk if image is not None else None
     
-    return {"pk": memory.pk, "title": title, "date": memory.date,
-            "mood_emoji": mood_emoji, "content": content, "image_pk": image_pk}
+    image_url = signed_media_url(memory.owner_id, image) if image is not None else None
+    
+    return {"pk": memory.pk, "title": memory.preview_title, "date": memory.date,
+            "mood_emoji": mood_emoji, "content": memory.excerpt, "image_pk": image_pk, "image_url": image_url}
+
+
+def backfill_memory_previews(sender, **kwargs):
+    """
+    Computes the preview fields of the memories saved before they existed, by batches
+    """
+    last_pk = 0
+    while batch := list(Memory.objects.filter(pk__gt=last_pk, preview_title="").order_by("pk")[:500]):
+        for memory in batch:
+            memory.update_preview()
+        Memory.objects.bulk_update(batch, ["preview_title", "excerpt"])
+        last_pk = batch[-1].pk
+
+
+def backfill_memory_anniversaries(sender, **kwargs):
+    """
+    Computes the anniversary keys of the memories saved before they existed, by batches
+    """
+    last_pk = 0
+    while batch := list(Memory.objects.filter(pk__gt=last_pk, anniversary=0).only("pk", "date").order_by("pk")[:500]):
+        for memory in batch:
+            memory.update_anniversary()
+        Memory.objects.bulk_update(batch, ["anniversary"])
+        last_pk = batch[-1].pk
 
 
 def memory_preview_image(memory:Memory) -> MemoryMedia|None:
@@ -127,44 +282,128 @@ def memory_preview_image(memory:Memory) -> MemoryMedia|None:
     return None
 
 
-def send_email(user:User, template:str, subject:str, context:dict={}, sender:str=settings.DEFAULT_FROM_EMAIL, attachments:list[Path]=[]):
+def email_base_context(subject:str) -> dict:
+    """
+    Context shared by all the email templates
+    """
+    return {
+        "title": subject,
+        "base_url": f"{'https' if getattr(settings, 'SECURE_SSL_REDIRECT', False) else 'http'}://{settings.WEB_DOMAIN}",
+        "CONTACT_EMAIL": settings.CONTACT_EMAIL,
+        "GITHUB_REPO": settings.GITHUB_REPO,
+    }
+
+
+def with_email_css(html_content:str) -> str:
+    """
+    Inlines the email stylesheet in the head of an html email
+    """
+    css_path = finders.find("diarytrove/css/emails.css")
+    if css_path:
+        with open(css_path, "r", encoding="utf-8") as css_file:
+            css = css_file.read()
+        html_content = html_content.replace("</head>", f"\n<style>\n{css}\n</style>\n</head>")
+    return html_content
+
+
+def send_email(user:User, template:str, subject:str, context:dict={}, sender:str=settings.DEFAULT_FROM_EMAIL, attachments:list[Path|MIMEBase]=[]):
     """
     Send an email to a user using a thread by providing the templates directory
     The template directory is under the emails directory, and contains template.txt and template.html
+    Attachments are file paths, or already built MIME parts
     """
     def send_email_thread():
         text_content = render_to_string(f"diarytrove/emails/{template}/template.txt", context=context)
-        html_content = render_to_string(f"diarytrove/emails/{template}/template.html", context=context)
-        css_path = finders.find("diarytrove/css/emails.css")
-        if css_path:
-            with open(css_path, "r", encoding="utf-8") as css_file:
-                css = css_file.read()
-            html_content = html_content.replace("</head>", f"\n<style>\n{css}\n</style>\n</head>")
+        html_content = with_email_css(render_to_string(f"diarytrove/emails/{template}/template.html", context=context))
         email = EmailMultiAlternatives(subject, text_content, sender, [user.email])
         if html_content is not None:
             email.attach_alternative(html_content, "text/html")
         for attachment in attachments:
-            email.attach(file_data(attachment))
+            email.attach(attachment if isinstance(attachment, MIMEBase) else file_data(attachment))
         email.send()
 
     check_profiles(user)  # Ensures the user has a profile and therefore an email language
-    context.update({
-        "user": user,
-        "title": subject,
-        "base_url": f"{'https' if getattr(settings, 'SECURE_SSL_REDIRECT', False) else 'http'}://{settings.WEB_DOMAIN}",
-        "CONTACT_EMAIL": settings.CONTACT_EMAIL,
-        "GITHUB_REPO": settings.GITHUB_REPO,
-    })
+    context.update({"user": user, **email_base_context(subject)})
     email_thread = Thread(target=send_email_thread)
     email_thread.daemon = True
     email_thread.start()
 
 
-@lru_cache()
+class BytesLRUCache:
+    """
+    Thread safe cache bounded by the total size of its values, the least recently used ones are evicted first
+    """
+    def __init__(self, max_bytes:int):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits, self.misses, self.evictions = 0, 0, 0
+        self.lock = Lock()
+
+    def get(self, key) -> bytes|None:
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, value:bytes):
+        if len(value) > self.max_bytes:
+            return  # Would evict everything else
+        with self.lock:
+            if key in self.entries:
+                self.size -= len(self.entries.pop(key))
+            self.entries[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"entries": len(self.entries), "bytes": self.size, "max_bytes": self.max_bytes,
+                    "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+attachment_cache = BytesLRUCache(settings.EMAIL_ATTACHMENT_CACHE_BYTES)
+
+
 def file_data(file_path:Path) -> MIMEImage:
-    with open(file_path, "rb") as f:
-        data = f.read()
+    """
+    Creates an image attachment, the file content is kept in a bounded cache as the same images are often sent again
+    """
+    key = (str(file_path), os.stat(file_path).st_mtime_ns)  # A changed file is read again
+    data = attachment_cache.get(key)
+    if data is None:
+        with open(file_path, "rb") as f:
+            data = f.read()
+        attachment_cache.put(key, data)
     file = MIMEImage(data)
     file.add_header("Content-ID", f"<{file_path.name}>")
     file.add_header("Content-Disposition", "attachment", filename=file_path.name)
     return file
+
+
+SERVICE_WORKER_SHELL = ("diarytrove/css/style.css", "diarytrove/js/serviceworker_register.js",
+                        "diarytrove/assets/github.svg", "diarytrove/assets/file.svg", "diarytrove/assets/external.svg")
+
+
+def service_worker_script() -> str:
+    """
+    Get the service worker script preceded by its configuration, with the URLs of the app shell
+    Its cache is versioned with the manifest of the collected static files, a new deployment replaces it
+    """
+    hashed = isinstance(staticfiles_storage, ManifestFilesMixin) and not settings.DEBUG
+    config = {"version": staticfiles_storage.manifest_hash if hashed else "debug",
+              "hashed": hashed,
+              "static_url": static(""),
+              "shell": [static(name) for name in SERVICE_WORKER_SHELL],
+              "logout_url": reverse("logout"),
+              "page_timeout": settings.SERVICE_WORKER_PAGE_TIMEOUT * 1000,
+              "max_entries": settings.SERVICE_WORKER_MAX_ENTRIES,
+              "max_media_size": settings.SERVICE_WORKER_MAX_MEDIA_SIZE}
+    with open(finders.find("diarytrove/js/serviceworker.js"), encoding="utf-8") as script:
+        return f"self.service_worker_config = {json.dumps(config)};\n{script.read()}"
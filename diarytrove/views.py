@@ -1,24 +1,39 @@
 from django.conf import settings
 from django.shortcuts import redirect, render, get_object_or_404
-from django.http import HttpRequest, HttpResponse, Http404, JsonResponse
+from django.http import HttpRequest, HttpResponse, Http404, JsonResponse, StreamingHttpResponse
 from django.core.exceptions import PermissionDenied, ValidationError
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.password_validation import validate_password
 from django.contrib.auth.models import User
 from django.contrib.auth.decorators import login_required
+from django.views.decorators.http import require_POST, require_http_methods
 from django.utils import timezone, translation
 from django.urls import reverse
+from django.db.models import Q, Sum
 from django.utils.translation import gettext as _
 
-from .models import Profile, Memory, MemoryMedia
-from .forms import LoginForm, SignupForm, PreferencesForm
-from .utils import needs_profile, memory_media_mimetype, private_media_response, memory_to_dict, send_email
+from .models import Profile, Memory, MemoryMedia, DiaryImport, ChunkedUpload
+from .forms import LoginForm, SignupForm, PreferencesForm, ImportForm
+from .utils import needs_profile, cache_anonymous_page, private_media_full, parse_date_or_none, valid_media_signature, private_media_response, memory_to_dict, send_email, service_worker_script
+from .export import diary_zip_stream
+from .imports import start_import, retry_import
+from .images import optimize_images
+from .stats import user_stats
+from .rendering import rendered_memory
+from .uploads import received_chunks, expected_chunk_size, save_chunk, upload_complete, attach_upload, delete_upload
+from .backends import users_with_email, resolve_login_user, login_throttled, record_failed_login
+from .database import UnicodeLower
 
 from pathlib import Path
+import datetime
 import random
-import os
+import uuid
+import zipfile
 
+ON_THIS_DAY_MEMORIES = 5  # Memories shown on the home page for the same day in previous years
 
+
+@cache_anonymous_page
 def index(request:HttpRequest):
     """
     The page to return when requesting the index page
@@ -50,7 +65,7 @@ def auth_signup(request:HttpRequest):
                 error_message = _("This username is already taked, choose another one or use the log in page if you already created your account.")
             
             # Check email availability
-            elif User.objects.filter(email=email).exists():
+            elif users_with_email(email).exists():
                 error_message = _("This email address is already in use, use the log in page to log into your account instead.")
 
             # Check password matching and robustness
@@ -104,34 +119,31 @@ def auth_login(request:HttpRequest):
             username_email = form.cleaned_data["username_email"]
             password = form.cleaned_data["password"]
 
-            login_type = "email" if "@" in username_email else "username"
-            if login_type == "email":
-                username_email = username_email.lower()  # emails are case insensitive
-            
             # Check the validity of the credentials
-            try:
-                if login_type == "username":
-                    user_object = User.objects.get(username=username_email)
-                else:
-                    user_object = User.objects.get(email=username_email)
-            except User.DoesNotExist:
-                error_message = _("This username/email isn't registered, sign up for a new account if you don't already have one.")
-            except User.MultipleObjectsReturned:
-                error_message = _("Multiple users are using this email, please use your username instead.")
-
+            if login_throttled(request, username_email):
+                error_message = _("Too many failed login attempts, please wait a few minutes before trying again.")
             else:
-                # Verify the password
-                username = user_object.username
-                user = authenticate(request, username=username, password=password)
-                if user is None:
-                    error_message = _("The entered password is wrong, try again.")
+                try:
+                    user_object = resolve_login_user(username_email)
+                except User.DoesNotExist:
+                    record_failed_login(request, username_email)
+                    error_message = _("This username/email isn't registered, sign up for a new account if you don't already have one.")
+                except User.MultipleObjectsReturned:
+                    record_failed_login(request, username_email)
+                    error_message = _("Multiple users are using this email, please use your username instead.")
+
                 else:
-                    # Log the user in then redirect
-                    login(request, user)
-                    if "next" in request.POST and request.POST.get("next", "").startswith("/"):  # Only redirect on this site
-                        return redirect(request.POST.get("next", "home"))
+                    # Verify the password, the user was already fetched so the backend doesn't query it again
+                    user = authenticate(request, username=username_email, password=password, login_user=user_object)
+                    if user is None:
+                        error_message = _("The entered password is wrong, try again.")
                     else:
-                        return redirect("home")
+                        # Log the user in then redirect
+                        login(request, user)
+                        if "next" in request.POST and request.POST.get("next", "").startswith("/"):  # Only redirect on this site
+                            return redirect(request.POST.get("next", "home"))
+                        else:
+                            return redirect("home")
         
         else:
             # Properly display the error for an invalid form
@@ -148,12 +160,13 @@ def auth_login(request:HttpRequest):
 
 def auth_logout(request:HttpRequest):
     """
-    Logs out the current user
+    Logs out the current user, the service worker deletes the pages it cached for them
     """
     logout(request)
     return redirect("index")
 
 
+@cache_anonymous_page
 def conditions(request:HttpRequest):
     """
     Returns  page with the terms and conditions
@@ -161,6 +174,7 @@ def conditions(request:HttpRequest):
     return render(request, "diarytrove/information/conditions.html", {"user": request.user})
 
 
+@cache_anonymous_page
 def passwords(request:HttpRequest):
     """
     Returns a page explaining password security
@@ -192,7 +206,10 @@ def preferences(request:HttpRequest):
             mail_reminder = form.cleaned_data["mail_reminder"]
             mail_memory = form.cleaned_data["mail_memory"]
             mail_newsletter = form.cleaned_data["mail_newsletter"]
+            keep_original_images = form.cleaned_data["keep_original_images"]
             language = form.cleaned_data["language"]
+            time_zone = form.cleaned_data["time_zone"]
+            mail_hour = form.cleaned_data["mail_hour"]
 
             if profile.editable_lock_time:
                 profile.lock_time = lock_time
@@ -204,7 +221,10 @@ def preferences(request:HttpRequest):
             profile.mail_reminder = mail_reminder
             profile.mail_memory = int(mail_memory)
             profile.language = language
+            profile.time_zone = time_zone
+            profile.mail_hour = mail_hour
             profile.mail_newsletter = mail_newsletter
+            profile.keep_original_images = keep_original_images
             profile.save()
             error_message = _("Preferences saved successfully!")
         
@@ -221,11 +241,72 @@ def preferences(request:HttpRequest):
         form.fields["mail_reminder"].initial = profile.mail_reminder
         form.fields["mail_memory"].initial = profile.mail_memory
         form.fields["language"].initial = profile.language
+        form.fields["time_zone"].initial = profile.time_zone
+        form.fields["mail_hour"].initial = profile.mail_hour
         form.fields["mail_newsletter"].initial = profile.mail_newsletter
+        form.fields["keep_original_images"].initial = profile.keep_original_images
     
     return render(request, "diarytrove/preferences.html", {"form": form, "error":error_message, "editable":profile.editable_lock_time})
 
 
+@login_required
+def diary_export(request:HttpRequest):
+    """
+    Streams the unlocked memories of the user and their media files as a zip archive
+    """
+    filename = f"diarytrove_{request.user.username}_{timezone.localdate():%Y-%m-%d}.zip"
+    response = StreamingHttpResponse(diary_zip_stream(request.user), content_type="application/zip")
+    response["Content-Disposition"] = f'attachment; filename="{filename}"'
+    response["X-Accel-Buffering"] = "no"  # Let Nginx forward the chunks instead of buffering the archive
+    return response
+
+
+@login_required
+@needs_profile
+def diary_import(request:HttpRequest):
+    """
+    Upload a diary archive to import in the background, and follow the imports progress
+    """
+    error_message = None
+    if request.method == "POST":
+        if "retry" in request.POST:
+            # Resume a failed import after its last saved batch
+            try:
+                failed_import = DiaryImport.objects.get(pk=int(request.POST["retry"]), owner=request.user)
+            except (ValueError, DiaryImport.DoesNotExist):
+                raise Http404("No such import")
+            if retry_import(failed_import):
+                start_import(failed_import)
+            return redirect("diary_import")
+
+        form = ImportForm(request.POST, request.FILES)
+        if form.is_valid():
+            archive = form.cleaned_data["archive"]
+            limit_mib = round(settings.MAX_IMPORT_ARCHIVE_SIZE / 2**20, 3)
+            if archive.size > settings.MAX_IMPORT_ARCHIVE_SIZE:
+                error_message = _("The archive is too large, the maximum is %(limit)s MiB.") % {"limit": limit_mib}
+            elif not zipfile.is_zipfile(archive):
+                error_message = _("The uploaded file is not a zip archive.")
+            elif private_media_full(archive.size):
+                error_message = _("The media storage is full, you cannot import a diary.")
+            else:
+                # Save the archive then import it in the background
+                new_import = DiaryImport(owner=request.user, archive=archive)
+                new_import.save()
+                start_import(new_import)
+                return redirect("diary_import")
+        else:
+            # Properly display the error for an invalid form
+            error_message = "".join([error for errors in form.errors.values() for error in errors])
+
+    form = ImportForm()
+    imports = list(request.user.diaryimport_set.order_by("-created")[:10])
+    in_progress = any(imported.status in (DiaryImport.PENDING, DiaryImport.RUNNING) for imported in imports)
+    return render(request, "diarytrove/import.html", {"form": form, "error": error_message, "imports": imports,
+                                                      "in_progress": in_progress,
+                                                      "max_archive_mib": round(settings.MAX_IMPORT_ARCHIVE_SIZE / 2**20, 3)})
+
+
 @login_required(redirect_field_name=None, login_url="index")  # Simply redirect to the index if the user is not logged in
 @needs_profile
 def home(request:HttpRequest):
@@ -234,15 +315,20 @@ def home(request:HttpRequest):
     """
     user = request.user
     latest_memory, random_memory = None, None
-    unlocked_memories = [memory for memory in user.memory_set.all().order_by("-date") if memory.is_unlocked()]
+    # The full content isn't needed for previews
+    unlocked_memories = user.memory_set.unlocked().defer("content").prefetch_related("memorymedia_set").order_by("-date")
+    unlocked_count = unlocked_memories.count()
     
-    if len(unlocked_memories) >= 1:
-        latest_memory = memory_to_dict(unlocked_memories.pop(0))
-    if len(unlocked_memories) >= 1:  # If there's still a memory left
-        random_memory = memory_to_dict(random.choice(unlocked_memories))
+    if unlocked_count >= 1:
+        latest_memory = memory_to_dict(unlocked_memories[0])
+    if unlocked_count >= 2:  # If there's still a memory left
+        random_memory = memory_to_dict(unlocked_memories[random.randint(1, unlocked_count-1)])
+    
+    # Memories of the same day in previous years, found with the anniversary index
+    on_this_day = [memory_to_dict(memory) for memory in unlocked_memories.on_this_day()[:ON_THIS_DAY_MEMORIES]]
 
     return render(request, "diarytrove/home.html",
-                  {"user": user, "latest_memory": latest_memory, "random_memory": random_memory})
+                  {"user": user, "latest_memory": latest_memory, "random_memory": random_memory, "on_this_day": on_this_day})
 
 
 @login_required
@@ -250,22 +336,47 @@ def gallery(request:HttpRequest):
     """
     A gallery to browse unlocked memories
     """
-    all_memories = request.user.memory_set.all().order_by("-date")
+    # The full content isn't needed for previews, it's only searched by the database
+    memories = request.user.memory_set.unlocked().defer("content").prefetch_related("memorymedia_set").order_by("-date")
     if "s" in request.GET:
-        query = request.GET.get("s", "").strip().lower()
-        wanted_memories = []
-        for memory in all_memories:
-            if query in str(memory.title).lower() or query in str(memory.content).lower():
-                wanted_memories.append(memory)
-    else:
-        wanted_memories = all_memories
+        query = request.GET.get("s", "").strip()
+        # Accented letters match whatever their case, which icontains doesn't do on SQLite
+        memories = (memories.alias(lower_title=UnicodeLower("title"), lower_content=UnicodeLower("content"))
+                    .filter(Q(lower_title__contains=query.lower()) | Q(lower_content__contains=query.lower())))
+    
+    # Date range and mood filters, served by the owner and date indexes
+    date_from = parse_date_or_none(request.GET.get("from", ""))  # Invalid dates are ignored
+    date_to = parse_date_or_none(request.GET.get("to", ""))
+    mood = request.GET.get("mood", "")
+    # The first and last days of the calendar don't limit anything, and their bounds can't be converted to UTC
+    if date_from is not None and date_from > datetime.date.min:
+        memories = memories.filter(date__gte=timezone.make_aware(datetime.datetime.combine(date_from, datetime.time.min)))
+    if date_to is not None and date_to < datetime.date.max:
+        memories = memories.filter(date__lt=timezone.make_aware(datetime.datetime.combine(date_to + datetime.timedelta(days=1), datetime.time.min)))
+    if mood.isdigit() and 1 <= int(mood) <= len(Memory.MOODS):
+        memories = memories.filter(mood=int(mood))
     
-    memories = []
-    for memory in wanted_memories:
-        if memory.is_unlocked():
-            memories.append(memory_to_dict(memory))
+    memories = [memory_to_dict(memory) for memory in memories]
     
-    return render(request, "diarytrove/gallery.html",  {"memories": memories})
+    return render(request, "diarytrove/gallery.html",  {"memories": memories, "moods": Memory.MOODS})
+
+
+@login_required
+@needs_profile
+def stats(request:HttpRequest):
+    """
+    Mood and writing statistics, the charts load their data from stats_data
+    """
+    return render(request, "diarytrove/stats.html")
+
+
+@login_required
+@needs_profile
+def stats_data(request:HttpRequest):
+    """
+    Statistics of the user as JSON, read from the daily aggregates
+    """
+    return JsonResponse({"success": True, **user_stats(request.user)})
 
 
 @login_required
@@ -278,13 +389,8 @@ def memory_create(request:HttpRequest):
     limit_bytes = settings.MAX_SUBMIT_MEDIA_SIZE
     limit_mib = round(limit_bytes / 2**20, 3)
     
-    # Check if the media storage is full
-    if not os.path.exists(settings.PRIVATE_MEDIA_ROOT):
-        storage_full = True  # Consider the storage full if it doesn't exist
-    else:
-        total_disk_max = settings.MAX_GLOBAL_MEDIA_SIZE
-        total_disk_used = os.path.getsize(settings.PRIVATE_MEDIA_ROOT)
-        storage_full = total_disk_used >= total_disk_max - limit_bytes  # The space should be enough for any new memory
+    # Check if the media storage is full, the space should be enough for any new memory
+    storage_full = private_media_full(limit_bytes)
 
     if request.method == "POST":
         # Handle post data
@@ -317,12 +423,21 @@ def memory_create(request:HttpRequest):
         if not Memory.MOODS[0][0] <= mood <= Memory.MOODS[-1][0]:
             return JsonResponse({"success": False, "error": _("Please select a valid mood.")}, status=400)
         
-        # Validate uploaded files
+        # Validate uploaded files, sent with the form or by chunks beforehand
         files = request.FILES.getlist("files[]")
-        if storage_full and files:
+        upload_ids = request.POST.getlist("uploads[]")
+        try:
+            uploads = list(ChunkedUpload.objects.filter(owner=request.user, pk__in=[uuid.UUID(upload_id) for upload_id in upload_ids]))
+        except ValueError:
+            uploads = []
+        if len(uploads) != len(upload_ids):
+            return JsonResponse({"success": False, "error": _("Some uploaded files could not be found, please add them again.")}, status=400)
+        if not all(upload_complete(upload) for upload in uploads):
+            return JsonResponse({"success": False, "error": _("Some files were not fully uploaded.")}, status=400)
+        if storage_full and (files or uploads):
             return JsonResponse({"success": False, "error": _("The media storage is full, you cannot upload new files.")}, status=400)
         
-        total_size = 0  # Files size in bytes
+        total_size = sum(upload.size for upload in uploads)  # Files size in bytes
 
         for f in files:
             try:
@@ -338,7 +453,8 @@ def memory_create(request:HttpRequest):
                                 status=400)
 
         # Create the memory object
-        memory = Memory(owner=request.user, lock_time=lock_time, title=str(title).strip(), content=str(content).strip(), mood=mood)
+        memory = Memory(owner=request.user, lock_time=lock_time, title=str(title).strip(), content=str(content).strip(), mood=mood,
+                        markdown=bool(request.POST.get("markdown")))
         memory.save()
 
         # Update the last memory creation date
@@ -346,8 +462,9 @@ def memory_create(request:HttpRequest):
         profile.sent_writing_reminder = False
         profile.save()
 
-        for f in files:
-            MemoryMedia.objects.create(memory=memory, file=f)
+        medias = [MemoryMedia.objects.create(memory=memory, file=f) for f in files]
+        medias += [attach_upload(upload, memory) for upload in uploads]
+        optimize_images([media.pk for media in medias])  # Images are reduced in the background
 
         # Return json for AJAX requests or redirect for normal requests
         if request.headers.get("x-requested-with") == "XMLHttpRequest":
@@ -362,65 +479,114 @@ def memory_create(request:HttpRequest):
                                                              "storage_full": storage_full})
 
 
+@login_required
+@require_POST
+def upload_create(request:HttpRequest):
+    """
+    Starts a chunked upload, the file is then sent by chunks to upload_chunk
+    """
+    try:
+        filename = str(request.POST["filename"]).strip()
+        size = int(request.POST["size"])
+    except (KeyError, ValueError):
+        return JsonResponse({"success": False, "error": _("Invalid upload information.")}, status=400)
+    
+    limit_bytes = settings.MAX_SUBMIT_MEDIA_SIZE
+    limit_mib = round(limit_bytes / 2**20, 3)
+    unfinished = ChunkedUpload.objects.filter(owner=request.user).aggregate(total=Sum("size"))["total"] or 0
+    if size <= 0 or not filename:
+        return JsonResponse({"success": False, "error": _("Invalid upload information.")}, status=400)
+    if size + unfinished > limit_bytes:
+        return JsonResponse({"success": False,
+                             "error": _("The uploaded files are too large. The maximum is %(limit)s MiB total, you uploaded %(size)s Mib.") % {"limit": limit_mib, "size": round((size + unfinished) / 2**20, 3)}},
+                            status=400)
+    if private_media_full(size):
+        return JsonResponse({"success": False, "error": _("The media storage is full, you cannot upload new files.")}, status=400)
+    
+    upload = ChunkedUpload.objects.create(owner=request.user, filename=filename[-255:], size=size, chunk_size=settings.UPLOAD_CHUNK_SIZE)
+    return JsonResponse({"success": True, "id": str(upload.pk), "chunk_size": upload.chunk_size, "received": []})
+
+
+@login_required
+@require_http_methods(["GET", "PATCH", "DELETE"])
+def upload_chunk(request:HttpRequest, upload_id:uuid.UUID):
+    """
+    Receives a chunk of an upload at the offset given by the Upload-Offset header
+    Also gives the received chunks to resume an upload, or cancels it
+    """
+    upload:ChunkedUpload = get_object_or_404(ChunkedUpload, pk=upload_id, owner=request.user)
+
+    if request.method == "GET":
+        return JsonResponse({"success": True, "id": str(upload.pk), "size": upload.size,
+                             "chunk_size": upload.chunk_size, "received": received_chunks(upload)})
+    if request.method == "DELETE":
+        delete_upload(upload)
+        return JsonResponse({"success": True})
+
+    try:
+        offset = int(request.headers.get("Upload-Offset", ""))
+    except ValueError:
+        return JsonResponse({"success": False, "error": _("Invalid chunk offset.")}, status=400)
+    if not 0 <= offset < upload.size or offset % upload.chunk_size != 0:
+        return JsonResponse({"success": False, "error": _("Invalid chunk offset.")}, status=400)
+    
+    index = offset // upload.chunk_size
+    data = request.body
+    if len(data) != expected_chunk_size(upload, index):
+        return JsonResponse({"success": False, "error": _("Invalid chunk size.")}, status=400)
+    
+    save_chunk(upload, index, data)
+    return JsonResponse({"success": True, "offset": offset + len(data)})
+
+
 @login_required
 def memory_view(request:HttpRequest, memory_pk:int):
     """
     View to display a memory
     """
     user = request.user
-    memory:Memory = get_object_or_404(Memory, pk=memory_pk)
-
-
-    owner = memory.owner
-    owner_profile:Profile = owner.profile
+    # The content is only needed when the rendered memory isn't cached
+    memory:Memory = get_object_or_404(Memory.objects.with_unlock_date().defer("content"), pk=memory_pk)
 
     # Verify access rights
-    if not (user.is_superuser or user == owner):
+    if not (user.is_superuser or user.pk == memory.owner_id):
         raise PermissionDenied("You are not the owner of this memory")
     
     # Check if the memory is unlocked
-    lock_time = memory.lock_time
-    if lock_time == 0:
-        lock_time = owner_profile.lock_time
-    
-    if memory.date + timezone.timedelta(days=lock_time) >= timezone.now():
+    if memory.unlock_date is None or memory.unlock_date >= timezone.now():
         raise Http404("This memory is still locked")
     
-    # Create a list of the memory media objects with the media primary keys, the rough media types and the mimetypes
-    media_data = []
-    for memory_media in memory.memorymedia_set.all():
-        ctype = memory_media_mimetype(memory_media)
-        if ctype.startswith("image/"):
-            media_type = "image"
-        elif ctype.startswith("video/"):
-            media_type = "video"
-        elif ctype.startswith("audio/"):
-            media_type = "audio"
-        else:
-            media_type = "file"
-        media_data.append({"pk": memory_media.pk, "filename": Path(memory_media.file.name).name, "type": media_type, "mimetype": ctype})
-
-    # Render the memory view page
+    # Render the memory view page, the unlocked memory only changes when it's edited
     return render(request, "diarytrove/memory_view.html", {"memory": memory,
-                                                           "content": memory.content.strip().split("\n"),
                                                            "mood_emoji": memory.MOODS[memory.mood-1][1],
-                                                           "media_data": media_data})
+                                                           **rendered_memory(memory, user.pk)})
 
 
 @login_required
-def memory_media_view(request:HttpRequest, memory_pk:int, media_pk:int):
+@require_POST
+def memory_delete(request:HttpRequest, memory_pk:int):
     """
-    Returns the raw media file if the data is valid and verifications passed
+    Deletes a memory of the user, its media files are deleted in the background
     """
     memory:Memory = get_object_or_404(Memory, pk=memory_pk)
-    memory_media:MemoryMedia = get_object_or_404(MemoryMedia, pk=media_pk)
+    if not (request.user.is_superuser or request.user == memory.owner):
+        raise PermissionDenied("You are not the owner of this memory")
+    
+    memory.delete()
+    return redirect("gallery")
+
 
-    # Check path consistency
-    if memory_media not in memory.memorymedia_set.all():
-        raise Http404("The memory doesn't contain this media")
+@login_required
+def memory_media_view(request:HttpRequest, memory_pk:int, media_pk:int):
+    """
+    Returns the raw media file if the data is valid and verifications passed
+    """
+    # A single query checks that the media belongs to the memory and gets its owner
+    memory_media:MemoryMedia = get_object_or_404(MemoryMedia.objects.select_related("memory").only("file", "memory__owner_id"),
+                                                 pk=media_pk, memory_id=memory_pk)
     
     # Verify access rights
-    if not(request.user.is_superuser or request.user == memory.owner):
+    if not(request.user.is_superuser or request.user.pk == memory_media.memory.owner_id):
         raise PermissionDenied("You are not the owner of this media")
     
     # Make sure there is a file path
@@ -433,3 +599,23 @@ def memory_media_view(request:HttpRequest, memory_pk:int, media_pk:int):
     
     # Everything is in order, return media file response
     return private_media_response(request, Path(file_path))
+
+
+def signed_media_view(request:HttpRequest, user_pk:int, file_path:str):
+    """
+    Serves a media file from a signed URL, when Nginx didn't already check and serve it
+    The signature proves that the URL was given to the user, so no database query is needed
+    """
+    if not valid_media_signature(request.path, request.GET.get("expires", ""), request.GET.get("md5", "")):
+        raise PermissionDenied("Invalid or expired media URL")
+    return private_media_response(request, Path(file_path))
+
+
+def service_worker(request:HttpRequest):
+    """
+    Serves the service worker from the root of the website, so it can cache every page
+    Browsers check it for updates on each visit, so it isn't cached
+    """
+    response = HttpResponse(service_worker_script(), content_type="text/javascript")
+    response["Cache-Control"] = "no-cache"
+    return response
@@ -0,0 +1,29 @@
+"""
+Gunicorn settings, read automatically when gunicorn is started from the project folder
+The app is loaded once in the master process then forked, the background jobs run in a single worker
+"""
+
+import os
+import time
+
+started = time.monotonic()  # The config is read before the app is loaded
+wsgi_app = "website.wsgi:application"
+workers = int(os.getenv("GUNICORN_WORKERS", 2))
+preload_app = True  # Workers share the loaded code copy-on-write and start faster
+
+
+def when_ready(server):
+    """
+    Called in the master process once the app is loaded, before the workers are forked
+    No threads or connections must be left open here, they can't be used after forking
+    """
+    from diarytrove.server import preload
+    preload(started)
+
+
+def post_worker_init(worker):
+    """
+    Called in each worker once it's forked and ready to handle requests
+    """
+    from diarytrove.server import worker_started
+    worker_started()
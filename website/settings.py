@@ -65,8 +65,14 @@ TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
         'DIRS': [],
-        'APP_DIRS': True,
         'OPTIONS': {
+            # Compiled templates are kept in memory instead of being parsed again on each render
+            'loaders': [
+                ('django.template.loaders.cached.Loader', [
+                    'django.template.loaders.filesystem.Loader',
+                    'django.template.loaders.app_directories.Loader',
+                ]),
+            ],
             'context_processors': [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
@@ -83,17 +89,93 @@ WSGI_APPLICATION = 'website.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# SQLite by default, set POSTGRES_DB in the .env file to use PostgreSQL with a connection pool instead
+if os.getenv('POSTGRES_DB'):
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.getenv('POSTGRES_DB'),
+            'USER': os.getenv('POSTGRES_USER'),
+            'PASSWORD': os.getenv('POSTGRES_PASSWORD'),
+            'HOST': os.getenv('POSTGRES_HOST', 'localhost'),
+            'PORT': os.getenv('POSTGRES_PORT', '5432'),
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {
+                # Needs psycopg[pool], the pool keeps the connections open so CONN_MAX_AGE must stay 0
+                'pool': {'min_size': 2, 'max_size': int(os.getenv('POSTGRES_POOL_SIZE', 10)), 'timeout': 10},
+            },
+        }
     }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'db.sqlite3',
+            'CONN_MAX_AGE': 600,  # Seconds to keep a connection for the next requests of the same thread
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {
+                'transaction_mode': 'IMMEDIATE',  # Transactions wait for the write lock when they start, instead of failing when they write
+            },
+        }
+    }
+
+# Applied to each new SQLite connection by diarytrove.database
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',  # Readers don't block the writer
+    'synchronous': 'NORMAL',  # Safe with WAL, only the last transactions can be lost on a power failure
+    'busy_timeout': 5000,  # Milliseconds to wait for the write lock before "database is locked"
+    'cache_size': -20000,  # Negative values are in KiB
+    'mmap_size': 128 * 2**20,  # Bytes of the database read through memory mapping
+    'temp_store': 'MEMORY',
 }
 
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+# Files are shared between the gunicorn workers, set REDIS_URL in the .env file to use a Redis compatible server instead
+
+if os.getenv('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.getenv('REDIS_URL'),
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': BASE_DIR / 'cache',
+        }
+    }
+
+# Sessions are read from the cache, and only written through to the database
+
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+
+ANONYMOUS_PAGES_CACHE_TIMEOUT = 60 * 60  # Seconds to cache the information pages for logged out visitors
+MEMORY_RENDER_CACHE_TIMEOUT = 7 * 24 * 60 * 60  # Seconds to cache rendered memories, edits change the cache key anyway
+
+# Authentication, users can log in with their username or email
+
+AUTHENTICATION_BACKENDS = [
+    'diarytrove.backends.UsernameOrEmailBackend',
+]
+
+# Failed logins throttling, rejected before any password hashing
+
+LOGIN_THROTTLE_WINDOW = 15 * 60  # Seconds during which failed logins are counted
+LOGIN_THROTTLE_IP_ATTEMPTS = 30  # Max failed logins from one IP address in the window
+LOGIN_THROTTLE_ACCOUNT_ATTEMPTS = 10  # Max failed logins on one account in the window
+LOGIN_THROTTLE_IP_HEADER = 'HTTP_X_REAL_IP'  # Set by Nginx proxy_params, falls back to REMOTE_ADDR
+
 # Password hashing functions
 
+ARGON2_TIME_COST = 2  # Passwords are rehashed on login when these change
+ARGON2_MEMORY_COST = 102400  # In KiB
+ARGON2_PARALLELISM = 8
+
 PASSWORD_HASHERS = [
-    'django.contrib.auth.hashers.Argon2PasswordHasher',
+    'diarytrove.hashers.ConfigurableArgon2PasswordHasher',
     #'django.contrib.auth.hashers.BCryptSHA256PasswordHasher',
     #'django.contrib.auth.hashers.PBKDF2PasswordHasher',
     #'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
@@ -140,12 +222,36 @@ LOCALE_PATHS = [
 STATIC_URL = 'static/'
 STATIC_ROOT = Path('/var/www/diarytrove/static')
 
+# Collected static files get a content hash in their name and precompressed .gz and .br versions
+STORAGES = {
+    'default': {
+        'BACKEND': 'django.core.files.storage.FileSystemStorage',
+    },
+    'staticfiles': {
+        'BACKEND': 'diarytrove.storage.PrecompressedManifestStaticFilesStorage',
+    },
+}
+
 # Private media files, those can only be accessed internally after permission checks
 # FOR PRODUCTION: use an adapted path, like the commented one
 
 #PRIVATE_MEDIA_ROOT = Path('/var/www/diarytrove/private_media')
 PRIVATE_MEDIA_ROOT = BASE_DIR / 'private_media'  # Change to the above in production
 
+# Set PRIVATE_MEDIA_BUCKET in the .env file to store the private media files in an S3 compatible bucket instead (AWS S3, MinIO, Garage...)
+# Several servers can then run the website with the same files, install the client with pip install -r requirements-s3.txt
+PRIVATE_MEDIA_BUCKET = os.getenv('PRIVATE_MEDIA_BUCKET')
+PRIVATE_MEDIA_S3 = {
+    'endpoint_url': os.getenv('PRIVATE_MEDIA_S3_ENDPOINT'),  # Leave empty for AWS S3
+    'region_name': os.getenv('PRIVATE_MEDIA_S3_REGION'),
+    'access_key': os.getenv('PRIVATE_MEDIA_S3_ACCESS_KEY'),
+    'secret_key': os.getenv('PRIVATE_MEDIA_S3_SECRET_KEY'),
+}
+PRIVATE_MEDIA_S3_PART_SIZE = 8 * 2**20  # Bytes, larger files are streamed to the bucket with multipart uploads
+PRIVATE_MEDIA_S3_BUFFER_SIZE = 8 * 2**20  # Bytes of an opened file kept in memory, the rest is buffered on the disk
+PRIVATE_MEDIA_S3_PROXY = False  # Send the files through Django instead of redirecting to presigned URLs, when browsers can't reach the bucket
+PRIVATE_MEDIA_USAGE_CACHE_TIMEOUT = 5 * 60  # Seconds to cache the total size of the private media files
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
@@ -160,6 +266,7 @@ EMAIL_USE_TLS = True
 EMAIL_USE_SSL = False
 EMAIL_HOST_USER = os.getenv('EMAIL_HOST_USER')
 EMAIL_HOST_PASSWORD = os.getenv('EMAIL_HOST_PASSWORD')
+EMAIL_TIMEOUT = 30  # Seconds, a hanging SMTP server fails the email instead of blocking the sending thread
 DEFAULT_FROM_EMAIL = os.getenv('AGENT_EMAIL')
 CONTACT_EMAIL = os.getenv('CONTACT_EMAIL')
 
@@ -171,6 +278,79 @@ LOGIN_URL = 'login'
 
 MAX_GLOBAL_MEDIA_SIZE = 10 * 2**30  # Max total medias size on disk, disable media uploads after, 10 Gib
 MAX_SUBMIT_MEDIA_SIZE = 10 * 2**20  # Max medias upload size in bytes for one memory, 10 MiB
+UPLOAD_CHUNK_SIZE = 2 * 2**20  # Media files are uploaded by chunks of this size, must stay under DATA_UPLOAD_MAX_MEMORY_SIZE
+UPLOAD_EXPIRATION = 24 * 60 * 60  # Seconds after which unfinished uploads are deleted
+MAX_IMPORT_ARCHIVE_SIZE = 2 * 2**30  # Max size of a diary archive to import, 2 GiB
+IMPORT_BATCH_SIZE = 200  # Memories inserted at once when importing a diary, an interrupted import resumes after the last batch
+IMPORT_MEDIA_WORKERS = 4  # Threads copying the media files of an imported diary
+
+# Folder of the backups made with "manage.py backup", each backup only holds the media files changed since the previous one
+BACKUP_ROOT = BASE_DIR / 'backups'
+
+# Media files are shown with signed URLs which expire, checked by Nginx without going through Django
+MEDIA_URL_SECRET = os.getenv('MEDIA_URL_SECRET')  # Must match the secret in the Nginx secure_link_md5 directive
+MEDIA_URL_LIFETIME = 60 * 60  # Seconds, the URLs stay valid between one and two lifetimes
+
+# The service worker keeps the static files, and the gallery pages, memories and media files viewed by the user in the browser
+SERVICE_WORKER_MAX_ENTRIES = 300  # Pages and media files cached for the logged in user, the oldest ones are removed
+SERVICE_WORKER_MAX_MEDIA_SIZE = 8 * 2**20  # Bytes, larger media files like videos are always downloaded
+SERVICE_WORKER_PAGE_TIMEOUT = 2  # Seconds to wait for the server to confirm the session before showing a cached page
+
+# Uploaded images are re-encoded in the background, unless the user chose to keep the originals
+IMAGE_OPTIMIZATION = True
+IMAGE_OPTIMIZATION_WORKERS = 2  # Threads re-encoding images
+IMAGE_MAX_EDGE = 2560  # Max width or height of the stored images in pixels
+IMAGE_FORMAT = 'JPEG'  # Pillow format to re-encode images with, like 'JPEG' or 'WEBP'
+IMAGE_QUALITY = 85
+
+# Users can receive the memories unlocked at the same time in one email
+MEMORY_DIGEST_MAX_INLINE = 10  # Memories shown in a digest email, the other ones are only counted
+EMAIL_THUMBNAIL_SIZE = 320  # Max width or height of the images in digest emails in pixels
+
+# Memory emails attach a smaller version of the images, cached on disk
+EMAIL_IMAGE_SIZE = 1280  # Max width or height of the images attached to memory emails in pixels
+EMAIL_IMAGE_CACHE_DIR = BASE_DIR / 'cache' / 'email_images'
+EMAIL_IMAGE_CACHE_DAYS = 7  # Unused cached images are deleted after this many days
+EMAIL_ATTACHMENT_CACHE_BYTES = 32 * 2**20  # Max size of the attachments kept in memory by each process, 32 MiB
+
+# Writing reminders wait for the hour chosen by each user in their time zone, and are spread over a window after it
+EMAIL_REMINDER_WINDOW = 60 * 60  # Seconds, users choosing the same hour get their reminders at different times in it
+EMAIL_RATE = 2  # Max reminder and memory emails sent per second, newsletters have their own limit
+
+# Newsletters are sent over a few reused SMTP connections, at a limited rate
+NEWSLETTER_RATE = 10  # Max emails sent per second, check the limits of your SMTP provider
+NEWSLETTER_CONNECTIONS = 4  # SMTP connections used at the same time
+NEWSLETTER_BATCH_SIZE = 500  # Recipients loaded from the database at once
+# With EMAIL_TIMEOUT, checkpoints stay a few minutes apart even if the SMTP server hangs, stalled sendings are taken over after 10 minutes
+NEWSLETTER_CHECKPOINT_INTERVAL = 20  # Emails sent between checkpoints, an interrupted sending resumes after the last one
+
+# Background jobs run in a small thread pool, with at most one run of each job at a time
+JOB_WORKERS = 3
+JOB_JITTER = 60  # Max random delay in seconds before the first run of each job, so they don't all start together
+JOB_TIMEOUT = 30 * 60  # Seconds after which a running job is logged as stuck
+JOBS_LOCK_FILE = BASE_DIR / 'jobs.lock'  # Locked by the process running the background jobs, a gunicorn worker or the run_jobs command
+JOB_TIMEOUTS = {'cleanup_private_media': 2 * 60 * 60, 'process_diary_imports': 6 * 60 * 60, 'send_queued_newsletters': 12 * 60 * 60, 'database_maintenance': 2 * 60 * 60}  # Timeouts of specific jobs
+
+# Startup budgets, gunicorn logs a warning when the app takes longer to preload or a worker uses more memory
+# Measured with 2 workers: about 0.3s to load the app, and 20 to 25 MiB of proportional memory per worker
+PRELOAD_TIME_BUDGET = 1  # Seconds
+WORKER_MEMORY_BUDGET = 64 * 1024  # KiB of proportional memory, the shared memory is split between the workers
+
+# Log the outcome and duration of the background jobs
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'jobs': {'format': '{asctime} {levelname} {message}', 'style': '{'},
+    },
+    'handlers': {
+        'jobs_console': {'class': 'logging.StreamHandler', 'formatter': 'jobs'},
+    },
+    'loggers': {
+        'diarytrove.jobs': {'handlers': ['jobs_console'], 'level': 'INFO', 'propagate': False},
+        'diarytrove.server': {'handlers': ['jobs_console'], 'level': 'INFO', 'propagate': False},
+    },
+}
 
 # SECURITY FEATURES: uncomment these in production
 
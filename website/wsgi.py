@@ -8,9 +8,15 @@ https://docs.djangoproject.com/en/5.2/howto/deployment/wsgi/
 """
 
 import os
+import sys
 
 from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'website.settings')
 
 application = get_wsgi_application()
+
+# Gunicorn starts the background jobs after forking its workers, other servers must run them separately
+if 'gunicorn' not in sys.modules:
+    from diarytrove.jobs import check_job_scheduler
+    check_job_scheduler()